@@ -15,13 +15,14 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import socket, logging
-import xml.sax.expatreader
-import timer, event, xobject
+import socket, logging, time, struct, zlib, errno, os
+from xml.parsers import expat
+import timer, event, xobject, stats, tracing, throttle
 from xobject import XMLObject, EndOfObjectException
 from event import Event, EventSource, EventListener
 from select import select
-from message import Message, Request, Response
+from message import Message, Request, Response, MessageTemplate, \
+                    MessageBatch, encode_batch
 
 class AgentState(XMLObject): 
     def __equal__(self, object):
@@ -52,12 +53,85 @@ STARTING    = StartingState()
 RUNNING     = RunningState()
 STOPPING    = StoppingState()
 
-BUFF_SIZE = 1024
+BUFF_SIZE = 64 * 1024
+
+# Number of spare XML parsers kept for connections to share
+PARSER_POOL_SIZE = 64
 
 # Seconds we give a new socket to request a connection
 CONFIG_TIMEOUT = 2.0
 
+# Seconds an agent which has stopped keeps sending what its peers have not
+# yet taken (the replies to a shutdown, say) before closing its connections
+CLEANUP_TIMEOUT = 5.0
+
+# Seconds between checks for idle connections. How long a connection may
+# be idle depends on its class (see Connection.idle_timeout) and can be
+# changed per class in the AgentConfig.
+IDLE_CHECK_INTERVAL = 5.0
+
+# Default budgets for a single pass of the event loop: how many ready
+# connections are handled, how many queued events are processed, and how
+# long (in seconds) we keep processing events before going back to select
+MAX_IO_PER_TICK = 64
+MAX_EVENTS_PER_TICK = 64
+TIME_SLICE = 0.05
+
+# Default flow control limits. Once the event queue reaches the high
+# watermark the agent is overloaded, and answers new requests with a
+# BusyResponse until the queue drains to the low watermark. New requests
+# from a peer are held back (though we keep reading, so the peer is never
+# stuck behind us) while our unsent data to it is over the send high
+# watermark, until it drains to the low watermark, and a message which would grow the
+# unsent data beyond the send window is not sent at all. A request refused
+# that way is answered with a BusyResponse from the agent itself.
+QUEUE_HIGH_WATERMARK = 5000
+QUEUE_LOW_WATERMARK = 1000
+SEND_HIGH_WATERMARK = 256 * 1024
+SEND_LOW_WATERMARK = 64 * 1024
+SEND_WINDOW = 4 * 1024 * 1024
+
+# Messages sent to the same peer during one pass of the event loop are
+# coalesced into one frame, which is sent early if it grows past
+# MAX_BATCH_SIZE bytes
+BATCH_MESSAGES = True
+MAX_BATCH_SIZE = 64 * 1024
+
+# Compression offered to peers when connecting (None to never compress),
+# and the smallest write which is worth compressing
+COMPRESSION = "zlib"
+COMPRESS_THRESHOLD = 1024
+COMPRESS_LEVEL = 6
+
+# Length of the listen queue of an agent's server socket, the most
+# connections accepted in one pass of the event loop, and the most
+# connections an agent will hold (None for no limit). Connections accepted
+# beyond the limit are closed straight away.
+LISTEN_BACKLOG = 128
+ACCEPT_BATCH = 64
+MAX_CONNECTIONS = None
+
+# Number of connection attempts an agent makes at once, and the rate (per
+# second) and burst size at which it admits the handshakes of connecting
+# agents. A connect attempt which fails is retried after the delay given
+# by the agent's backoff policy (see throttle).
+CONNECT_CONCURRENCY = 16
+HANDSHAKE_RATE = 100.0
+HANDSHAKE_BURST = 200
+
+# Compressed data is sent in a binary frame: a magic byte which can not
+# start an XML document, the codec, flags and the payload length. Each
+# connection keeps one compression stream for all its frames. A frame
+# with the FRAME_BLOB flag holds (uncompressed) one of the blobs of the
+# message which follows it, whose XML may be compressed like any other.
+FRAME_MAGIC = "\x01"
+FRAME_HEADER = "!cBHI"
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER)
+FRAME_BLOB = 0x1
+CODECS = {"zlib": 1}
+
 log = logging.getLogger("agent")
+trc = tracing.getTracer("agent")
 
 class AgentInfo(XMLObject):
     """Basic information about an agent."""
@@ -113,6 +187,30 @@ class AgentConfig(XMLObject):
         self.port = None
         self.name = "Unnamed"
         self.logging_path = ""
+        self.collect_stats = False
+        self.max_io_per_tick = MAX_IO_PER_TICK
+        self.max_events_per_tick = MAX_EVENTS_PER_TICK
+        self.time_slice = TIME_SLICE
+        self.cleanup_timeout = CLEANUP_TIMEOUT
+        self.queue_high_watermark = QUEUE_HIGH_WATERMARK
+        self.queue_low_watermark = QUEUE_LOW_WATERMARK
+        self.send_high_watermark = SEND_HIGH_WATERMARK
+        self.send_low_watermark = SEND_LOW_WATERMARK
+        self.send_window = SEND_WINDOW
+        self.batch_messages = BATCH_MESSAGES
+        self.max_batch_size = MAX_BATCH_SIZE
+        self.compression = COMPRESSION
+        self.compress_threshold = COMPRESS_THRESHOLD
+        self.connect_backoff = throttle.ExponentialBackoff()
+        self.connect_concurrency = CONNECT_CONCURRENCY
+        self.handshake_rate = HANDSHAKE_RATE
+        self.handshake_burst = HANDSHAKE_BURST
+        self.listen_backlog = LISTEN_BACKLOG
+        self.accept_batch = ACCEPT_BATCH
+        self.max_connections = MAX_CONNECTIONS
+        self.evict_connections = True
+        self.handshake_timeout = CONFIG_TIMEOUT
+        self.idle_timeouts = {}
 
     def getBindAddress(self):
         return self.bind_addr
@@ -134,73 +232,247 @@ class AgentConfig(XMLObject):
     def setLoggingPath(self, path):
         self.logging_path = path
 
+    def getCollectStats(self):
+        return self.collect_stats
+    def setCollectStats(self, collect):
+        self.collect_stats = collect
+
+    def getMaxIOPerTick(self):
+        return self.max_io_per_tick
+    def setMaxIOPerTick(self, count):
+        self.max_io_per_tick = count
+
+    def getMaxEventsPerTick(self):
+        return self.max_events_per_tick
+    def setMaxEventsPerTick(self, count):
+        self.max_events_per_tick = count
+
+    def getTimeSlice(self):
+        """Seconds a pass of the event loop may spend processing events,
+        None for no limit"""
+        return self.time_slice
+    def setTimeSlice(self, seconds):
+        self.time_slice = seconds
+
+    def getCleanupTimeout(self):
+        """Seconds a stopped agent spends sending unsent data before it
+        closes its connections"""
+        return self.cleanup_timeout
+    def setCleanupTimeout(self, seconds):
+        self.cleanup_timeout = seconds
+
+    def getQueueWatermarks(self):
+        """Return a tuple of the high and low event queue watermarks"""
+        return (self.queue_high_watermark, self.queue_low_watermark)
+    def setQueueWatermarks(self, high, low):
+        self.queue_high_watermark = high
+        self.queue_low_watermark = low
+
+    def getSendWatermarks(self):
+        """Return a tuple of the high and low watermarks (in bytes) of a
+        connection's unsent data"""
+        return (self.send_high_watermark, self.send_low_watermark)
+    def setSendWatermarks(self, high, low):
+        self.send_high_watermark = high
+        self.send_low_watermark = low
+
+    def getSendWindow(self):
+        return self.send_window
+    def setSendWindow(self, size):
+        self.send_window = size
+
+    def getBatchMessages(self):
+        return self.batch_messages
+    def setBatchMessages(self, batch):
+        self.batch_messages = batch
+
+    def getMaxBatchSize(self):
+        return self.max_batch_size
+    def setMaxBatchSize(self, size):
+        self.max_batch_size = size
+
+    def getCompression(self):
+        """Compression codec offered to and accepted from peers, or None"""
+        return self.compression
+    def setCompression(self, codec):
+        self.compression = codec
+
+    def getCompressThreshold(self):
+        return self.compress_threshold
+    def setCompressThreshold(self, size):
+        self.compress_threshold = size
+
+    def getConnectBackoff(self):
+        """Backoff policy deciding the wait between connect attempts"""
+        return self.connect_backoff
+    def setConnectBackoff(self, policy):
+        self.connect_backoff = policy
+
+    def getConnectConcurrency(self):
+        """Number of connect attempts in progress at once"""
+        return self.connect_concurrency
+    def setConnectConcurrency(self, count):
+        self.connect_concurrency = count
+
+    def getHandshakeRate(self):
+        """Return a tuple of the handshakes admitted per second and the
+        size of the burst admitted at once"""
+        return (self.handshake_rate, self.handshake_burst)
+    def setHandshakeRate(self, rate, burst):
+        self.handshake_rate = rate
+        self.handshake_burst = burst
+
+    def getListenBacklog(self):
+        return self.listen_backlog
+    def setListenBacklog(self, backlog):
+        self.listen_backlog = backlog
+
+    def getAcceptBatch(self):
+        """Most connections accepted in one pass of the event loop"""
+        return self.accept_batch
+    def setAcceptBatch(self, count):
+        self.accept_batch = count
+
+    def getMaxConnections(self):
+        """Most connections the agent will hold, None for no limit"""
+        return self.max_connections
+    def setMaxConnections(self, count):
+        self.max_connections = count
+
+    def getEvictConnections(self):
+        """Once the agent holds max connections, should a new connection
+        replace the least recently used one (rather than be rejected)"""
+        return self.evict_connections
+    def setEvictConnections(self, evict):
+        self.evict_connections = evict
+
+    def getHandshakeTimeout(self):
+        """Seconds a new connection has to send its ConnectRequest"""
+        return self.handshake_timeout
+    def setHandshakeTimeout(self, seconds):
+        self.handshake_timeout = seconds
+
+    def getIdleTimeouts(self):
+        """Dictionary of connection class names to the seconds connections
+        of that class (or classes derived from it) may be idle, None for
+        no limit. Classes not named keep their own idle_timeout."""
+        return self.idle_timeouts
+    def setIdleTimeout(self, class_name, seconds):
+        self.idle_timeouts[class_name] = seconds
+
     def getAgentClass(self):
         return Agent
 
 # Special Messages for generic agents
 class ShutdownRequest(Request): 
     """Tell an agent to shutdown"""
-    pass
+    __slots__ = ()
 class PingRequest(Request): 
     """A request for an agent to reply with a PingResponse"""
-    pass
+    __slots__ = ()
+
+class OkResponse(Response):
+    __slots__ = ()
+class DeniedResponse(Response):
+    __slots__ = ()
+class PingResponse(Response):
+    __slots__ = ()
+class BusyResponse(Response):
+    """Reply to a request the agent was too overloaded to accept. The
+    request was not handled and may be retried later."""
+    __slots__ = ()
+
+class UnsupportedResponse(Response):
+    __slots__ = ()
 
-class OkResponse(Response): pass
-class DeniedResponse(Response): pass
-class PingResponse(Response): pass
+# Special Events for generic agents
+class ConnectionEvent(Event):
+    __slots__ = ()
 
-class UnsupportedResponse(Response): pass
+class IdleCheckEvent(Event):
+    """Event to indicate it is time to look for idle connections"""
+    __slots__ = ()
 
-# Special Events for generic agents
-class ConnectionEvent(Event): pass
+class IdleCheckTimer(timer.Timer):
+    def __init__(self, source = None):
+        timer.Timer.__init__(self, IDLE_CHECK_INTERVAL, IdleCheckEvent(source))
 
 class ConnectEvent(ConnectionEvent):
     """Event generated when a connection is made"""
-    def __init__(self, source, conn):
+    __slots__ = ('conn', 'accepted')
+    def __init__(self, source, conn, accepted = None):
         self.conn = conn
+        self.accepted = accepted
         Event.__init__(self, source)
     def getNewConnection(self):
         return self.conn
+    def getAcceptTime(self):
+        """When the connection was accepted, None if it was not accepted
+        by one of our server connections"""
+        return self.accepted
+
+# The readiness events below never go through the event queue. The agent
+# hands them straight to its own handler, and only listeners registered
+# with Agent.addIOListener() see them. A single instance of each is reused
+# for every ready connection, so they must not be kept or queued.
 
 class ConnectionReadEvent(ConnectionEvent):
     """Event that will cause the source Connection to be read from"""
-    pass
+    __slots__ = ()
 
 class ConnectionWriteEvent(ConnectionEvent):
     """Event that will cause the source Connection to be written to"""
-    pass
+    __slots__ = ()
 
 class ConnectionExceptionEvent(ConnectionEvent):
     """Event that indicates the source Connection has encountered a network
     problem. Probably a disconnect."""
-    pass
+    __slots__ = ()
 
 class MessageEvent(Event):
     """Generic event base class for any incomming or outgoing message"""
+    __slots__ = ('message',)
     def __init__(self, source, msg):
         self.message = msg
         Event.__init__(self, source)
     def getMessage(self):
         return self.message
     def setMessage(self, obj):
-        self.message = msg
+        self.message = obj
 
 class MessageReceivedEvent(MessageEvent): 
     """Event that indicates we have received a message. The event's source
     will be connection that received the message"""
-    pass
+    __slots__ = ()
 
 class MessageSendEvent(MessageEvent):
     """Event that indicates we should be sending this event to the selected
     destination"""
+    __slots__ = ('_target', '_encoded')
     def __init__(self, source, message, target):
         MessageEvent.__init__(self, source, message)
         self._target = target
+        self._encoded = None
     def getTarget(self):
         return self._target
 
+    def setMessage(self, obj):
+        MessageEvent.setMessage(self, obj)
+        self._encoded = None
+
+    def getEncodedMessage(self):
+        """Return the message as it will be written to the target. The
+        message is only serialized the first time this is called, so it
+        should not be changed once the event has been queued."""
+        if self._encoded is None:
+            self._encoded = encode_message(self.message)
+        return self._encoded
+    def setEncodedMessage(self, encoded):
+        self._encoded = encoded
+
 class StateChangeEvent(Event):
     """Event to indicate that the agent has changed states"""
+    __slots__ = ('old_state', 'new_state')
     def __init__(self, source, old_state, new_state):
         Event.__init__(self, source)
         self.old_state = old_state
@@ -214,8 +486,15 @@ class StateChangeEvent(Event):
 class ConnectException(Exception): pass
 
 class Connection:
+    # Seconds the connection may go without reading or writing before the
+    # agent closes it, None to never close it
+    idle_timeout = None
+
     def __init__(self, sock = None):
         self.sock = sock
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.last_active = time.time()
 
     def setSocket(self, sock):
         self.sock = sock
@@ -227,6 +506,24 @@ class Connection:
 
     def fileno(self):
         return self.sock.fileno()
+
+    def getBytesIn(self):
+        return self.bytes_in
+    def getBytesOut(self):
+        return self.bytes_out
+    def getLastActive(self):
+        """Time of the last read or write"""
+        return self.last_active
+    def getPendingBytes(self):
+        """Number of bytes waiting to be sent"""
+        return 0
+    def getRefusedCount(self):
+        """Number of messages not sent because the send window was full"""
+        return 0
+    def getCompressedBytes(self):
+        """Return a tuple of the number of bytes that were compressed and
+        the number of bytes they were compressed to"""
+        return (0, 0)
     
     def isConnected(self):
         return self.sock is not None
@@ -242,13 +539,19 @@ class Connection:
         raise Exception("Not supported")
     
     def read(self):
-        return self.sock.recv(BUFF_SIZE)
+        data = self.sock.recv(BUFF_SIZE)
+        self.bytes_in += len(data)
+        self.last_active = time.time()
+        return data
     def write(self, msg):
+        sent = 0
         try:
             sent = self.sock.send(msg)
         except socket.error, e:
             log.exception("Exception during send")
             self.disconnect()
+        self.bytes_out += sent
+        self.last_active = time.time()
         return sent
     def isReadPending(self):
         log.debug("Base class Connection polled for ReadPending")
@@ -256,22 +559,85 @@ class Connection:
     def isWritePending(self):
         return False
 
+class ParserPool:
+    """Spare XML decoders, so a connection only holds one while part of
+    an object has arrived."""
+    def __init__(self, size = PARSER_POOL_SIZE):
+        self.size = size
+        self.parsers = []
+        self.created = 0
+
+    def acquire(self):
+        """Return an XMLDecoder ready for a new object"""
+        try:
+            # Agents in other threads may share the pool
+            return self.parsers.pop()
+        except IndexError:
+            pass
+        self.created += 1
+        return xobject.XMLDecoder(lazy = True)
+
+    def release(self, decoder):
+        """Take back a decoder, which may be in the middle of an object"""
+        if len(self.parsers) < self.size:
+            decoder.reset()
+            self.parsers.append(decoder)
+
+    def getCreatedCount(self):
+        return self.created
+    def __len__(self):
+        return len(self.parsers)
+
+parsers = ParserPool()
+
+def encode_message(msg):
+    """Return a message as it is sent to other agents: its XML, preceded
+    by a frame for each blob it carries. Anything which is not an
+    XMLObject (an HTTP reply, say) is just converted to a string."""
+    if not isinstance(msg, (XMLObject, xobject.SlottedXMLObject)):
+        return str(msg)
+    encoded, blobs = xobject.convert_value_oob(msg)
+    if len(blobs) == 0:
+        return encoded
+    frames = []
+    for blob in blobs:
+        data = memoryview(blob).tobytes()
+        frames.append(struct.pack(FRAME_HEADER, FRAME_MAGIC, 0, FRAME_BLOB,
+                                  len(data)))
+        frames.append(data)
+    frames.append(encoded)
+    return "".join(frames)
+
 class AgentConnection(Connection):
     def __init__(self, conn_info = None, sock = None):
         Connection.__init__(self, sock)
         self.conn_info = conn_info
         self.out_buffer = ""
-        self.in_buffer = ""
+        self.batch = []
+        self.batch_size = 0
         self.conn_timer = None
         self.self_connect = False
-        self.parser = xml.sax.expatreader.ExpatParser()
-        self.parser.setFeature(xml.sax.expatreader.feature_namespaces, 0)
-        self.parser_hndlr = xobject.SingleXMLObjectHandler()
-        self.parser.setContentHandler(self.parser_hndlr)
-
-        self.parser.reset()
-        self.parser._cont_handler.setDocumentLocator(
-                                 xml.sax.expatreader.ExpatLocator(self.parser))
+        self.connecting = False
+        self.send_high_watermark = SEND_HIGH_WATERMARK
+        self.send_low_watermark = SEND_LOW_WATERMARK
+        self.send_window = SEND_WINDOW
+        self.paused = False
+        self.held = []
+        self.refused = 0
+        self.frame = None
+        self.frame_size = 0
+        self.frame_end = None
+        self.blobs = []
+        self.compression = None
+        self.compress_threshold = COMPRESS_THRESHOLD
+        self.compressor = None
+        self.decompressor = None
+        self.compressed_in = 0
+        self.compressed_out = 0
+        # The parser is taken from the pool when an object starts to
+        # arrive and given back once it is complete
+        self.parser = None
+        self.parsed = 0
     
     def getAgentInfo(self):
         return self.conn_info
@@ -284,6 +650,13 @@ class AgentConnection(Connection):
         else:
             return "Unnamed"
 
+    def getConnectTimer(self):
+        """The timer waiting for the other side to send its
+        ConnectRequest, if any"""
+        return self.conn_timer
+    def setConnectTimer(self, conn_timer):
+        self.conn_timer = conn_timer
+
     def isAuthorized(self, request):
         """Is this connection authorized for the specific request. For now
         we just require that the connection request was made. In the future
@@ -295,10 +668,104 @@ class AgentConnection(Connection):
         """Is the open connection opened by us, or by the remote side"""
         return self.self_connect
 
+    def hasRoom(self, size):
+        """Would another size bytes fit in the send window"""
+        return len(self.out_buffer) == 0 or len(self.out_buffer) + \
+               self.batch_size + size <= self.send_window
+
+    def setSendLimits(self, window, high, low):
+        """Set the send window and the watermarks (all in bytes) of unsent
+        data between which new requests from the peer are held back"""
+        self.send_window = window
+        self.send_high_watermark = high
+        self.send_low_watermark = low
+        self._updateFlow()
+
+    def setCompression(self, codec, threshold = COMPRESS_THRESHOLD,
+                       level = COMPRESS_LEVEL):
+        """Compress every write of at least threshold bytes from now on.
+        This should only be done once the peer is known to understand the
+        codec. A codec of None stops compressing."""
+        if codec is None:
+            self.compressor = None
+        elif CODECS.has_key(codec):
+            self.compressor = zlib.compressobj(level)
+        else:
+            raise ValueError("Unknown compression %s" % str(codec))
+        self.compression = codec
+        self.compress_threshold = threshold
+    def getCompression(self):
+        return self.compression
+    def getCompressedBytes(self):
+        return (self.compressed_in, self.compressed_out)
+
+    def _compress(self, data):
+        payload = self.compressor.compress(data) + \
+                  self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.compressed_in += len(data)
+        self.compressed_out += len(payload)
+        return struct.pack(FRAME_HEADER, FRAME_MAGIC, CODECS[self.compression],
+                           0, len(payload)) + payload
+
+    def _pack(self, data):
+        """Compress data if it is worth it"""
+        if self.compressor is not None and \
+           len(data) >= self.compress_threshold:
+            return self._compress(data)
+        return data
+
+    def _skipFrames(self, data):
+        """Return the offset just past the frames at the start of data"""
+        end = 0
+        while data[end:end + 1] == FRAME_MAGIC:
+            length = struct.unpack(FRAME_HEADER, 
+                                   data[end:end + FRAME_HEADER_SIZE])[3]
+            end += FRAME_HEADER_SIZE + length
+        return end
+
+    def getPendingBytes(self):
+        return len(self.out_buffer)
+    def getRefusedCount(self):
+        return self.refused
+    def isPaused(self):
+        """Are new requests from the peer held back until it takes more of
+        our unsent data"""
+        return self.paused
+
+    def takeHeldEvents(self):
+        """Return the events for requests held back while we were paused,
+        once we no longer are"""
+        if self.paused or len(self.held) == 0:
+            return []
+        held = self.held
+        self.held = []
+        return held
+
+    def _updateFlow(self):
+        pending = len(self.out_buffer)
+        if self.paused:
+            if pending <= self.send_low_watermark:
+                trc.trace("Resuming requests", conn=self.getName(),
+                          pending=pending)
+                self.paused = False
+        elif pending >= self.send_high_watermark:
+            trc.trace("Pausing requests", conn=self.getName(), 
+                      pending=pending)
+            self.paused = True
+
     def disconnect(self):
         Connection.disconnect(self)
         self.out_buffer = ""
+        self.batch = []
+        self.batch_size = 0
         self.self_connect = False
+        self.connecting = False
+        self.paused = False
+        self.held = []
+        self.setCompression(None)
+        self.decompressor = None
+        self.frame = None
+        self.resetParser()
 
     def connect(self):
         if self.isConnected():
@@ -310,100 +777,331 @@ class AgentConnection(Connection):
 
         self.self_connect = True
 
+        # The connect is non-blocking, it completes once the socket becomes
+        # writable. Until then anything we write is buffered.
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((self.getAgentInfo().getHost(), 
-                               int(self.getAgentInfo().getPort())))
+            self.sock.setblocking(0)
+            err = self.sock.connect_ex((self.getAgentInfo().getHost(), 
+                                        int(self.getAgentInfo().getPort())))
         except socket.error, e:
+            err = e.args[0]
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            self.connecting = True
+        elif err == 0:
+            self.sock.setblocking(1)
+        else:
             log.error("Error connecting to agent %s: %s" % \
-                      (str(self.getAgentInfo().getName()), str(e)))
-            self.sock = None
+                      (str(self.getAgentInfo().getName()), os.strerror(err)))
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+
+    def isConnecting(self):
+        """Is a non-blocking connect still in progress"""
+        return self.connecting
+
+    def _checkConnect(self):
+        """Return whether our connect has completed. If it failed, the
+        connection is closed. select() is not used to check, as it cannot
+        take sockets numbered FD_SETSIZE or above."""
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err == 0:
+            # Connecting again tells us whether the first one has finished
+            err = self.sock.connect_ex((self.getAgentInfo().getHost(),
+                                        int(self.getAgentInfo().getPort())))
+            if err in (errno.EINPROGRESS, errno.EWOULDBLOCK,
+                       errno.EALREADY):
+                return False
+            if err == errno.EISCONN:
+                err = 0
+        if err != 0:
+            log.error("Error connecting to agent %s: %s" % \
+                      (str(self.getAgentInfo().getName()), os.strerror(err)))
+            self.disconnect()
+            return False
+        self.connecting = False
+        self.sock.setblocking(1)
+        return True
         
-    def read(self):
+    def resetParser(self):
+        """Get ready for the start of the next object, giving our parser
+        back to the pool"""
+        if self.parser is not None:
+            parsers.release(self.parser)
+            self.parser = None
+        self.parsed = 0
+        if len(self.blobs) > 0:
+            self.blobs = []
+
+    def readEvents(self):
         """This method should only be called when we know there is data
         waiting (by using select, for example). Data read is fed into the
-        XML parser. When an XMLObject is completely read, it will be wrapped
-        in a MessageReceivedEvent and handed back to the caller."""
-
-        log.debug("Connection read")
-        obj = None
+        XML parser, and a list of MessageReceivedEvents is returned, one for
+        every message the data completed. The messages of a MessageBatch
+        are unpacked into separate events. A message which has only partly
+        arrived stays in the parser until the rest of it is read."""
+        trc.trace("Connection read", conn=self.getName())
+        events = []
         try:
-            self.in_buffer = Connection.read(self)
-            if self.in_buffer == "":
-                log.debug("Read 0, disconnect")
-                self.disconnect()
-                return None
-            while self.in_buffer != "":
-                self.parser.feed(self.in_buffer)
-                self.in_buffer = Connection.read(self)
-        except EndOfObjectException, e:
-            obj = e.getObject()
-            self.parser.reset()
-            self.parser_hndlr.reset()
+            data = Connection.read(self)
         except socket.error, e:
             log.exception("Exception from socket")
             self.disconnect()
+            return events
+        if data == "":
+            trc.trace("Read 0, disconnect", conn=self.getName())
+            self.disconnect()
+            return events
+
+        self._receive(data, events)
+        return events
+
+    def _receive(self, data, events):
+        """Split received data into frames and plain XML. A frame arriving
+        in several reads is only joined together once it is complete."""
+        while data != "" and self.isConnected():
+            if self.frame is None and self.parsed == 0:
+                # Between objects, so a frame may start here
+                data = data.lstrip()
+                if data[:1] == FRAME_MAGIC:
+                    self.frame = []
+                    self.frame_size = 0
+                    self.frame_end = None
+            if self.frame is None:
+                data = self._parse(data, events)
+                continue
+
+            self.frame.append(data)
+            self.frame_size += len(data)
+            data = ""
+            if self.frame_end is None:
+                if self.frame_size < FRAME_HEADER_SIZE:
+                    break
+                self.frame = ["".join(self.frame)]
+                length = struct.unpack(FRAME_HEADER, 
+                                   self.frame[0][:FRAME_HEADER_SIZE])[3]
+                self.frame_end = FRAME_HEADER_SIZE + length
+            if self.frame_size < self.frame_end:
+                break
+            frame = "".join(self.frame)
+            end = self.frame_end
+            self.frame = None
+            magic, codec, flags, length = struct.unpack(FRAME_HEADER,
+                                                frame[:FRAME_HEADER_SIZE])
+            data = frame[end:]
+            if flags & FRAME_BLOB:
+                # Kept for the message which follows, without copying
+                self.blobs.append(memoryview(frame)[FRAME_HEADER_SIZE:end])
+                continue
+            payload = frame[FRAME_HEADER_SIZE:end]
 
-        if isinstance(obj, Message):
-            obj = MessageReceivedEvent(self, obj)
+            try:
+                payload = self._decompress(codec, payload)
+            except (zlib.error, ValueError), e:
+                log.error("Invalid frame from %s: %s" % (self.getName(), 
+                                                         str(e)))
+                self.disconnect()
+                break
+            # Frames only ever hold whole objects
+            while payload != "":
+                payload = self._parse(payload, events)
+
+    def _parse(self, data, events):
+        """Feed data to the XML parser, and return whatever follows the
+        first object it completes"""
+        if self.parser is None:
+            self.parser = parsers.acquire()
+            self.parser.blobs = self.blobs
+        try:
+            self.parser.feed(data)
+            self.parsed += len(data)
+            return ""
+        except EndOfObjectException, e:
+            # The parser stops just past the end of the object, the rest
+            # of the data belongs to the objects which follow it
+            end = self.parser.getByteIndex() - self.parsed
+            self.resetParser()
+            self._addReceived(events, e.getObject())
+            return data[end:].lstrip()
+        except (expat.ExpatError, ValueError), e:
+            log.error("Invalid data from %s: %s" % (self.getName(), str(e)))
+            self.disconnect()
+            return ""
+
+    def _decompress(self, codec, payload):
+        if codec != CODECS["zlib"]:
+            raise ValueError("Unknown compression %d" % codec)
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj()
+        return self.decompressor.decompress(payload)
+
+    def _addReceived(self, events, obj):
+        if isinstance(obj, MessageBatch):
+            for msg in obj.getMessages():
+                self._addMessage(events, msg)
+        elif isinstance(obj, Message):
+            self._addMessage(events, obj)
+        else:
+            trc.trace("Unknown obj", obj=obj)
+
+    def _addMessage(self, events, msg):
+        if self.paused and isinstance(msg, Request):
+            # Answering it would only add to the data the peer is not
+            # taking, replies to our own requests still go through
+            self.held.append(MessageReceivedEvent(self, msg))
+        else:
+            events.append(MessageReceivedEvent(self, msg))
+
+    def read(self):
+        """Read like readEvents(), but only return the first event (or
+        None). Any other messages that arrived with it are lost."""
+        events = self.readEvents()
+        if len(events) > 0:
+            return events[0]
+        return None
+
+    def addMessage(self, encoded):
+        """Queue an encoded message, to be sent along with any others
+        queued before the next flush() (or write()) in one frame"""
+        self.batch.append(encoded)
+        self.batch_size += len(encoded)
+    def hasBatch(self):
+        return len(self.batch) > 0
+    def getBatchSize(self):
+        """Number of bytes of queued messages"""
+        return self.batch_size
+
+    def _takeBatch(self):
+        if len(self.batch) == 0:
+            return ""
+        elif len(self.batch) == 1:
+            frame = self.batch[0]
         else:
-            log.debug("Unknown obj %s" % str(obj))
-            obj = None
+            frame = encode_batch(self.batch)
+        self.batch = []
+        self.batch_size = 0
+        return frame
 
-        return obj
+    def flush(self):
+        """Send the queued messages, several in a MessageBatch"""
+        if len(self.batch) > 0:
+            self.write()
 
     def write(self, buffer = ""):
-        log.debug("Connection Write")
+        trc.trace("Connection write", conn=self.getName())
         if not self.isConnected():
             try:
                 self.connect()
             except ConnectException, e:
                 log.debug("Failed to (re)connect to agent. Not writing")
-            return
+                return
+            if not self.isConnected():
+                return
+
+        buffer = str(buffer)
+        batch = ""
+        if not self.hasRoom(len(buffer)):
+            log.warning("Send window to %s is full, message not sent" %
+                        self.getName())
+            if buffer != "":
+                self.refused += 1
+                buffer = ""
+            if self.batch_size > self.send_window:
+                # Never hold more than a window's worth of messages back
+                self.refused += len(self.batch)
+                self.batch = []
+                self.batch_size = 0
+            # Otherwise the batch waits until the peer takes more data
+        else:
+            batch = self._takeBatch()
+        if buffer[:1] == FRAME_MAGIC:
+            # A message with blobs, which are sent as they are. Only the
+            # XML after them may be compressed.
+            end = self._skipFrames(buffer)
+            buffer = self._pack(batch) + buffer[:end] + \
+                     self._pack(buffer[end:])
+        else:
+            buffer = self._pack(batch + buffer)
 
         sent = 0
-        self.out_buffer += str(buffer)
+        self.out_buffer += buffer
+        if self.connecting and not self._checkConnect():
+            self._updateFlow()
+            return
         try:
             sent = Connection.write(self, self.out_buffer)
         except socket.error, e:
             log.exception("Exception during send")
             self.disconnect()
         self.out_buffer = self.out_buffer[sent:]
-        log.debug("%d chars sent" % sent)
+        trc.trace("Chars sent", sent=sent, pending=len(self.out_buffer))
+        self._updateFlow()
 
     def isReadPending(self):
         """If the socket is open, we will always say we are ready for read.
         This assumes the caller is only inspecting this socket when there
         is data ready. We do not want to check for data here because we do 
-        not want to block."""
-        return self.isConnected()
+        not want to block. There is nothing to read until a connect has
+        completed."""
+        return self.isConnected() and not self.connecting
 
     def isWritePending(self):
         """We only want to write data if we are connected and have data
-        waiting in the out_buffer"""
-        return self.isConnected() and len(self.out_buffer) > 0
+        waiting in the out_buffer, or a batch held back while it was full.
+        A connect in progress waits for the socket to become writable
+        too, as do requests held back until we are no longer paused."""
+        return self.isConnected() and \
+               (len(self.out_buffer) > 0 or self.connecting or
+                len(self.batch) > 0 or
+                (len(self.held) > 0 and not self.paused))
 
 class ServerConnection(Connection):
     """Subclass of Connection which represents a socket which is listening 
-    for incoming connections"""
+    for incoming connections. The socket is non-blocking so every
+    connection waiting can be accepted at once."""
     def __init__(self, sock = None):
         Connection.__init__(self, sock)
+        if sock is not None:
+            sock.setblocking(0)
+
+    def newConnection(self, sock):
+        """Return the ConnectEvent for a newly accepted socket"""
+        return ConnectEvent(self, AgentConnection(None, sock), time.time())
+
+    def readEvents(self, limit = ACCEPT_BATCH):
+        """Accept waiting connections until there are no more, or limit
+        have been accepted. Returns a list of ConnectEvents."""
+        events = []
+        while len(events) < limit:
+            try:
+                new_sock, new_addr = self.sock.accept()
+            except socket.error, e:
+                if e.args[0] == errno.ECONNABORTED:
+                    continue
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    log.error("Error accepting connection: %s" % str(e))
+                break
+            log.debug("%s connected" % str(new_addr))
+            events.append(self.newConnection(new_sock))
+        return events
 
     def read(self):
         log.debug("Accepting new connection")
-        new_sock, new_addr = self.sock.accept()
-        log.debug("%s connected" % str(new_addr))
-        return ConnectEvent(self, AgentConnection(None, new_sock))
+        events = self.readEvents(1)
+        if len(events) == 0:
+            return None
+        return events[0]
 
     def isReadPending(self):
         return True
 
-def create_server_socket(address, port):
+def create_server_socket(address, port, backlog = LISTEN_BACKLOG):
     """Utility for creating a server socket"""
     srv_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     srv_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     srv_sock.bind((address, port))
-    srv_sock.listen(5)
+    srv_sock.listen(backlog)
     return srv_sock
 
 class Agent(EventSource, EventListener):
@@ -416,11 +1114,31 @@ class Agent(EventSource, EventListener):
         self.connections = []
         self.event_queue = EventQueue()
         self.timers = TimerCollection()
+        self.stats = None
+        self._read_event = ConnectionReadEvent()
+        self._write_event = ConnectionWriteEvent()
+        self._excep_event = ConnectionExceptionEvent()
+        self.io_listeners = []
+        self._io_turn = 0
+        self.overloaded = False
+        self.shed = 0
+        self._batched = []
+        self._connect_slots = {}
+        self._connect_waiting = []
+        self.accepted = 0
+        self.rejected = 0
+        self.evicted = 0
+        self.reaped = 0
+        self._accepting = 0
         EventSource.__init__(self)
         EventListener.__init__(self)
 
+        if self.config.getCollectStats():
+            self.enableStats()
+
         # Yes we are a listener to ourselves
         self.addListener(self)
+        self.addTimer(IdleCheckTimer(self))
 
         self.setState(STARTING)
         if self.config.getBindAddress() != None and \
@@ -428,7 +1146,8 @@ class Agent(EventSource, EventListener):
             log.debug("Initializing server on %s:%d" % 
                     (self.config.getBindAddress(), self.config.getPort()))
             srv_sock = create_server_socket(self.config.getBindAddress(),
-                                            self.config.getPort())
+                                            self.config.getPort(),
+                                            self.config.getListenBacklog())
             self.addConnection(ServerConnection(srv_sock))
             log.debug("Server initialized")
 
@@ -449,6 +1168,9 @@ class Agent(EventSource, EventListener):
                     return c
         return None
     def addConnection(self, conn):
+        if isinstance(conn, AgentConnection):
+            high, low = self.config.getSendWatermarks()
+            conn.setSendLimits(self.config.getSendWindow(), high, low)
         self.connections.append(conn)
         log.debug("Connection Added (%d)" % (len(self.connections)))
     def dropConnection(self, conn):
@@ -457,17 +1179,47 @@ class Agent(EventSource, EventListener):
     
     def addEvent(self, event):
         self.event_queue.push(event)
-        log.debug("Event Added (%d)" % (len(self.event_queue)))
+        trc.trace("Event added", queue=len(self.event_queue))
     def addTimer(self, timer):
         self.timers.add(timer)
-        log.debug("Timer Added (%d)" % (len(self.timers)))
+        trc.trace("Timer added", timers=len(self.timers))
     def dropTimer(self, timer):
         self.timers.remove(timer)
-        log.debug("Timer Removed (%d)" % (len(self.timers)))
+        trc.trace("Timer removed", timers=len(self.timers))
 
     def getConfig(self):
         return self.config
 
+    def broadcastMessage(self, source, msg, targets):
+        """Send a copy of msg to each of the targets. The message is only
+        serialized once, each copy gets its own key patched in. Returns the
+        list of MessageSendEvents that were queued, the message of each one
+        being the copy (with its key) sent to that target."""
+        template = MessageTemplate(msg)
+        events = []
+        for target in targets:
+            copy_msg, encoded = template.create()
+            evt = MessageSendEvent(source, copy_msg, target)
+            evt.setEncodedMessage(encoded)
+            self.addEvent(evt)
+            events.append(evt)
+        return events
+
+    def getStats(self):
+        """Return the AgentStats being collected, or None if statistics
+        are not enabled"""
+        return self.stats
+    def enableStats(self):
+        """Start collecting runtime statistics. Events already in the queue
+        are carried over but their queue wait time is measured from now."""
+        if self.stats is not None:
+            return
+        self.stats = stats.AgentStats()
+        old_queue = self.event_queue
+        self.event_queue = stats.TimedEventQueue(self.stats)
+        while old_queue.hasEvents():
+            self.event_queue.push(old_queue.pop())
+
     def getInfo(self):
         if self._info is None:
             self._info = AgentInfo(self.getConfig())
@@ -482,46 +1234,254 @@ class Agent(EventSource, EventListener):
     def isRunning(self):
         return isinstance(self.state, RunningState)
 
+    def isOverloaded(self):
+        """Is the event queue too long to accept new requests. Once the
+        queue reaches its high watermark the agent stays overloaded until
+        the queue has drained to the low watermark."""
+        high, low = self.config.getQueueWatermarks()
+        if high is None:
+            return False
+        queued = len(self.event_queue)
+        if self.overloaded:
+            if queued <= low:
+                log.info("Event queue drained (%d), accepting requests" %
+                         queued)
+                self.overloaded = False
+        elif queued >= high:
+            log.warning("Event queue is full (%d), shedding requests" % 
+                        queued)
+            self.overloaded = True
+        return self.overloaded
+
+    def getShedCount(self):
+        """Number of requests answered with a BusyResponse"""
+        return self.shed
+
+    def getAcceptCounts(self):
+        """Return a tuple of the number of connections accepted and the
+        number rejected because the agent held too many"""
+        return (self.accepted, self.rejected)
+
+    def getReapCounts(self):
+        """Return a tuple of the number of connections closed for being
+        idle (or dead) and the number evicted to make room for new ones"""
+        return (self.reaped, self.evicted)
+
+    def acceptConnections(self, conn):
+        """Accept the connections waiting on a server connection, up to
+        the accept batch. Each accepted connection is announced by a
+        ConnectEvent. A connection which would take us past the connection
+        limit replaces the least recently used connection, or if there
+        is none to replace (or the config says not to), is closed."""
+        limit = self.config.getMaxConnections()
+        for evt in conn.readEvents(self.config.getAcceptBatch()):
+            if limit is not None and \
+               len(self.connections) + self._accepting >= limit and \
+               not self._evictConnection():
+                log.warning("Connection limit (%d) reached, rejecting" 
+                            % limit)
+                evt.getNewConnection().disconnect()
+                self.rejected += 1
+                continue
+            self.accepted += 1
+            self._accepting += 1
+            self.addEvent(evt)
+
+    def _evictConnection(self):
+        """Close the least recently used connection, preferring ones which
+        have not told us who they are. Returns False if there was none."""
+        if not self.config.getEvictConnections():
+            return False
+        victim = None
+        for c in self.connections:
+            if isinstance(c, ServerConnection) or not c.isConnected() or \
+               (isinstance(c, AgentConnection) and c.isConnecting()):
+                continue
+            rank = (isinstance(c, AgentConnection) and 
+                    c.getAgentInfo() is not None, c.getLastActive())
+            if victim is None or rank < victim_rank:
+                victim, victim_rank = c, rank
+        if victim is None:
+            return False
+        log.info("Connection limit reached, evicting %s" % victim.getName())
+        self.evicted += 1
+        self.closeConnection(victim)
+        return True
+
+    def closeConnection(self, conn):
+        """Close and drop a connection the way a connection error would,
+        so I/O listeners see it go"""
+        self.notifyReady(self._excep_event, conn)
+
+    def getIdleTimeout(self, conn):
+        """Seconds the connection may be idle, None for no limit"""
+        timeouts = self.config.getIdleTimeouts()
+        if len(timeouts) > 0:
+            classes = [conn.__class__]
+            while classes:
+                cls = classes.pop(0)
+                if timeouts.has_key(cls.__name__):
+                    return timeouts[cls.__name__]
+                classes.extend(cls.__bases__)
+        return conn.idle_timeout
+
+    def reapConnections(self):
+        """Close connections which have been idle too long, and drop closed
+        connections nobody can reconnect (those without an AgentInfo)"""
+        now = time.time()
+        for c in self.connections[:]:
+            if isinstance(c, ServerConnection):
+                continue
+            if not c.isConnected():
+                if not isinstance(c, AgentConnection) or \
+                   c.getAgentInfo() is None:
+                    self.dropConnection(c)
+                    self.reaped += 1
+                continue
+            timeout = self.getIdleTimeout(c)
+            if timeout is not None and now - c.getLastActive() > timeout:
+                log.info("Closing idle connection %s" % c.getName())
+                self.reaped += 1
+                self.closeConnection(c)
+
+    def acquireConnectSlot(self, holder, event):
+        """Ask to make a connect attempt. Returns True if the holder may
+        go ahead (or already holds a slot). Otherwise the holder waits its
+        turn, and the event is queued once it has been given a slot."""
+        if self._connect_slots.has_key(holder):
+            return True
+        if len(self._connect_slots) < self.config.getConnectConcurrency():
+            self._connect_slots[holder] = 1
+            return True
+        if holder not in [h for h, e in self._connect_waiting]:
+            self._connect_waiting.append((holder, event))
+        return False
+
+    def releaseConnectSlot(self, holder):
+        """The holder's connect attempt is over, one way or another"""
+        self._connect_slots.pop(holder, None)
+        self._connect_waiting = [(h, e) for h, e in self._connect_waiting
+                                 if h is not holder]
+        while len(self._connect_waiting) > 0 and \
+              len(self._connect_slots) < self.config.getConnectConcurrency():
+            next_holder, event = self._connect_waiting.pop(0)
+            self._connect_slots[next_holder] = 1
+            self.addEvent(event)
+
+    def getConnectCounts(self):
+        """Return a tuple of the number of connect attempts in progress and
+        the number waiting for their turn"""
+        return (len(self._connect_slots), len(self._connect_waiting))
+
     # Event Handlers
     def handleConnectionReadEvent(self, event):
-        log.debug("Handling Read Event")
-        obj = event.getSource().read()
-        if obj != None:
+        trc.trace("Handling read event")
+        conn = event.getSource()
+        if isinstance(conn, ServerConnection):
+            self.acceptConnections(conn)
+            return
+        if isinstance(conn, AgentConnection):
+            objs = conn.readEvents()
+        else:
+            objs = [conn.read()]
+        self._addReceived(conn, objs)
+
+    def _addReceived(self, conn, objs):
+        for obj in objs:
+            if obj is None:
+                continue
+            if isinstance(obj, MessageReceivedEvent) and \
+               isinstance(obj.getMessage(), Request) and self.isOverloaded():
+                # Reply straight away rather than queueing the request (or
+                # the reply) behind everything else
+                trc.trace("Shedding request",
+                          type=obj.getMessage().__class__)
+                self.shed += 1
+                self.writeMessage(conn, 
+                            str(BusyResponse(obj.getMessage().getKey())))
+                continue
             self.addEvent(obj)
 
     def handleConnectionWriteEvent(self, event):
-        log.debug("Handling Write Event")
-        event.getSource().write()
+        trc.trace("Handling write event")
+        conn = event.getSource()
+        conn.write()
+        if isinstance(conn, AgentConnection):
+            self._addReceived(conn, conn.takeHeldEvents())
 
     def handleConnectionExceptionEvent(self, event):
         log.debug("Handling Connection Exception Event")
         event.getSource().disconnect()
         self.dropConnection(event.getSource())
 
+    def handleIdleCheckEvent(self, event):
+        self.reapConnections()
+        self.addTimer(IdleCheckTimer(self))
+
     def handleConnectEvent(self, event):
         log.debug("Handling connect event")
         self.addConnection(event.getNewConnection())
+        if event.getAcceptTime() is not None:
+            self._accepting -= 1
+            if self.stats is not None:
+                self.stats.recordAccept(time.time() - event.getAcceptTime())
 
     def handleMessageRecievedEvent(self, event):
         # All we will do a receive event is log it.
         # Its up to one of our listeners to care about it.
-        log.debug("Received a message of type %s" 
-                   % str(event.getMessage().__class__))
-        if isinstance(event.getMessage(), Request):
-            log.debug("Request: %s" % str(event.getMessage()))
-        if isinstance(event.getMessage(), Response):
-            log.debug("Response: %s" % str(event.getMessage()))
+        # The message is only serialized if the trace is really emitted.
+        trc.trace("Received a message", type=event.getMessage().__class__,
+                  message=event.getMessage())
 
     def handleMessageSendEvent(self, event):
-        log.debug("Sending a message of type %s" 
-                   % str(event.getMessage().__class__))
-        if isinstance(event.getMessage(), Request):
-            log.debug("Request: %s" % event.getMessage().getKey())
-        if isinstance(event.getMessage(), Response):
-            log.debug("Response: %s" % str(event.getMessage()))
+        msg = event.getMessage()
+        if isinstance(msg, Request):
+            trc.trace("Sending a request", type=msg.__class__,
+                      key=msg.getKey())
+        elif isinstance(msg, Response):
+            trc.trace("Sending a response", type=msg.__class__,
+                      key=msg.getRequestKey())
+        else:
+            trc.trace("Sending a message", type=msg.__class__)
+
+        target = event.getTarget()
+        if isinstance(target, AgentConnection) and \
+           isinstance(msg, Request) and \
+           not target.hasRoom(len(event.getEncodedMessage())):
+            # The request would never be answered, so answer it as an
+            # overloaded peer would
+            log.warning("Send window to %s is full, request not sent" %
+                        target.getName())
+            target.refused += 1
+            self.addEvent(MessageReceivedEvent(target, 
+                                               BusyResponse(msg.getKey())))
+            return
+        if isinstance(target, Connection):
+            self.writeMessage(target, event.getEncodedMessage())
+
+    def writeMessage(self, conn, encoded):
+        """Send an encoded message over a connection. If batching is on,
+        messages for an AgentConnection are held until flushConnections()
+        is called at the end of the pass through the event loop."""
+        if not self.config.getBatchMessages() or \
+           not isinstance(conn, AgentConnection) or \
+           encoded[:1] == FRAME_MAGIC:
+            # Messages with blobs are sent after the batch, not inside it
+            conn.write(encoded)
+            return
 
-        if isinstance(event.getTarget(), Connection):
-            event.getTarget().write(str(event.getMessage()))
+        if not conn.hasBatch():
+            self._batched.append(conn)
+        conn.addMessage(encoded)
+        if conn.getBatchSize() >= self.config.getMaxBatchSize():
+            conn.flush()
+
+    def flushConnections(self):
+        """Send the messages held back for each connection"""
+        batched = self._batched
+        self._batched = []
+        for conn in batched:
+            conn.flush()
 
 
     _handlers = {
@@ -530,7 +1490,8 @@ class Agent(EventSource, EventListener):
                  ConnectionExceptionEvent:  handleConnectionExceptionEvent,
                  MessageSendEvent:          handleMessageSendEvent,
                  MessageReceivedEvent:      handleMessageRecievedEvent,
-                 ConnectEvent:              handleConnectEvent
+                 ConnectEvent:              handleConnectEvent,
+                 IdleCheckEvent:            handleIdleCheckEvent
                }
 
     def getHandlers(self):
@@ -544,14 +1505,57 @@ class Agent(EventSource, EventListener):
                 hndlrs[h](self, evt)
                 found = 1
 
+    def notifyListeners(self, event):
+        if self.stats is None:
+            EventSource.notifyListeners(self, event)
+            return
+
+        for l in self.event_listeners:
+            start = time.time()
+            l.notify(event)
+            self.stats.recordListener(l, time.time() - start)
+
+    def addIOListener(self, listener):
+        """Register a listener which wants to see the raw connection
+        readiness events. Ordinary listeners only see the events the
+        agent generates from them (messages received, new connections)."""
+        self.io_listeners = self.io_listeners + [listener]
+    def dropIOListener(self, listener):
+        listeners = self.io_listeners[:]
+        listeners.remove(listener)
+        self.io_listeners = listeners
+
+    def notifyReady(self, event, conn):
+        """Handle a (reused) readiness event for the given connection. The
+        agent's handler is called directly, followed by any I/O
+        listeners."""
+        event.setSource(conn)
+        try:
+            handler = self.getHandlers()[event.__class__]
+            if self.stats is None:
+                handler(self, event)
+            else:
+                start = time.time()
+                handler(self, event)
+                self.stats.recordEvent(event, time.time() - start)
+
+            for l in self.io_listeners:
+                l.notify(event)
+        finally:
+            event.setSource(None)
+
     def processEvent(self):
         """Process a single event from the event_queue"""
-        log.debug("Going to handle an event")
         event = self.event_queue.pop()
         if event != None:
             try:
-                log.debug("Handling event %s" % str(event))
-                self.notifyListeners(event)
+                trc.trace("Handling event", event=event.__class__)
+                if self.stats is None:
+                    self.notifyListeners(event)
+                else:
+                    start = time.time()
+                    self.notifyListeners(event)
+                    self.stats.recordEvent(event, time.time() - start)
             except Exception, e:
                 log.exception("Error handling event")
 
@@ -559,56 +1563,155 @@ class Agent(EventSource, EventListener):
         log.debug('Shutting down agent')
         self.setState(STOPPING)
 
-    def run(self):
-        self.setState(RUNNING)
-        while self.isRunning() or self.event_queue.hasEvents():
-            should_handle_events = 1
-            write_pending = []
-            read_pending = []
-            excep_pending = []
-            for c in self.connections:
-                if c.isWritePending():
-                    write_pending.append(c)
-                if c.isReadPending():
-                    read_pending.append(c)
-                if c.isConnected():
-                    excep_pending.append(c)
-
-            if self.event_queue.hasEvents():
-                timeout = 0.0
-            else:
-                log.debug("Event Queue is empty")
-                timeout = self.timers.nextTimeoutValue()
-                should_handle_events = 0
-
-            log.debug("Going into select (R:%d W:%d, X:%d for %s sec)" %
-                              (len(read_pending), len(write_pending), 
-                               len(excep_pending), str(timeout)))
-            reads, writes, exceps = select(
-                        read_pending, write_pending, excep_pending, timeout)
-
-            for event in self.timers.checkTimers():
-                self.addEvent(event)
-
-            for e in exceps:
-                log.debug("Handling exception for %s" % str(e))
-                self.notifyListeners(ConnectionExceptionEvent(e))
-                should_handle_events = 0
-            
-            for w in writes:
-                log.debug("%s requests a write" % str(w))
-                self.notifyListeners(ConnectionWriteEvent(w))
-                should_handle_events = 0
-
-            for r in reads:
-                log.debug("%s requests a read" % str(r))
-                self.notifyListeners(ConnectionReadEvent(r))
-                should_handle_events = 0
-
-            if should_handle_events:
-                self.processEvent()
-        
+    def isActive(self):
+        """Does the agent still have work to do? An agent that is no longer
+        running stays active until its event queue has been emptied."""
+        return self.isRunning() or self.event_queue.hasEvents()
+
+    def getPendingConnections(self):
+        """Return a tuple of lists of the connections waiting to be read
+        from, waiting to be written to, and to be checked for errors."""
+        write_pending = []
+        read_pending = []
+        excep_pending = []
+        for c in self.connections:
+            if c.isWritePending():
+                write_pending.append(c)
+            if c.isReadPending():
+                read_pending.append(c)
+            if c.isConnected():
+                excep_pending.append(c)
+        return (read_pending, write_pending, excep_pending)
+
+    def getTimeout(self):
+        """Return how long (in seconds) the agent can wait for I/O before
+        it has something else to do. None means wait forever."""
+        if self.event_queue.hasEvents():
+            return 0.0
+        return self.timers.nextTimeoutValue()
+
+    def dispatch(self, reads, writes, exceps):
+        """Do the work for one pass of the event loop, once we know which
+        connections are ready. Expired timers are queued, then ready
+        connections are handled and queued events processed, each within
+        the budgets given by the agent's config. Neither can starve the
+        other."""
+        tracing_on = trc.isEnabled()
+        start = time.time()
+
+        for event in self.timers.checkTimers():
+            self.addEvent(event)
+
+        # Errors are always handled, they only drop the connection
+        for e in exceps:
+            if tracing_on:
+                trc.trace("Handling exception", conn=e.getName())
+            self.notifyReady(self._excep_event, e)
+
+        # Connections over the I/O budget are left for the next pass (select
+        # will report them again). Each pass starts further along the list
+        # so the same connections are not always the ones left behind.
+        ready = [(self._write_event, w) for w in writes] + \
+                [(self._read_event, r) for r in reads]
+        max_io = self.config.getMaxIOPerTick()
+        if len(ready) > max_io:
+            turn = self._io_turn % len(ready)
+            self._io_turn = turn + max_io
+            ready = (ready[turn:] + ready[:turn])[:max_io]
+        for event, conn in ready:
+            if not conn.isConnected():
+                # Closed earlier in this pass, evicted to make room for a
+                # newly accepted connection say
+                continue
+            if tracing_on:
+                trc.trace("I/O ready", conn=conn.getName(),
+                          event=event.__class__)
+            self.notifyReady(event, conn)
+
+        if self.stats is not None and self.event_queue.hasEvents():
+            self.stats.recordQueueAge(self.event_queue.getOldestAge())
+
+        # Queued events get a share of every pass, however busy the
+        # connections are
+        max_events = self.config.getMaxEventsPerTick()
+        time_slice = self.config.getTimeSlice()
+        events = 0
+        while events < max_events and self.event_queue.hasEvents():
+            self.processEvent()
+            events += 1
+            if time_slice is not None and time.time() - start >= time_slice:
+                break
+
+        self.flushConnections()
+
+        if self.stats is not None:
+            self.stats.recordTick(len(reads) + len(writes), len(ready),
+                                  events, len(self.event_queue))
+
+    def runOnce(self):
+        """Run a single pass of the event loop, waiting in select for at
+        most as long as getTimeout() allows"""
+        # Statistics may be switched on by a handler part way through
+        # the loop, so only time a pass if they were on at the start
+        loop_stats = self.stats
+        if loop_stats is not None:
+            loop_start = time.time()
+
+        read_pending, write_pending, excep_pending = \
+                                            self.getPendingConnections()
+        timeout = self.getTimeout()
+        if trc.isEnabled():
+            trc.trace("Going into select", read=len(read_pending),
+                      write=len(write_pending), excep=len(excep_pending),
+                      timeout=timeout)
+
+        if loop_stats is not None:
+            select_start = time.time()
+        reads, writes, exceps = select(
+                    read_pending, write_pending, excep_pending, timeout)
+        if loop_stats is not None:
+            select_time = time.time() - select_start
+
+        self.dispatch(reads, writes, exceps)
+
+        if loop_stats is not None:
+            loop_stats.recordLoop(select_time,
+                          time.time() - loop_start - select_time)
+
+    def cleanup(self):
+        """Process every event left in the queue once the agent stops, then
+        close all our connections once they have sent what they hold (or
+        the cleanup timeout runs out)"""
         log.debug("Cleaning up event queue")
         while self.event_queue.hasEvents():
             self.processEvent()
+        self.flushConnections()
         log.debug("Event queue empty, all events processed. Ok to shutdown")
+
+        deadline = time.time() + self.config.getCleanupTimeout()
+        pending = [c for c in self.connections if self._isSending(c)]
+        while len(pending) > 0:
+            wait = deadline - time.time()
+            if wait <= 0:
+                log.warning("Closing %d connections with data unsent" %
+                            len(pending))
+                break
+            for c in select([], pending, [], wait)[1]:
+                c.write()
+            pending = [c for c in pending if self._isSending(c)]
+
+        for c in self.connections:
+            if c.isConnected():
+                c.disconnect()
+
+    def _isSending(self, conn):
+        if not conn.isConnected():
+            return False
+        return conn.getPendingBytes() > 0 or \
+               (isinstance(conn, AgentConnection) and conn.hasBatch())
+
+    def run(self):
+        self.setState(RUNNING)
+        while self.isActive():
+            self.runOnce()
+        self.cleanup()
@@ -0,0 +1,618 @@
+#!/usr/bin/python
+
+# JoeAgent - A Multi-Agent Distributed Application Framework
+# Copyright (C) 2004 Rhett Garber
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""
+Benchmarks for the agent runtime.
+
+Everything runs inside this process, agents talk to each other over the
+loopback interface. Each benchmark returns a dictionary of named numbers,
+so the results of two runs can be compared:
+
+    python bench.py                        run every benchmark
+    python bench.py xobject timers         run only the named benchmarks
+    python bench.py -o new.json            also write the results as JSON
+    python bench.py -c old.json            compare against an earlier run
+    python bench.py -q                     smaller, quicker runs
+"""
+
+import sys, os, time, socket, threading, logging, optparse, platform
+import json, StringIO, gc, array
+import xml.sax.expatreader
+import agent, simple, director, job, event, timer, xobject, stats, http
+import message
+from loadgen import get_memory
+
+LOOPBACK = "127.0.0.1"
+
+def find_free_port():
+    """Ask the OS for a port nobody is listening on"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((LOOPBACK, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def start_thread(target):
+    thrd = threading.Thread(target = target)
+    thrd.setDaemon(True)
+    thrd.start()
+    return thrd
+
+def make_status_response(num_agents):
+    """A DirectorStatusResponse listing num_agents agents, which is the
+    largest message a normal deployment sends around"""
+    config = director.DirectorConfig()
+    config.setName("Director")
+    config.setBindAddress(LOOPBACK)
+    config.setPort(9000)
+
+    resp = director.DirectorStatusResponse("1234")
+    resp.setState(agent.RUNNING)
+    resp.setConfig(config)
+    for ndx in range(0, num_agents):
+        info = agent.AgentInfo()
+        info.setHost("10.0.%d.%d" % (ndx / 250, ndx % 250))
+        info.setPort(9000 + ndx)
+        info.setName("Agent %d" % ndx)
+        info.setClassName("simple.SubAgent")
+        resp.addAgentInfo(info)
+    return resp
+
+def decode_message(data):
+    """Decode a single message with the SAX handler, the way
+    AgentConnection did before it used the XMLDecoder"""
+    parser = xml.sax.expatreader.ExpatParser()
+    parser.setFeature(xml.sax.expatreader.feature_namespaces, 0)
+    hndlr = xobject.SingleXMLObjectHandler()
+    parser.setContentHandler(hndlr)
+    parser.reset()
+    try:
+        parser.feed(data)
+    except xobject.EndOfObjectException, e:
+        return e.getObject()
+    return None
+
+def decode_direct(data, lazy = False):
+    """Decode a single message with the XMLDecoder. AgentConnection
+    decodes lazily"""
+    try:
+        xobject.XMLDecoder(lazy).feed(data)
+    except xobject.EndOfObjectException, e:
+        return e.getObject()
+    return None
+
+def timed(func, min_time):
+    """Call func repeatedly for at least min_time seconds. Returns the
+    number of calls and the elapsed time"""
+    count = 0
+    start = time.time()
+    elapsed = 0.0
+    while elapsed < min_time:
+        func()
+        count += 1
+        elapsed = time.time() - start
+    return count, elapsed
+
+def bench_xobject(opts):
+    """XMLObject encode and decode throughput by message size. Decoding
+    is timed with both the SAX handler (sax_decode) and the XMLDecoder,
+    eagerly and lazily"""
+    results = {}
+    for size in opts.sizes:
+        msg = make_status_response(size)
+        data = str(msg)
+
+        count, elapsed = timed(lambda: str(msg), opts.min_time)
+        results["size_%d.bytes" % size] = len(data)
+        results["size_%d.encode_per_sec" % size] = count / elapsed
+        results["size_%d.encode_mb_per_sec" % size] = \
+                            count * len(data) / elapsed / 1048576.0
+
+        count, elapsed = timed(lambda: decode_message(data), opts.min_time)
+        results["size_%d.sax_decode_per_sec" % size] = count / elapsed
+        results["size_%d.sax_decode_mb_per_sec" % size] = \
+                            count * len(data) / elapsed / 1048576.0
+
+        assert str(decode_direct(data)) == str(decode_message(data))
+        count, elapsed = timed(lambda: decode_direct(data), opts.min_time)
+        results["size_%d.decode_per_sec" % size] = count / elapsed
+        results["size_%d.decode_mb_per_sec" % size] = \
+                            count * len(data) / elapsed / 1048576.0
+
+        # Routing only needs the class and key, relaying encodes it again
+        count, elapsed = timed(lambda: decode_direct(data, True).key, 
+                               opts.min_time)
+        results["size_%d.lazy_decode_per_sec" % size] = count / elapsed
+        count, elapsed = timed(lambda: str(decode_direct(data, True)), 
+                               opts.min_time)
+        results["size_%d.lazy_relay_per_sec" % size] = count / elapsed
+        count, elapsed = timed(lambda: str(decode_direct(data)), 
+                               opts.min_time)
+        results["size_%d.relay_per_sec" % size] = count / elapsed
+    return results
+
+def bench_arrays(opts):
+    """Encode and decode of float samples, as a list against an array"""
+    results = {}
+    samples = [ndx * 0.5 for ndx in range(0, opts.samples)]
+    for name, value in [("list", samples), 
+                        ("array", array.array('d', samples))]:
+        data = xobject.convert_value(value)
+        results[name + ".bytes"] = len(data)
+        count, elapsed = timed(lambda: xobject.convert_value(value), 
+                               opts.min_time)
+        results[name + ".encode_per_sec"] = count / elapsed
+        count, elapsed = timed(lambda: xobject.decode(data), opts.min_time)
+        results[name + ".decode_per_sec"] = count / elapsed
+    return results
+
+class BenchEvent(event.Event): pass
+class BenchDoneEvent(event.Event): pass
+
+class CountJob(job.Job):
+    """Job which does nothing but look at every event"""
+    def __init__(self, agnt):
+        job.Job.__init__(self, agnt)
+        self.count = 0
+    def notify(self, evt):
+        job.Job.notify(self, evt)
+        if isinstance(evt, BenchEvent):
+            self.count += 1
+        elif isinstance(evt, BenchDoneEvent):
+            self.getAgent().shutdown()
+
+def bench_events(opts):
+    """Events per second through Agent.run with a number of jobs"""
+    results = {}
+    for num_jobs in opts.jobs:
+        agnt = agent.Agent(agent.AgentConfig())
+        for ndx in range(0, num_jobs):
+            agnt.addListener(CountJob(agnt))
+        for ndx in range(0, opts.events):
+            agnt.addEvent(BenchEvent(agnt))
+        agnt.addEvent(BenchDoneEvent(agnt))
+
+        start = time.time()
+        cpu_start = time.clock()
+        agnt.run()
+        elapsed = time.time() - start
+
+        results["jobs_%d.events_per_sec" % num_jobs] = opts.events / elapsed
+        results["jobs_%d.cpu_sec" % num_jobs] = time.clock() - cpu_start
+    return results
+
+class BenchTickEvent(event.Event): pass
+
+class PingRoundJob(job.Job):
+    """Director job which waits for the expected number of agents to
+    register, then sends rounds of pings to all of them, timing how long
+    it takes for every agent to respond. Shuts the director down (and with
+    it all the agents) when done."""
+    def __init__(self, agnt, expected, rounds):
+        job.Job.__init__(self, agnt)
+        self.expected = expected
+        self.rounds = rounds
+        self.pending = {}
+        self.round_start = 0
+        self.latency = stats.Histogram()
+
+    def _setTimer(self):
+        self.getAgent().addTimer(timer.Timer(0.05, BenchTickEvent(self)))
+
+    def _getAgentConnections(self):
+        conns = []
+        for c in self.getAgent().getConnections():
+            if isinstance(c, agent.AgentConnection) and \
+               c.getAgentInfo() is not None:
+                conns.append(c)
+        return conns
+
+    def _startRound(self):
+        self.round_start = time.time()
+        for evt in self.getAgent().broadcastMessage(self, 
+                           agent.PingRequest(), self._getAgentConnections()):
+            self.pending[evt.getMessage().getKey()] = None
+
+    def notify(self, evt):
+        job.Job.notify(self, evt)
+        if isinstance(evt, BenchTickEvent) and evt.getSource() is self:
+            if len(self._getAgentConnections()) < self.expected:
+                self._setTimer()
+            else:
+                self._startRound()
+
+        elif isinstance(evt, agent.MessageReceivedEvent) and \
+             isinstance(evt.getMessage(), agent.PingResponse) and \
+             self.pending.has_key(evt.getMessage().getRequestKey()):
+            del self.pending[evt.getMessage().getRequestKey()]
+            if len(self.pending) == 0:
+                self.latency.record(time.time() - self.round_start)
+                self.rounds -= 1
+                if self.rounds > 0:
+                    self._startRound()
+                else:
+                    self.getAgent().shutdown()
+
+def bench_ping(opts):
+    """Ping round latency in a Director with a number of SubAgents"""
+    results = {}
+    for num_agents in opts.agents:
+        config = director.DirectorConfig()
+        config.setName("Director")
+        config.setBindAddress(LOOPBACK)
+        config.setPort(find_free_port())
+        dir_agent = director.Director(config)
+        ping_job = PingRoundJob(dir_agent, num_agents, opts.rounds)
+        dir_agent.addListener(ping_job)
+        dir_agent.addEvent(BenchTickEvent(ping_job))
+
+        threads = [start_thread(dir_agent.run)]
+        for ndx in range(0, num_agents):
+            sub_config = simple.SubAgentConfig()
+            sub_config.setName("Agent %d" % ndx)
+            sub_config.setDirectorInfo(dir_agent.getInfo())
+            threads.append(start_thread(simple.SubAgent(sub_config).run))
+
+        for thrd in threads:
+            thrd.join(opts.timeout)
+        if threads[0].isAlive():
+            raise Exception("Director did not finish the ping benchmark")
+
+        hist = ping_job.latency
+        results["agents_%d.round_mean_ms" % num_agents] = \
+                                                hist.getMean() * 1000.0
+        results["agents_%d.round_p99_ms" % num_agents] = \
+                                        hist.getPercentile(99) * 1000.0
+        results["agents_%d.round_max_ms" % num_agents] = \
+                                                hist.getMax() * 1000.0
+    return results
+
+class CountingConnection(agent.AgentConnection):
+    """AgentConnection which counts its writes (each one a send call)"""
+    def __init__(self, conn_info = None, sock = None):
+        agent.AgentConnection.__init__(self, conn_info, sock)
+        self.writes = 0
+    def write(self, buffer = ""):
+        self.writes += 1
+        agent.AgentConnection.write(self, buffer)
+
+def bench_batch(opts):
+    """Messages per second over a socket pair, with and without batching"""
+    results = {}
+    for batching in [False, True]:
+        config = agent.AgentConfig()
+        config.setBatchMessages(batching)
+        agnt = agent.Agent(config)
+        sock, other = socket.socketpair()
+        sender = CountingConnection(None, sock)
+        receiver = agent.AgentConnection(None, other)
+        encoded = [str(agent.PingRequest()) for ndx in range(0, opts.burst)]
+
+        # Each burst is the messages sent to one peer in a single pass
+        # through the event loop
+        sent = received = 0
+        start = time.time()
+        while sent < opts.messages:
+            for data in encoded:
+                agnt.writeMessage(sender, data)
+            agnt.flushConnections()
+            sent += len(encoded)
+            while received < sent:
+                received += len(receiver.readEvents())
+        elapsed = time.time() - start
+        sock.close()
+        other.close()
+
+        name = batching and "batched" or "unbatched"
+        results[name + ".messages_per_sec"] = sent / elapsed
+        results[name + ".writes_per_message"] = \
+                                        float(sender.writes) / sent
+    return results
+
+class MemorySocket:
+    """Socket stand-in which keeps whatever is sent to it, so both ends of
+    a connection can be timed without the kernel in the way"""
+    def __init__(self):
+        self.data = []
+    def send(self, data):
+        self.data.append(data)
+        return len(data)
+    def recv(self, size):
+        if len(self.data) == 0:
+            return ""
+        data = self.data.pop(0)
+        if len(data) > size:
+            self.data.insert(0, data[size:])
+            data = data[:size]
+        return data
+    def close(self):
+        pass
+
+def bench_compression(opts):
+    """CPU time against bytes saved when compressing status responses"""
+    results = {}
+    for num_agents in opts.status_sizes:
+        encoded = str(make_status_response(num_agents))
+        for codec in [None, "zlib"]:
+            sock = MemorySocket()
+            sender = agent.AgentConnection(None, sock)
+            receiver = agent.AgentConnection(None, sock)
+            sender.setCompression(codec)
+
+            send_time = recv_time = 0.0
+            sent = received = wire = 0
+            while sent < opts.status_messages:
+                start = time.clock()
+                sender.write(encoded)
+                send_time += time.clock() - start
+                sent += 1
+                wire += sum([len(data) for data in sock.data])
+
+                start = time.clock()
+                while received < sent:
+                    received += len(receiver.readEvents())
+                recv_time += time.clock() - start
+
+            name = "agents_%d.%s" % (num_agents, codec or "none")
+            # Repeats compress far better than the first message, as the
+            # compression stream is kept across messages
+            results[name + ".bytes_per_message"] = float(wire) / sent
+            results[name + ".send_cpu_ms"] = send_time / sent * 1000.0
+            results[name + ".recv_cpu_ms"] = recv_time / sent * 1000.0
+        results["agents_%d.saved_ratio" % num_agents] = 1.0 - \
+                 results[name + ".bytes_per_message"] / len(encoded)
+    return results
+
+class PayloadMessage(message.Message):
+    __slots__ = ('payload',)
+
+def bench_blobs(opts):
+    """Sending a payload as a string member against sending it as a blob"""
+    results = {}
+    text = "<row id=\"1\">a & b</row>\n" * (opts.payload / 25)
+    for name, payload in [("str", text), ("blob", bytearray(text))]:
+        msg = PayloadMessage()
+        msg.payload = payload
+        sock = MemorySocket()
+        sender = agent.AgentConnection(None, sock)
+        receiver = agent.AgentConnection(None, sock)
+
+        send_time = recv_time = 0.0
+        sent = received = wire = 0
+        while sent < opts.status_messages:
+            start = time.clock()
+            sender.write(agent.encode_message(msg))
+            send_time += time.clock() - start
+            sent += 1
+            wire += sum([len(data) for data in sock.data])
+
+            start = time.clock()
+            while received < sent:
+                for evt in receiver.readEvents():
+                    evt.getMessage().payload
+                    received += 1
+            recv_time += time.clock() - start
+
+        results[name + ".bytes_per_message"] = float(wire) / sent
+        results[name + ".send_cpu_ms"] = send_time / sent * 1000.0
+        results[name + ".recv_cpu_ms"] = recv_time / sent * 1000.0
+    return results
+
+class BenchTimerEvent(event.Event): pass
+
+def bench_timers(opts):
+    """Timer churn: adding, stopping, checking and expiring timers"""
+    timers = timer.TimerCollection()
+    live = []
+    ops = 0
+    start = time.time()
+    while ops < opts.timer_ops:
+        # Keep a window of timers alive, half of which never expire
+        for ndx in range(0, 100):
+            tmr = timer.Timer(ndx % 2 and 60.0 or 0.0, BenchTimerEvent())
+            timers.add(tmr)
+            live.append(tmr)
+        for tmr in live[:50]:
+            timers.remove(tmr)
+        del live[:50]
+        timers.nextTimeoutValue()
+        timers.checkTimers()
+        ops += 100
+    elapsed = time.time() - start
+    return {"timer_ops_per_sec": ops / elapsed,
+            "timers_left": len(timers)}
+
+class HTTPBenchJob(job.Job):
+    """Answers every HTTP request with a tiny page, stops the agent when
+    asked for /stop"""
+    def notify(self, evt):
+        job.Job.notify(self, evt)
+        if isinstance(evt, http.HTTPRequestEvent):
+            if evt.getRequest().getPath() == "/stop":
+                self.getAgent().shutdown()
+            resp = http.HTTPResponse(200, 
+                        [http.Header('Content-type', 'text/plain')], "OK")
+            self.getAgent().addEvent(
+                    http.HTTPResponseEvent(self, resp, evt.getSource()))
+
+def http_get(port, path):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect((LOOPBACK, port))
+    sock.sendall("GET %s HTTP/1.0\r\n\r\n" % path)
+    data = sock.recv(4096)
+    while data != "":
+        data = sock.recv(4096)
+    sock.close()
+
+def bench_http(opts):
+    """Requests per second against an HTTPServerConnection"""
+    port = find_free_port()
+    agnt = agent.Agent(agent.AgentConfig())
+    agnt.addConnection(http.HTTPServerConnection(
+                            agent.create_server_socket(LOOPBACK, port)))
+    agnt.addListener(HTTPBenchJob(agnt))
+    thrd = start_thread(agnt.run)
+
+    start = time.time()
+    for ndx in range(0, opts.requests):
+        http_get(port, "/")
+    elapsed = time.time() - start
+    http_get(port, "/stop")
+    thrd.join(opts.timeout)
+    return {"requests_per_sec": opts.requests / elapsed}
+
+def bench_memory(opts):
+    """Resident memory of idle connections, with parsers taken from the
+    pool only while a message arrives, against each connection holding
+    its own parser (as every connection used to)"""
+    results = {}
+    fresh = agent.ParserPool(0)
+    for name, parser_each in [("pooled", False), ("parser_each", True)]:
+        gc.collect()
+        before = get_memory()
+        conns = []
+        for ndx in range(0, opts.connections):
+            conn = agent.AgentConnection()
+            if parser_each:
+                conn.parser = fresh.acquire()
+            conns.append(conn)
+        results[name + ".kb_per_connection"] = \
+                (get_memory() - before) / 1024.0 / opts.connections
+        del conns
+
+    # Messages still decode, borrowing a parser from the pool
+    created = agent.parsers.getCreatedCount()
+    sock = MemorySocket()
+    sender = agent.AgentConnection(None, sock)
+    receivers = [agent.AgentConnection(None, sock) for n in range(0, 100)]
+    for receiver in receivers:
+        sender.write(str(agent.PingRequest()))
+        assert len(receiver.readEvents()) == 1
+    results["parsers_created"] = agent.parsers.getCreatedCount() - created
+    return results
+
+BENCHMARKS = [
+    ("xobject", bench_xobject),
+    ("arrays",  bench_arrays),
+    ("events",  bench_events),
+    ("ping",    bench_ping),
+    ("batch",   bench_batch),
+    ("compression", bench_compression),
+    ("blobs",   bench_blobs),
+    ("timers",  bench_timers),
+    ("http",    bench_http),
+    ("memory",  bench_memory)
+]
+
+def compare(old, new):
+    """Print how each result changed between two runs"""
+    for name in new.keys():
+        if not old.has_key(name):
+            continue
+        print "%s:" % name
+        metrics = new[name].keys()
+        metrics.sort()
+        for metric in metrics:
+            if not old[name].has_key(metric):
+                continue
+            before = old[name][metric]
+            after = new[name][metric]
+            if before:
+                change = "%+.1f%%" % ((after - before) * 100.0 / before)
+            else:
+                change = "n/a"
+            print "  %-36s %14.3f %14.3f %10s" % (metric, before, after, 
+                                                   change)
+
+def main(argv):
+    parser = optparse.OptionParser(
+                      usage = "%prog [options] [benchmark ...]")
+    parser.add_option("-o", "--output", dest = "output",
+                      help = "write the results as JSON to this file")
+    parser.add_option("-c", "--compare", dest = "compare",
+                      help = "compare with results from an earlier run")
+    parser.add_option("-q", "--quick", dest = "quick", action = "store_true",
+                      default = False, help = "smaller, quicker runs")
+    opts, names = parser.parse_args(argv)
+
+    opts.min_time = 1.0
+    opts.sizes = [1, 10, 100, 1000]
+    opts.samples = 10000
+    opts.payload = 1024 * 1024
+    opts.jobs = [1, 10, 50]
+    opts.events = 20000
+    opts.agents = [1, 10, 25]
+    opts.rounds = 50
+    opts.timer_ops = 20000
+    opts.requests = 1000
+    opts.messages = 20000
+    opts.status_sizes = [10, 100, 1000]
+    opts.status_messages = 50
+    opts.burst = 10
+    opts.connections = 10000
+    opts.timeout = 60.0
+    if opts.quick:
+        opts.min_time = 0.2
+        opts.sizes = [1, 100]
+        opts.samples = 1000
+        opts.payload = 256 * 1024
+        opts.jobs = [1, 10]
+        opts.events = 2000
+        opts.agents = [1, 5]
+        opts.rounds = 10
+        opts.timer_ops = 2000
+        opts.requests = 100
+        opts.messages = 2000
+        opts.status_sizes = [10, 100]
+        opts.status_messages = 10
+        opts.connections = 2000
+
+    known = [name for name, func in BENCHMARKS]
+    for name in names:
+        if name not in known:
+            parser.error("Unknown benchmark %s, choose from: %s" 
+                         % (name, ", ".join(known)))
+
+    results = {}
+    for name, func in BENCHMARKS:
+        if names and name not in names:
+            continue
+        print "Running %s: %s" % (name, func.__doc__)
+        results[name] = func(opts)
+        metrics = results[name].keys()
+        metrics.sort()
+        for metric in metrics:
+            print "  %-36s %14.3f" % (metric, results[name][metric])
+
+    output = {"python": platform.python_version(),
+              "platform": platform.platform(),
+              "time": time.time(),
+              "results": results}
+    if opts.output:
+        out = open(opts.output, "w")
+        json.dump(output, out, indent = 2, sort_keys = True)
+        out.close()
+    if opts.compare:
+        print
+        print "Compared with %s" % opts.compare
+        compare(json.load(open(opts.compare))["results"], results)
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.WARNING)
+    main(sys.argv[1:])
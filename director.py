@@ -15,7 +15,7 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import agent, simple, job, event, timer, message
+import agent, simple, job, event, timer, message, membership
 from xobject import XMLObject
 import logging
 
@@ -24,6 +24,11 @@ log = logging.getLogger("agent.director")
 PING_INTERVAL = 3.0
 PING_TIMEOUT = 1.0
 
+# Number of agents a shutdown waits on at once, and how long (seconds) each
+# one has to answer before it is given up on
+SHUTDOWN_CONCURRENCY = 64
+SHUTDOWN_TIMEOUT = 10.0
+
 class PingJob(job.Job):
     """Job to handling pinging all the connected nodes a specified interval"""
     def __init__(self, agnt):
@@ -34,14 +39,18 @@ class PingJob(job.Job):
         if isinstance(evt, PingEvent):
             log.debug("Pinging all connections")
             agnt = self.getAgent()
+            conns = []
             for c in agnt.getConnections():
                 if isinstance(c, agent.AgentConnection) and \
                         c.getAgentInfo() is not None:
-                    evnt = agent.MessageSendEvent(self, agent.PingRequest(), c)
-                    agnt.addEvent(evnt)
-                    ptimer = PingTimeoutTimer(c)
-                    self.outgoing[evnt.getMessage().getKey()] = ptimer
-                    agnt.addTimer(ptimer)
+                    conns.append(c)
+
+            # Every ping is the same request, only the key differs
+            for evnt in agnt.broadcastMessage(self, agent.PingRequest(), 
+                                              conns):
+                ptimer = PingTimeoutTimer(evnt.getTarget())
+                self.outgoing[evnt.getMessage().getKey()] = ptimer
+                agnt.addTimer(ptimer)
 
             evt.getSource().addTimer(PingTimer(evt.getSource()))
 
@@ -68,12 +77,12 @@ class PingJob(job.Job):
 
 class PingEvent(event.Event):
     """Event to indicate its time to do another round of pinging"""
-    pass
+    __slots__ = ()
 
 class PingTimeoutEvent(event.Event):
     """Event to indicate the ping timer has timedout, the connection
        failed to respond"""
-    pass
+    __slots__ = ()
 
 class PingTimer(timer.Timer):
     def __init__(self, source = None):
@@ -85,37 +94,118 @@ class PingTimeoutTimer(timer.Timer):
         event = PingTimeoutEvent(source)
         timer.Timer.__init__(self, PING_TIMEOUT, event)
 
+class ShutdownTimeoutEvent(event.Event):
+    """Event to indicate an agent did not answer its shutdown request in
+    time. The source is the agent's connection."""
+    __slots__ = ()
+
+class ShutdownTimeoutTimer(timer.Timer):
+    def __init__(self, source, timeout):
+        timer.Timer.__init__(self, timeout, ShutdownTimeoutEvent(source))
+
 class ShutdownJob(job.Job):
     """The shutdown job is executed when a shutdown request is received.
 
-    The job will send shutdown requests to all registered agents.
+    The job will send shutdown requests to all agents registered directly
+    with this director. Agents registered with a relay director are shut
+    down by their relay.
+
+    Agents are shut down in phases, one for each class name listed in the
+    config's shutdown phases and a last phase for every other agent. Within
+    a phase at most the configured concurrency of requests are outstanding
+    at once. An agent is done once it answers, its connection closes, or
+    its deadline passes, so the whole shutdown finishes in bounded time.
 
     When the job is complete, the director agent status will be set to
-    STOPPING.  This only happens once all the agents have responded to the
-    request or failed to respond to a Ping (indicating the agent is already
-    unavailable).
+    STOPPING.
     """
     def __init__(self, agnt):
         job.Job.__init__(self, agnt)
-        self.agnt_conns = {}
-        # We will be creating a hash which will associate each connection with
-        # a message key. This way we can have multiple requests in play at once
-        # and recognize who the reply is from.
+        config = agnt.getConfig()
+        self.concurrency = config.getShutdownConcurrency()
+        self.timeout = config.getShutdownTimeout()
+        self.in_flight = {}
+        self.results = {}
+        self.total = 0
+
+        phase_names = config.getShutdownPhases()
+        self.phases = [[] for i in range(len(phase_names) + 1)]
+        table = agnt.getMembership()
         for conn in agnt.getConnections():
             if isinstance(conn, agent.AgentConnection) and \
+               conn.isConnected() and \
                conn.getAgentInfo() is not None and \
+               table.getMember(conn.getAgentInfo()) is not None and \
                conn.getAgentInfo().getName() != "Shutdown Command":
-                self.agnt_conns[conn] = None
+                class_name = conn.getAgentInfo().getClassName()
+                if class_name in phase_names:
+                    self.phases[phase_names.index(class_name)].append(conn)
+                else:
+                    self.phases[-1].append(conn)
+                self.total += 1
 
     def run(self):
-        # Run will create ShutdownRequest messages for each agent connection
-        for conn in self.agnt_conns.keys():
-            log.debug("Sending shutdown request to agent %s" 
-                      % conn.getAgentInfo().getName())
-            msg = agent.ShutdownRequest()
-            self.agnt_conns[conn] = msg.getKey()
-            evt = agent.MessageSendEvent(self, msg, conn)
-            self.getAgent().addEvent(evt)
+        log.debug("Sending shutdown request to %d agents" % self.total)
+        # We also need to see connections close
+        self.getAgent().addIOListener(self)
+        self._fill()
+
+    def getProgress(self):
+        """Return a dictionary describing how far the shutdown has got:
+        the number of agents in total, waiting to be asked, in flight, the
+        phases not yet finished, and a count for each way an agent can
+        finish (ok, denied, lost, timeout)"""
+        progress = {'total':     self.total,
+                    'queued':    sum([len(p) for p in self.phases]),
+                    'in_flight': len(self.in_flight),
+                    'phases':    len(self.phases),
+                    'ok':        0,
+                    'denied':    0,
+                    'lost':      0,
+                    'timeout':   0}
+        for result in self.results.values():
+            progress[result] += 1
+        return progress
+
+    def isDone(self):
+        return len(self.phases) == 0
+
+    def _fill(self):
+        """Send requests until the concurrency limit is reached, moving on
+        to the next phase once the current one has completely finished"""
+        while self.phases:
+            phase = self.phases[0]
+            room = self.concurrency - len(self.in_flight)
+            batch = [conn for conn in phase[:room] if conn.isConnected()]
+            for conn in phase[:room]:
+                if not conn.isConnected():
+                    self.results[conn] = 'lost'
+            del phase[:room]
+
+            # The request is only serialized once, each copy gets its own key
+            for evt in self.getAgent().broadcastMessage(self, 
+                                             agent.ShutdownRequest(), batch):
+                deadline = ShutdownTimeoutTimer(evt.getTarget(), self.timeout)
+                self.getAgent().addTimer(deadline)
+                self.in_flight[evt.getTarget()] = \
+                              (evt.getMessage().getKey(), deadline)
+
+            if phase or self.in_flight:
+                return
+            self.phases.pop(0)
+
+        # Every agent has been dealt with, we can shutdown
+        self.getAgent().dropIOListener(self)
+        self.getAgent().dropListener(self)
+        log.info("Shutdown complete: %s" % str(self.getProgress()))
+        if self.getAgent().isRunning():
+            self.getAgent().setState(agent.STOPPING)
+
+    def _finish(self, conn, result):
+        key, deadline = self.in_flight.pop(conn)
+        deadline.stop()
+        self.results[conn] = result
+        self._fill()
 
     def notify(self, evt):
         job.Job.notify(self, evt)
@@ -123,43 +213,167 @@ class ShutdownJob(job.Job):
         if isinstance(evt, agent.MessageReceivedEvent) and \
            isinstance(evt.getMessage(), message.Response):
             source = evt.getSource()
-            if self.agnt_conns.has_key(source) and \
-                self.agnt_conns[source] == evt.getMessage().getRequestKey():
+            if self.in_flight.has_key(source) and \
+                self.in_flight[source][0] == evt.getMessage().getRequestKey():
                 # this message is for us
                 if isinstance(evt.getMessage(), agent.OkResponse):
                     log.info("Agent %s stopping" 
                              % source.getAgentInfo().getName())
+                    self._finish(source, 'ok')
 
                 else:
                     log.warning("Agent %s responded to shutdown with: %s" 
                                 % (evt.getSource().getAgentInfo().getName(), 
                                    str(evt.getMessage())))
+                    self._finish(source, 'denied')
+
+        elif isinstance(evt, ShutdownTimeoutEvent):
+            if self.in_flight.has_key(evt.getSource()):
+                log.warning("Agent %s did not respond to shutdown in time"
+                            % evt.getSource().getAgentInfo().getName())
+                self._finish(evt.getSource(), 'timeout')
+
+        elif isinstance(evt, PingTimeoutEvent) or \
+             isinstance(evt, agent.ConnectionEvent):
+            if self.in_flight.has_key(evt.getSource()) and \
+               (isinstance(evt, PingTimeoutEvent) or
+                not evt.getSource().isConnected()):
+                log.info("Connection %s disconnected without responding" 
+                          % evt.getSource().getAgentInfo().getName())
+                self._finish(evt.getSource(), 'lost')
 
-                # We delete the entry in the hash so that we know our shutdown
-                # job for this agent is complete
-                del self.agnt_conns[source]
-                # Note, the director will continue pinging this connection even
-                # after we know it is shutting down.
+class MembershipJob(job.Job):
+    """Keeps the director's membership table up to date and sends every
+    change to the subscribed connections. The job is also an I/O listener
+    of the director, which is how it sees connections close.
+
+    Members registered with a relay director arrive as MembershipDeltas
+    on the relay's connection. They belong to that connection and leave
+    along with it."""
+    def __init__(self, agnt):
+        job.Job.__init__(self, agnt)
+        self.subscribers = {}
+        self.member_conns = {}
+        self.relayed = {}
 
+    def notify(self, evt):
+        job.Job.notify(self, evt)
+        table = self.getAgent().getMembership()
+        if isinstance(evt, simple.AgentJoinedEvent):
+            conn = evt.getConnection()
+            info = conn.getAgentInfo()
+            self.member_conns[membership.member_key(info)] = conn
+            self.publish(table.join(info, agent.RUNNING))
 
         elif isinstance(evt, PingTimeoutEvent):
-            if self.agnt_conns.has_key(evt.getSource()):
-                log.info("Connection %s disconnected without responding" 
-                          % evt.getSource().getAgentInfo().getName())
-                del self.agnt_conns[evt.getSource()]
+            self.lost(evt.getSource())
 
-        if len(self.agnt_conns) == 0 and self.getAgent().isRunning():
-            # All agents have responded, we can shutdown
-            self.getAgent().setState(agent.STOPPING)
+        elif isinstance(evt, agent.ConnectionEvent):
+            if not evt.getSource().isConnected():
+                self.lost(evt.getSource())
+
+        elif isinstance(evt, agent.MessageReceivedEvent):
+            msg = evt.getMessage()
+            conn = evt.getSource()
+            if isinstance(msg, membership.SubscribeRequest):
+                self.subscribers[conn] = 1
+                self.getAgent().addEvent(agent.MessageSendEvent(self,
+                                 table.getSnapshot(msg.getKey()), conn))
+            elif isinstance(msg, membership.MembershipQueryRequest):
+                found = table.query(msg.getName(), msg.getClassName(),
+                                    msg.getHost())
+                resp = membership.MembershipQueryResponse(msg.getKey(),
+                                               table.getVersion(), found)
+                self.getAgent().addEvent(agent.MessageSendEvent(self,
+                                                                resp, conn))
+            elif isinstance(msg, membership.UnsubscribeRequest):
+                self.subscribers.pop(conn, None)
+                self.getAgent().addEvent(agent.MessageSendEvent(self,
+                                 agent.OkResponse(msg.getKey()), conn))
+            elif isinstance(msg, simple.StateNotice) and \
+                 self.isMember(conn):
+                self.publish(table.setState(conn.getAgentInfo(), 
+                                            msg.getState()))
+            elif isinstance(msg, membership.MembershipDelta) and \
+                 self.isMember(conn):
+                self.relay(conn, msg)
+
+    def isMember(self, conn):
+        """Is the connection the one a member registered with us on"""
+        info = conn.getAgentInfo()
+        return info is not None and \
+               self.member_conns.get(membership.member_key(info)) is conn
+
+    def relay(self, conn, delta):
+        """Apply a change reported by the relay director on conn"""
+        table = self.getAgent().getMembership()
+        info = delta.getInfo()
+        key = membership.member_key(info)
+        owned = self.relayed.setdefault(conn, {})
+        if delta.getKind() == membership.JOIN:
+            self.member_conns[key] = conn
+            owned[key] = info
+            self.publish(table.join(info, delta.getState()))
+        elif self.member_conns.get(key) is not conn:
+            # Another connection has since taken over the member
+            return
+        elif delta.getKind() == membership.LEAVE:
+            del self.member_conns[key]
+            owned.pop(key, None)
+            self.publish(table.leave(info))
+        else:
+            self.publish(table.setState(info, delta.getState()))
+
+    def relayTo(self, conn):
+        """Report the membership to a parent director on conn: every
+        current member as a JOIN, then every change as it happens"""
+        table = self.getAgent().getMembership()
+        for record in table.getMembers():
+            delta = membership.MembershipDelta(table.getVersion(),
+                                               membership.JOIN,
+                                               record.getInfo(),
+                                               record.getState())
+            self.getAgent().addEvent(agent.MessageSendEvent(self, 
+                                                            delta, conn))
+        self.subscribers[conn] = 1
+
+    def lost(self, conn):
+        """The connection has gone, along with the member on it (unless
+        the member has already reconnected) and any members it relayed"""
+        self.subscribers.pop(conn, None)
+        table = self.getAgent().getMembership()
+        for key, info in self.relayed.pop(conn, {}).items():
+            if self.member_conns.get(key) is conn:
+                del self.member_conns[key]
+                self.publish(table.leave(info))
+        info = conn.getAgentInfo()
+        if info is None:
+            return
+        key = membership.member_key(info)
+        if self.member_conns.get(key) is conn:
+            del self.member_conns[key]
+            self.publish(table.leave(info))
+
+    def publish(self, delta):
+        """Send a delta to every subscriber, serializing it only once"""
+        if delta is None:
+            return
+        encoded = str(delta)
+        for conn in self.subscribers.keys():
+            evt = agent.MessageSendEvent(self, delta, conn)
+            evt.setEncodedMessage(encoded)
+            self.getAgent().addEvent(evt)
 
 class DirectorStatusResponse(simple.StatusResponse):
     """The response to a status request will contain in addition to basic
     status information the list of all the AgentInfo objects which were
     registered with the Director"""
+    __slots__ = ('config', 'agents', 'shutdown')
     def __init__(self, key = None):
         simple.StatusResponse.__init__(self, key)
         self.config = None
         self.agents = []
+        self.shutdown = None
 
     def setConfig(self, config):
         self.config = config
@@ -170,13 +384,49 @@ class DirectorStatusResponse(simple.StatusResponse):
         assert isinstance(agnt, agent.AgentInfo)
         self.agents.append(agnt)
 
+    def setShutdownProgress(self, progress):
+        self.shutdown = progress
+    def getShutdownProgress(self):
+        """Progress of the director's shutdown, None if it is not shutting
+        down"""
+        return self.shutdown
+
     def clearAgentInfoList(self):
         self.agents = []
 
+    def setAgentInfoList(self, infos):
+        self.agents = infos
+
     def getAgentInfoList(self):
         return self.agents
 
 class DirectorConfig(simple.SimpleAgentConfig):
+    def __init__(self):
+        simple.SimpleAgentConfig.__init__(self)
+        self.shutdown_concurrency = SHUTDOWN_CONCURRENCY
+        self.shutdown_timeout = SHUTDOWN_TIMEOUT
+        self.shutdown_phases = []
+
+    def getShutdownConcurrency(self):
+        """Number of agents a shutdown asks to stop at once"""
+        return self.shutdown_concurrency
+    def setShutdownConcurrency(self, count):
+        self.shutdown_concurrency = count
+
+    def getShutdownTimeout(self):
+        """Seconds an agent has to answer a shutdown request"""
+        return self.shutdown_timeout
+    def setShutdownTimeout(self, seconds):
+        self.shutdown_timeout = seconds
+
+    def getShutdownPhases(self):
+        """List of agent class names (as in AgentInfo, e.g.
+        'simple.SubAgent'), in the order they are shut down. Agents of
+        any other class are shut down last."""
+        return self.shutdown_phases
+    def setShutdownPhases(self, class_names):
+        self.shutdown_phases = class_names
+
     def getAgentClass(self):
         return Director
 
@@ -201,6 +451,32 @@ class Director(simple.SimpleAgent):
     requests. When a shutdown is requested of the director, effectivly
     the request is broadcasted to all agents.
     """
+    def __init__(self, config):
+        self.membership = membership.MembershipTable()
+        self._status_template = None
+        self._status_version = None
+        self._shutdown_job = None
+        self._membership_job = MembershipJob(self)
+        simple.SimpleAgent.__init__(self, config)
+        self.addIOListener(self._membership_job)
+
+    def getInitJobs(self):
+        return simple.SimpleAgent.getInitJobs(self) + \
+               [self._membership_job]
+
+    def getMembership(self):
+        """Return the MembershipTable of the registered agents"""
+        return self.membership
+
+    def getMembershipJob(self):
+        return self._membership_job
+
+    def findAgents(self, name = None, class_name = None, host = None):
+        """Return the AgentInfo of every registered agent matching all of
+        the given fields"""
+        return [r.getInfo() for r in 
+                self.membership.query(name, class_name, host)]
+
     #def getInitJobs(self):
         #return simple.SimpleAgent.getInitJobs(self) + \
            #[PingJob(self)]
@@ -212,23 +488,106 @@ class Director(simple.SimpleAgent):
         resp = DirectorStatusResponse(key)
         resp.setState(self.getState())
         resp.setConfig(self.getConfig())
+        resp.setShutdownProgress(self.getShutdownProgress())
+        if self.getStats() is not None:
+            resp.setStats(self.getStats().getSnapshot(self))
 
         # The director status response consists of a list of all the agents
-        # we are connected to. We need to extract all their AgentInfo
-        # objects and add them to our response
-        for c in self.getConnections():
-            if isinstance(c, agent.AgentConnection):
-                info = c.getAgentInfo()
-                if info is not None:
-                    resp.addAgentInfo(info)
+        # registered with us, which the membership table keeps for us
+        resp.setAgentInfoList(list(self.membership.getInfos()))
         return resp
 
+    def getEncodedStatusResponse(self, key):
+        # Without stats the response only changes along with our state or
+        # the membership, so it is serialized once and reused until then
+        if self.getStats() is not None or self._shutdown_job is not None:
+            return (self.getStatusResponse(key), None)
+        version = (self.membership.getVersion(), self.getState().__class__)
+        if self._status_template is None or \
+           self._status_version != version:
+            self._status_template = message.MessageTemplate(
+                                          self.getStatusResponse(key))
+            self._status_version = version
+        return self._status_template.create(key)
+
     def shutdown(self):
         # Director shutdown is special.
         # In addition to stopping ourselves, we will attempt to shutdown
         # all of the agents we are directing. All this is done in the 
         # Shutdown job
+        if self._shutdown_job is not None:
+            log.debug("Shutdown already in progress")
+            return
         log.debug("Starting shutdown")
-        shutdown_job = ShutdownJob(self)
-        self.addListener(shutdown_job)
-        shutdown_job.run()
+        self._shutdown_job = ShutdownJob(self)
+        self.addListener(self._shutdown_job)
+        self._shutdown_job.run()
+
+    def getShutdownProgress(self):
+        """Return the progress of our shutdown (see ShutdownJob.getProgress)
+        or None if we have not been asked to shutdown"""
+        if self._shutdown_job is None:
+            return None
+        return self._shutdown_job.getProgress()
+
+class RelayJob(job.Job):
+    """Once a relay director has connected to its parent, report our
+    membership to it"""
+    def __init__(self, agnt, connect_job):
+        job.Job.__init__(self, agnt)
+        self.connect_job = connect_job
+
+    def notify(self, evt):
+        job.Job.notify(self, evt)
+        if isinstance(evt, simple.ConnectCompleteEvent) and \
+           evt.getSource() is self.connect_job:
+            log.debug("Relaying membership to parent director")
+            self.getAgent().getMembershipJob().relayTo(evt.getConnection())
+
+class RelayDirectorConfig(DirectorConfig):
+    """A relay director needs the info of its parent director, the same
+    way a SubAgent needs the info of its director."""
+    def __init__(self):
+        DirectorConfig.__init__(self)
+        self.director_info = None
+
+    def getDirectorInfo(self):
+        return self.director_info
+    def setDirectorInfo(self, info):
+        self.director_info = info
+
+    def getAgentClass(self):
+        return RelayDirector
+
+class RelayDirector(Director):
+    """A director which owns a shard of a large deployment.
+
+    Sub-agents register with the relay exactly as they would with the
+    director. The relay registers with its parent director as a
+    sub-agent would, and relays every change of its membership upward,
+    so the parent's membership (and status) covers the whole tree while
+    the parent only holds a connection to each of its relays. Relays can
+    be nested.
+
+    Heartbeats stay within a shard: the parent only watches the relay,
+    and when the relay goes all the agents it relayed leave with it.
+    A shutdown of the parent reaches the relay like any other agent, and
+    the relay in turn shuts down its own shard, so the cost of a
+    broadcast grows with the depth of the tree rather than its size.
+    """
+    def __init__(self, config):
+        self._dir_connect_job = None
+        Director.__init__(self, config)
+
+    def getInitJobs(self):
+        self._dir_connect_job = simple.ConnectJob(self,
+                                  self.getConfig().getDirectorInfo(), -1)
+        return Director.getInitJobs(self) + \
+               [self._dir_connect_job,
+                simple.ReportStateJob(self, self._dir_connect_job),
+                RelayJob(self, self._dir_connect_job)]
+
+    def getInitEvents(self):
+        assert self._dir_connect_job is not None, "Connect job not yet defined"
+        return Director.getInitEvents(self) + \
+               [job.RunJobEvent(self, self._dir_connect_job)]
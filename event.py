@@ -15,11 +15,18 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-class Event:
+class Event(object):
+    """Base class for events. Agents can have deep event queues, so events
+    declare their members in __slots__ rather than each carrying a
+    __dict__. Subclasses which leave out __slots__ still work, they just
+    pay for a __dict__ again."""
+    __slots__ = ('source',)
     def __init__(self, source = None):
         self.source = source
     def getSource(self):
         return self.source
+    def setSource(self, source):
+        self.source = source
 
 class EventSource:
     def __init__(self):
@@ -29,11 +36,16 @@ class EventSource:
         for l in self.event_listeners:
             l.notify(event)
 
+    # Listeners often add or drop listeners (even themselves) while being
+    # notified. Rather than changing the list we are iterating over, a new
+    # list is made, so every listener sees the event being delivered.
     def addListener(self, listener):
-        self.event_listeners.append(listener)
+        self.event_listeners = self.event_listeners + [listener]
     
     def dropListener(self, listener):
-        self.event_listeners.remove(listener)
+        listeners = self.event_listeners[:]
+        listeners.remove(listener)
+        self.event_listeners = listeners
 
 class EventListener:
     def __init__(self):
@@ -42,11 +42,15 @@ handler for:
         Handle response by writing response to the target connection.
 """
 
-import re, string, socket
-import simple, event, message, agent
+import re, string, socket, time
+import simple, event, message, agent, tracing
 
 import logging
 log = logging.getLogger("http")
+trc = tracing.getTracer("http")
+
+# Seconds an HTTP client may keep a connection open without using it
+HTTP_IDLE_TIMEOUT = 60.0
 
 class ParseException(Exception): pass
 
@@ -198,6 +202,7 @@ class HTTPResponse:
         return "Response: %s" % (str(self.code))
 
 class HTTPRequestEvent(event.Event):
+    __slots__ = ('request',)
     def __init__(self, source, request):
         event.Event.__init__(self, source)
         self.request = request
@@ -205,9 +210,11 @@ class HTTPRequestEvent(event.Event):
     def getRequest(self):
         return self.request
 
-class HTTPResponseEvent(agent.MessageSendEvent): pass
+class HTTPResponseEvent(agent.MessageSendEvent):
+    __slots__ = ()
 
 class HTTPRequestErrorEvent(event.Event):
+    __slots__ = ('code', 'request_line')
     def __init__(self, source, code, request_line):
         event.Event.__init__(self, source)
         self.code = code
@@ -216,13 +223,15 @@ class HTTPRequestErrorEvent(event.Event):
     def getCode(self):
         return self.code
     def getRequestLine(self):
-        return self.request
+        return self.request_line
 
 class HTTPConnection(agent.Connection):
     """This connection provides facilities for connecting to a HTTP
     client.  This is based on BaseHTTPRequestHandler class of the
     python standard library. It was not possible to use that library
     directly because it blocks.  """
+    idle_timeout = HTTP_IDLE_TIMEOUT
+
     def __init__(self, sock = None):
         agent.Connection.__init__(self, sock)
         self.raw_request = ""
@@ -232,11 +241,11 @@ class HTTPConnection(agent.Connection):
         return "HTTP Client"
 
     def read(self):
-        log.debug("Connection read")
+        trc.trace("Connection read")
         try:
             self.in_buffer = agent.Connection.read(self)
             if self.in_buffer == "":
-                log.debug("Read 0, disconnect")
+                trc.trace("Read 0, disconnect")
                 self.disconnect()
                 return None
             self.raw_request += self.in_buffer
@@ -268,7 +277,7 @@ class HTTPConnection(agent.Connection):
             self.disconnect()
 
         self.out_buffer = self.out_buffer[sent:]
-        log.debug("%d chars sent" % sent)
+        trc.trace("Chars sent", sent=sent, pending=len(self.out_buffer))
 
         if not self.isWritePending():
             self.disconnect()
@@ -278,14 +287,12 @@ class HTTPConnection(agent.Connection):
     def isWritePending(self):
         return self.isConnected() and len(self.out_buffer) > 0
 
-class HTTPConnectEvent(agent.ConnectEvent): pass
+class HTTPConnectEvent(agent.ConnectEvent):
+    __slots__ = ()
 
 class HTTPServerConnection(agent.ServerConnection):
-    def read(self):
-        log.debug("Accepting a new HTTP connection")
-        new_sock, new_addr = self.sock.accept()
-        log.debug("%s connected" % str(new_addr))
-        return HTTPConnectEvent(self, HTTPConnection(new_sock))
+    def newConnection(self, sock):
+        return HTTPConnectEvent(self, HTTPConnection(sock), time.time())
 
 if __name__ == "__main__":
     sample_headers = ["Connection: keep-alive\r\n",
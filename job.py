@@ -44,6 +44,7 @@ class Job(event.EventListener):
 
 class RunJobEvent(event.Event):
     """Event which should run a given job"""
+    __slots__ = ('job',)
     def __init__(self, source, job):
         event.Event.__init__(self, source)
         self.job = job
@@ -0,0 +1,389 @@
+#!/usr/bin/python
+
+# JoeAgent - A Multi-Agent Distributed Application Framework
+# Copyright (C) 2004 Rhett Garber
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""
+Load generator for reproducing director scaling problems.
+
+Starts a Director and any number of SubAgents in this process, all sharing
+one Reactor, or spread over a few forked processes. Once the agents have
+registered with the director, every sub-agent sends requests to the
+director at a fixed rate and times the responses. Connections between the
+sub-agents and the director can be dropped at random along the way.
+
+    python loadgen.py -n 2000 -w status --rate 0.5 -d 30
+    python loadgen.py -n 5000 -p 4 --drop-rate 5 -o run.json
+
+Workloads are 'ping', 'status', 'custom' (a LoadRequest carrying --payload
+bytes, answered by the director with an OkResponse) or the full class name
+of any Request the director knows how to answer.
+"""
+
+import sys, os, time, random, socket, logging, optparse, resource
+import json, cPickle
+import agent, simple, director, job, event, timer, message, stats, utils
+from reactor import Reactor
+
+log = logging.getLogger("agent.loadgen")
+
+LOOPBACK = "127.0.0.1"
+
+class LoadRequest(message.Request):
+    """Request used by the custom workload"""
+    __slots__ = ('payload',)
+    def __init__(self, payload = ""):
+        message.Request.__init__(self)
+        self.payload = payload
+
+class HandleLoadJob(job.Job):
+    """Director side of the custom workload, answers every LoadRequest"""
+    def notify(self, evt):
+        job.Job.notify(self, evt)
+        if isinstance(evt, agent.MessageReceivedEvent) and \
+           isinstance(evt.getMessage(), LoadRequest):
+            resp = agent.OkResponse(evt.getMessage().getKey())
+            self.getAgent().addEvent(
+                    agent.MessageSendEvent(self, resp, evt.getSource()))
+
+class LoadResults:
+    """Counters shared by all the LoadJobs of one process"""
+    def __init__(self):
+        self.agents = 0
+        self.connected = 0
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.time()
+        self.end_time = None
+        self.sent = 0
+        self.responses = 0
+        self.errors = 0
+        self.busy = 0
+        self.lost = 0
+        self.drops = 0
+        self.reconnects = 0
+        self.latency = stats.Histogram()
+        self.memory = 0
+
+    def finish(self, jobs):
+        self.end_time = time.time()
+        for jb in jobs:
+            self.lost += len(jb.outstanding)
+
+    def merge(self, results):
+        self.agents += results.agents
+        self.connected += results.connected
+        self.sent += results.sent
+        self.responses += results.responses
+        self.errors += results.errors
+        self.busy += results.busy
+        self.lost += results.lost
+        self.drops += results.drops
+        self.reconnects += results.reconnects
+        self.latency.merge(results.latency)
+        self.memory += results.memory
+        self.start_time = min(self.start_time, results.start_time)
+        self.end_time = max(self.end_time, results.end_time)
+
+    def getReport(self):
+        elapsed = self.end_time - self.start_time
+        report = {'agents':       self.agents,
+                  'connected':    self.connected,
+                  'elapsed':      elapsed,
+                  'sent':         self.sent,
+                  'responses':    self.responses,
+                  'errors':       self.errors,
+                  'busy':         self.busy,
+                  'lost':         self.lost,
+                  'drops':        self.drops,
+                  'reconnects':   self.reconnects,
+                  'throughput':   self.responses / elapsed,
+                  'latency_mean_ms': self.latency.getMean() * 1000.0,
+                  'latency_p50_ms':  self.latency.getPercentile(50) * 1000.0,
+                  'latency_p99_ms':  self.latency.getPercentile(99) * 1000.0,
+                  'latency_p999_ms': \
+                                 self.latency.getPercentile(99.9) * 1000.0,
+                  'latency_max_ms':  self.latency.getMax() * 1000.0}
+        if self.agents:
+            report['memory_per_agent_kb'] = \
+                                   self.memory / 1024.0 / self.agents
+        return report
+
+class LoadTickEvent(event.Event): pass
+
+class LoadJob(job.Job):
+    """Sub-agent job which sends a request to the director every interval
+    seconds once it is connected, timing how long the response takes. If
+    the connection is lost, the job reconnects."""
+    def __init__(self, agnt, connect_job, factory, interval, results):
+        job.Job.__init__(self, agnt)
+        self.connect_job = connect_job
+        self.factory = factory
+        self.interval = interval
+        self.results = results
+        self.conn = None
+        self.started = False
+        self.outstanding = {}
+
+    def getConnection(self):
+        return self.conn
+
+    def _setTimer(self, interval):
+        self.getAgent().addTimer(timer.Timer(interval, LoadTickEvent(self)))
+
+    def _reconnect(self):
+        self.results.reconnects += 1
+        self.outstanding = {}
+        self.conn = None
+        agnt = self.getAgent()
+        self.connect_job = simple.ConnectJob(agnt, 
+                                agnt.getConfig().getDirectorInfo(), -1)
+        agnt.addListener(self.connect_job)
+        agnt.addEvent(job.RunJobEvent(agnt, self.connect_job))
+
+    def notify(self, evt):
+        job.Job.notify(self, evt)
+        if isinstance(evt, simple.ConnectCompleteEvent) and \
+           evt.getSource() is self.connect_job:
+            self.conn = evt.getConnection()
+            if not self.started:
+                self.started = True
+                self.results.connected += 1
+                # Spread the first requests out over a whole interval
+                self._setTimer(random.random() * self.interval)
+
+        elif isinstance(evt, LoadTickEvent) and evt.getSource() is self:
+            if self.conn is not None:
+                if self.conn.isConnected():
+                    msg = self.factory()
+                    self.outstanding[msg.getKey()] = time.time()
+                    self.results.sent += 1
+                    self.getAgent().addEvent(
+                            agent.MessageSendEvent(self, msg, self.conn))
+                else:
+                    self._reconnect()
+            self._setTimer(self.interval)
+
+        elif isinstance(evt, agent.MessageReceivedEvent) and \
+             isinstance(evt.getMessage(), message.Response):
+            sent = self.outstanding.pop(evt.getMessage().getRequestKey(), 
+                                        None)
+            if sent is not None:
+                self.results.responses += 1
+                self.results.latency.record(time.time() - sent)
+                if isinstance(evt.getMessage(), agent.DeniedResponse) or \
+                   isinstance(evt.getMessage(), agent.UnsupportedResponse):
+                    self.results.errors += 1
+                elif isinstance(evt.getMessage(), agent.BusyResponse):
+                    self.results.busy += 1
+
+def get_factory(opts):
+    """Return a function creating requests for the chosen workload"""
+    if opts.workload == "ping":
+        return agent.PingRequest
+    elif opts.workload == "status":
+        return simple.StatusRequest
+    elif opts.workload == "custom":
+        payload = "x" * opts.payload
+        return lambda: LoadRequest(payload)
+    else:
+        return utils.get_class(opts.workload)
+
+def get_memory():
+    """Resident memory of this process in bytes"""
+    try:
+        statm = open("/proc/self/statm").read().split()
+        return int(statm[1]) * resource.getpagesize()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def raise_file_limit():
+    """Every agent needs a couple of descriptors, get as many as we can"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 65536
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def create_director(opts):
+    config = director.DirectorConfig()
+    config.setName("Director")
+    config.setBindAddress(LOOPBACK)
+    config.setPort(opts.port)
+    dir_agent = director.Director(config)
+    dir_agent.addListener(HandleLoadJob(dir_agent))
+
+    # Thousands of agents connect at once, do not let the listen backlog
+    # turn them away
+    for c in dir_agent.getConnections():
+        if isinstance(c, agent.ServerConnection):
+            c.getSocket().listen(max(opts.agents, socket.SOMAXCONN))
+    return dir_agent
+
+def run_agents(reactor, count, first, dir_info, opts, deadline):
+    """Add count sub-agents to the reactor and run the workload until
+    deadline. Returns the LoadResults."""
+    results = LoadResults()
+    results.agents = count
+    factory = get_factory(opts)
+    interval = 1.0 / opts.rate
+
+    mem_before = get_memory()
+    jobs = []
+    waiting = range(first, first + count)
+    last_drop = time.time()
+    measuring = False
+    while time.time() < deadline:
+        # Only allow a few agents to be connecting at any one time, so the
+        # director gets a chance to accept everyone before they retry
+        starting = max(0, opts.ramp - (len(jobs) - results.connected))
+        for ndx in waiting[:starting]:
+            config = simple.SubAgentConfig()
+            config.setName("Load Agent %d" % ndx)
+            config.setDirectorInfo(dir_info)
+            sub = simple.SubAgent(config)
+            jb = LoadJob(sub, sub._dir_connect_job, factory, interval, 
+                         results)
+            sub.addListener(jb)
+            jobs.append(jb)
+            reactor.addAgent(sub)
+        del waiting[:starting]
+
+        reactor.runOnce(0.05)
+
+        if not measuring and not waiting and \
+           (results.connected == count or time.time() > 
+                                       results.start_time + opts.ramp_time):
+            log.info("%d of %d agents connected, measuring" 
+                     % (results.connected, count))
+            results.memory = get_memory() - mem_before
+            measuring = True
+            memory = results.memory
+            results.reset()
+            results.memory = memory
+            for jb in jobs:
+                jb.outstanding = {}
+            deadline = min(deadline, time.time() + opts.duration)
+
+        if measuring and opts.drop_rate > 0 and \
+           time.time() - last_drop > 1.0 / opts.drop_rate:
+            last_drop = time.time()
+            jb = random.choice(jobs)
+            if jb.getConnection() is not None and \
+               jb.getConnection().isConnected():
+                jb.getConnection().disconnect()
+                results.drops += 1
+
+    results.finish(jobs)
+    return results
+
+def main(argv):
+    parser = optparse.OptionParser(usage = "%prog [options]")
+    parser.add_option("-n", "--agents", type = "int", default = 100,
+                      help = "number of sub-agents to start")
+    parser.add_option("-p", "--procs", type = "int", default = 1,
+                      help = "number of processes to spread agents over")
+    parser.add_option("-w", "--workload", default = "ping",
+                      help = "ping, status, custom or a Request class name")
+    parser.add_option("-r", "--rate", type = "float", default = 1.0,
+                      help = "requests per second sent by each agent")
+    parser.add_option("-d", "--duration", type = "float", default = 10.0,
+                      help = "seconds to measure for")
+    parser.add_option("--drop-rate", type = "float", default = 0.0,
+                      help = "connections to drop per second")
+    parser.add_option("--payload", type = "int", default = 100,
+                      help = "payload bytes of the custom workload")
+    parser.add_option("--ramp", type = "int", default = 10,
+                      help = "agents allowed to be connecting at once")
+    parser.add_option("--ramp-time", type = "float", default = 60.0,
+                      help = "seconds to wait for every agent to connect")
+    parser.add_option("--port", type = "int", default = 0,
+                      help = "director port (default: any free port)")
+    parser.add_option("-o", "--output", 
+                      help = "write the report as JSON to this file")
+    opts, args = parser.parse_args(argv)
+
+    raise_file_limit()
+    if opts.port == 0:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((LOOPBACK, 0))
+        opts.port = sock.getsockname()[1]
+        sock.close()
+
+    dir_agent = create_director(opts)
+    dir_info = dir_agent.getInfo()
+    deadline = time.time() + opts.ramp_time + opts.duration
+
+    results = LoadResults()
+    if opts.procs <= 1:
+        reactor = Reactor()
+        reactor.addAgent(dir_agent)
+        results.merge(run_agents(reactor, opts.agents, 0, dir_info, opts, 
+                                 deadline))
+    else:
+        children = []
+        per_proc = opts.agents / opts.procs
+        for ndx in range(0, opts.procs):
+            count = per_proc
+            if ndx == opts.procs - 1:
+                count = opts.agents - per_proc * ndx
+            rfd, wfd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(rfd)
+                for c in dir_agent.getConnections():
+                    c.disconnect()
+                child_results = run_agents(Reactor(), count, ndx * per_proc,
+                                           dir_info, opts, deadline)
+                os.write(wfd, cPickle.dumps(child_results))
+                os.close(wfd)
+                os._exit(0)
+            os.close(wfd)
+            children.append((pid, rfd))
+
+        # The director runs here, until every child has reported
+        reactor = Reactor()
+        reactor.addAgent(dir_agent)
+        reports = {}
+        while len(reports) < len(children):
+            reactor.runOnce(0.05)
+            for pid, rfd in children:
+                if reports.has_key(pid):
+                    continue
+                pid_done, status = os.waitpid(pid, os.WNOHANG)
+                if pid_done != 0:
+                    reports[pid] = os.read(rfd, 1048576)
+                    os.close(rfd)
+        for data in reports.values():
+            results.merge(cPickle.loads(data))
+
+    report = results.getReport()
+    report['workload'] = opts.workload
+    report['procs'] = opts.procs
+    names = report.keys()
+    names.sort()
+    for name in names:
+        print "%-22s %s" % (name, report[name])
+    if opts.output:
+        out = open(opts.output, "w")
+        json.dump(report, out, indent = 2, sort_keys = True)
+        out.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level = logging.WARNING)
+    main(sys.argv[1:])
@@ -0,0 +1,310 @@
+# JoeAgent - A Multi-Agent Distributed Application Framework
+# Copyright (C) 2004 Rhett Garber
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""
+Agent membership subscriptions.
+
+Rather than polling the director with StatusRequests, an agent can send it
+a SubscribeRequest. The director answers with a MembershipSnapshot of every
+registered agent, followed by a MembershipDelta each time an agent joins,
+leaves or changes state. Every change carries the next version number, so
+a subscriber which misses one (see MembershipView.apply) simply subscribes
+again for a fresh snapshot.
+"""
+
+import logging
+import agent, simple, job, message
+from xobject import SlottedXMLObject
+
+log = logging.getLogger("agent.membership")
+
+# Kinds of MembershipDelta
+JOIN  = "join"
+LEAVE = "leave"
+STATE = "state"
+
+def member_key(info):
+    """Return the key identifying a member by its AgentInfo"""
+    return (info.getName(), info.getHost(), info.getPort())
+
+def same_state(state, other):
+    # States which came over the wire are copies, so compare their class
+    return state.__class__ is other.__class__
+
+class MemberRecord(SlottedXMLObject):
+    """A registered agent and its last known state"""
+    __slots__ = ('info', 'state')
+    def __init__(self, info = None, state = None):
+        self.info = info
+        self.state = state
+    def getInfo(self):
+        return self.info
+    def getState(self):
+        return self.state
+
+class SubscribeRequest(message.Request):
+    __slots__ = ()
+
+class UnsubscribeRequest(message.Request):
+    __slots__ = ()
+
+class MembershipSnapshot(message.Response):
+    """Reply to a SubscribeRequest with every member as of version"""
+    __slots__ = ('version', 'members')
+    def __init__(self, key = None, version = 0, members = None):
+        message.Response.__init__(self, key)
+        self.version = version
+        if members is None:
+            members = []
+        self.members = members
+    def getVersion(self):
+        return self.version
+    def getMembers(self):
+        return self.members
+
+class MembershipQueryRequest(message.Request):
+    """Ask for the members matching every field which is not None"""
+    __slots__ = ('name', 'class_name', 'host')
+    def __init__(self, name = None, class_name = None, host = None):
+        message.Request.__init__(self)
+        self.name = name
+        self.class_name = class_name
+        self.host = host
+    def getName(self):
+        return self.name
+    def getClassName(self):
+        return self.class_name
+    def getHost(self):
+        return self.host
+
+class MembershipQueryResponse(MembershipSnapshot):
+    """Reply to a MembershipQueryRequest. Only the matching members are
+    included, so it can not be used to load a MembershipView."""
+    __slots__ = ()
+
+class MembershipDelta(message.Message):
+    """A single change to the membership, sent to every subscriber"""
+    __slots__ = ('version', 'kind', 'info', 'state')
+    def __init__(self, version = 0, kind = None, info = None, state = None):
+        message.Message.__init__(self)
+        self.version = version
+        self.kind = kind
+        self.info = info
+        self.state = state
+    def getVersion(self):
+        return self.version
+    def getKind(self):
+        return self.kind
+    def getInfo(self):
+        return self.info
+    def getState(self):
+        return self.state
+
+class MembershipTable:
+    """The director's record of its registered agents. Each change bumps the
+    version and returns the MembershipDelta describing it (or None if
+    nothing changed). Members are indexed by name, class name and host so
+    they can be queried without looking at every member."""
+    def __init__(self):
+        self.version = 0
+        self.members = {}
+        self.indexes = {'name': {}, 'class_name': {}, 'host': {}}
+        self._infos = None
+
+    def getVersion(self):
+        return self.version
+    def getMembers(self):
+        return self.members.values()
+    def getMember(self, info):
+        return self.members.get(member_key(info))
+    def __len__(self):
+        return len(self.members)
+
+    def getInfos(self):
+        """Return the AgentInfo of every member. The list is kept until
+        an agent joins or leaves, so it must not be changed."""
+        if self._infos is None:
+            self._infos = [r.getInfo() for r in self.members.values()]
+        return self._infos
+
+    def _getFields(self, info):
+        return {'name':       info.getName(),
+                'class_name': info.getClassName(),
+                'host':       info.getHost()}
+
+    def _index(self, key, info):
+        for field, value in self._getFields(info).items():
+            keys = self.indexes[field].get(value)
+            if keys is None:
+                keys = self.indexes[field][value] = set()
+            keys.add(key)
+
+    def _unindex(self, key, info):
+        for field, value in self._getFields(info).items():
+            keys = self.indexes[field][value]
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.indexes[field][value]
+
+    def query(self, name = None, class_name = None, host = None):
+        """Return the records of the members matching every field given"""
+        found = None
+        for field, value in [('name', name), ('class_name', class_name),
+                             ('host', host)]:
+            if value is None:
+                continue
+            keys = self.indexes[field].get(value, ())
+            if found is None:
+                found = set(keys)
+            else:
+                found &= keys
+        if found is None:
+            return self.members.values()
+        return [self.members[key] for key in found]
+
+    def _change(self, kind, info, state):
+        self.version += 1
+        return MembershipDelta(self.version, kind, info, state)
+
+    def join(self, info, state = None):
+        key = member_key(info)
+        record = self.members.get(key)
+        if record is not None:
+            # Rejoining (a reconnect) only changes the state
+            return self.setState(info, state)
+        self.members[key] = MemberRecord(info, state)
+        self._index(key, info)
+        self._infos = None
+        return self._change(JOIN, info, state)
+
+    def leave(self, info):
+        key = member_key(info)
+        record = self.members.pop(key, None)
+        if record is None:
+            return None
+        self._unindex(key, record.getInfo())
+        self._infos = None
+        return self._change(LEAVE, record.getInfo(), record.getState())
+
+    def setState(self, info, state):
+        record = self.members.get(member_key(info))
+        if record is None or same_state(record.state, state):
+            return None
+        record.state = state
+        return self._change(STATE, record.getInfo(), state)
+
+    def getSnapshot(self, key):
+        return MembershipSnapshot(key, self.version, self.members.values())
+
+class MembershipView:
+    """A subscriber's copy of the membership, kept up to date by applying
+    the director's deltas in version order"""
+    def __init__(self):
+        self.version = None
+        self.members = {}
+
+    def isLoaded(self):
+        return self.version is not None
+    def getVersion(self):
+        return self.version
+    def getMembers(self):
+        return self.members.values()
+    def getMember(self, info):
+        return self.members.get(member_key(info))
+
+    def reset(self):
+        """Forget our version, when we lose the director. Deltas are
+        ignored until a new snapshot is loaded, as a restarted director
+        starts again from a lower version."""
+        self.version = None
+
+    def load(self, snapshot):
+        self.version = snapshot.getVersion()
+        self.members = {}
+        for record in snapshot.getMembers():
+            self.members[member_key(record.getInfo())] = record
+
+    def apply(self, delta):
+        """Apply a delta. Returns False if a delta was missed, in which case
+        the view is no longer loaded and needs a new snapshot."""
+        if self.version is None or delta.getVersion() <= self.version:
+            # Already part of the snapshot (or waiting for one)
+            return True
+        if delta.getVersion() != self.version + 1:
+            log.warning("Missed membership deltas %d to %d" % 
+                        (self.version + 1, delta.getVersion() - 1))
+            self.version = None
+            return False
+
+        self.version = delta.getVersion()
+        key = member_key(delta.getInfo())
+        if delta.getKind() == LEAVE:
+            self.members.pop(key, None)
+        else:
+            self.members[key] = MemberRecord(delta.getInfo(), 
+                                             delta.getState())
+        return True
+
+class SubscribeJob(job.Job):
+    """Subscribes to the membership of the agent we connect to (normally
+    the director) and keeps a MembershipView of it. We subscribe again
+    every time the connection to that agent is made."""
+    def __init__(self, agent_obj, view = None):
+        job.Job.__init__(self, agent_obj)
+        if view is None:
+            view = MembershipView()
+        self.view = view
+        self.conn = None
+        self.info = None
+        self.key = None
+
+    def getView(self):
+        return self.view
+
+    def run(self):
+        msg = SubscribeRequest()
+        self.key = msg.getKey()
+        assert self.conn != None, "Connection should not be None"
+        self.getAgent().addEvent(agent.MessageSendEvent(self, msg, self.conn))
+
+    def _isSameAgent(self, conn):
+        if self.info is None:
+            return self.conn is None
+        info = conn.getAgentInfo()
+        return info is not None and member_key(info) == member_key(self.info)
+
+    def notify(self, evt):
+        job.Job.notify(self, evt)
+        if self.conn is not None and not self.conn.isConnected():
+            log.info("Lost the connection we subscribed over")
+            self.conn = None
+            self.view.reset()
+        if isinstance(evt, simple.ConnectCompleteEvent) and \
+           self._isSameAgent(evt.getConnection()):
+            self.conn = evt.getConnection()
+            self.info = self.conn.getAgentInfo()
+            self.view.reset()
+            self.run()
+        elif isinstance(evt, agent.MessageReceivedEvent) and \
+             evt.getSource() is self.conn:
+            msg = evt.getMessage()
+            if isinstance(msg, MembershipSnapshot) and \
+               msg.getRequestKey() == self.key:
+                self.view.load(msg)
+            elif isinstance(msg, MembershipDelta):
+                if not self.view.apply(msg):
+                    self.run()
@@ -15,13 +15,22 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-from xobject import XMLObject
+import copy, string
+from xobject import SlottedXMLObject, convert_value
 
-class Message(XMLObject): pass
+class Message(SlottedXMLObject):
+    """Base class for everything agents send to each other. Messages are
+    slotted; subclasses with members of their own should declare them in
+    __slots__ as well (though they still work without)."""
+    __slots__ = ()
+    lazy_decode = True
+    def __init__(self):
+        pass
 
 class Request(Message):
     """Special class of Message which indicates we are requesting the intended
     target to do something"""
+    __slots__ = ('key',)
     def __init__(self):
         Message.__init__(self)
         self.key = str(id(self))
@@ -31,6 +40,7 @@ class Request(Message):
 
 class Response(Message):
     """Special class of Message which is a responding to a request object."""
+    __slots__ = ('key',)
     def __init__(self, key = None):
         Message.__init__(self)
         self.key = key
@@ -38,3 +48,57 @@ class Response(Message):
         self.key = key
     def getRequestKey(self):
         return self.key
+
+class MessageBatch(Message):
+    """Envelope carrying several messages to the same peer in one frame.
+    The receiving connection unpacks it, so agents and jobs only ever see
+    the individual messages."""
+    __slots__ = ('messages',)
+    # Unpacked as soon as it arrives (the messages themselves stay lazy)
+    lazy_decode = False
+    def __init__(self, messages = None):
+        Message.__init__(self)
+        if messages is None:
+            messages = []
+        self.messages = messages
+    def getMessages(self):
+        return self.messages
+
+def encode_batch(encoded):
+    """Wrap a list of already encoded messages in a MessageBatch envelope,
+    without decoding and encoding them again"""
+    return "<XMLObject class=\"%s.%s\">\n" \
+           "  <messages><list>%s</list></messages>\n" \
+           "</XMLObject>\n" % (MessageBatch.__module__, MessageBatch.__name__,
+                                string.join(encoded, '\n'))
+
+class MessageTemplate:
+    """A message which has been serialized once so that copies of it can be
+    sent to many targets (a broadcast). The copies only differ by their key,
+    so rather than serializing each copy we patch its key into the already
+    encoded text."""
+    def __init__(self, msg):
+        self.message = msg
+        key_value = convert_value(msg.key)
+        key_elem = "<key>%s</key>" % key_value
+        encoded = str(msg)
+        if encoded.count(key_elem) != 1:
+            raise ValueError("Cannot find the key of %s" % 
+                             str(msg.__class__))
+
+        ndx = encoded.find(key_elem) + len("<key>")
+        self._prefix = encoded[:ndx]
+        self._suffix = encoded[ndx + len(key_value):]
+
+    def getMessage(self):
+        return self.message
+
+    def create(self, key = None):
+        """Return a tuple of a copy of the message and its encoded form.
+        If no key is given the copy gets a new unique key, the same way a
+        new Request would."""
+        msg = copy.copy(self.message)
+        if key is None:
+            key = str(id(msg))
+        msg.key = key
+        return (msg, self._prefix + convert_value(key) + self._suffix)
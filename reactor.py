@@ -0,0 +1,144 @@
+# JoeAgent - A Multi-Agent Distributed Application Framework
+# Copyright (C) 2004 Rhett Garber
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""
+A Reactor runs the event loops of many agents in a single thread.
+
+Normally every agent calls select() in its own Agent.run loop. When a lot
+of agents live in the same process (for load testing, or a process hosting
+a number of small agents) the Reactor instead waits on the connections of
+all of them with one call, then lets each agent dispatch whatever became
+ready. poll() is used where available since select() can not handle more
+than FD_SETSIZE descriptors.
+"""
+
+import select, time, logging
+import agent
+
+log = logging.getLogger("agent.reactor")
+
+POLL_READ = getattr(select, 'POLLIN', 0) | getattr(select, 'POLLPRI', 0)
+POLL_WRITE = getattr(select, 'POLLOUT', 0)
+POLL_ERROR = getattr(select, 'POLLERR', 0) | getattr(select, 'POLLNVAL', 0)
+POLL_HANGUP = getattr(select, 'POLLHUP', 0)
+
+class Reactor:
+    def __init__(self):
+        self.agents = []
+
+    def addAgent(self, agnt):
+        """Add an agent and start it running"""
+        agnt.setState(agent.RUNNING)
+        self.agents.append(agnt)
+
+    def getAgents(self):
+        return self.agents
+
+    def _wait(self, pending, timeout):
+        """Wait for any of the pending connections to become ready.
+        pending is a list of (agent, reads, writes, exceps) tuples. Returns
+        a dictionary of agent to (reads, writes, exceps) lists of the
+        connections which are ready."""
+        ready = {}
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            conns = {}
+            for agnt, reads, writes, exceps in pending:
+                for c, flag in [(c, POLL_READ) for c in reads] + \
+                               [(c, POLL_WRITE) for c in writes] + \
+                               [(c, POLL_ERROR) for c in exceps]:
+                    fd = c.fileno()
+                    if conns.has_key(fd):
+                        conns[fd][2] |= flag
+                    else:
+                        conns[fd] = [agnt, c, flag]
+            for fd, (agnt, c, flags) in conns.items():
+                poller.register(fd, flags)
+
+            if timeout is not None:
+                timeout = int(timeout * 1000)
+            for fd, flags in poller.poll(timeout):
+                agnt, c, wanted = conns[fd]
+                lists = ready.setdefault(agnt, ([], [], []))
+                # A hang up is reported to a connection as a read (which
+                # will come back empty), unless it is not being read from
+                if flags & POLL_ERROR or \
+                   (flags & POLL_HANGUP and not wanted & POLL_READ):
+                    lists[2].append(c)
+                    continue
+                if flags & (POLL_READ | POLL_HANGUP) and wanted & POLL_READ:
+                    lists[0].append(c)
+                if flags & POLL_WRITE and wanted & POLL_WRITE:
+                    lists[1].append(c)
+        else:
+            all_reads = []
+            all_writes = []
+            all_exceps = []
+            owner = {}
+            for agnt, reads, writes, exceps in pending:
+                all_reads.extend(reads)
+                all_writes.extend(writes)
+                all_exceps.extend(exceps)
+                for c in reads + writes + exceps:
+                    owner[c] = agnt
+            reads, writes, exceps = select.select(all_reads, all_writes, 
+                                                  all_exceps, timeout)
+            for ndx, conns in [(0, reads), (1, writes), (2, exceps)]:
+                for c in conns:
+                    ready.setdefault(owner[c], ([], [], []))[ndx].append(c)
+        return ready
+
+    def runOnce(self, max_timeout = None):
+        """Run one pass of the event loop of every agent. We wait for I/O
+        no longer than the most impatient agent (or max_timeout) allows."""
+        pending = []
+        timeouts = []
+        timeout = max_timeout
+        for agnt in self.agents:
+            reads, writes, exceps = agnt.getPendingConnections()
+            pending.append((agnt, reads, writes, exceps))
+            agnt_timeout = agnt.getTimeout()
+            timeouts.append(agnt_timeout)
+            if agnt_timeout is not None and \
+               (timeout is None or agnt_timeout < timeout):
+                timeout = agnt_timeout
+
+        start = time.time()
+        ready = self._wait(pending, timeout)
+        waited = time.time() - start
+
+        for agnt, agnt_timeout in zip(self.agents[:], timeouts):
+            # Agents with nothing ready and nothing due are left alone
+            if ready.has_key(agnt):
+                reads, writes, exceps = ready[agnt]
+            elif agnt_timeout is not None and agnt_timeout <= waited:
+                reads, writes, exceps = ([], [], [])
+            else:
+                continue
+            try:
+                agnt.dispatch(reads, writes, exceps)
+            except Exception, e:
+                log.exception("Error in event loop of %s" 
+                              % agnt.getConfig().getName())
+            if not agnt.isActive():
+                agnt.cleanup()
+                self.agents.remove(agnt)
+
+    def run(self):
+        """Run until every agent has stopped"""
+        while len(self.agents) > 0:
+            self.runOnce()
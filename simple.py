@@ -18,49 +18,151 @@
 import logging
 log = logging.getLogger("agent.simple")
 
-import agent, job, utils, event, message, timer
+import agent, job, utils, event, message, timer, tracing, throttle
+trc = tracing.getTracer("agent.simple")
 
 CONNECT_RETRY = 3.0
 
 class ConnectRequest(agent.Request): 
-    def __init__(self, info = None):
+    __slots__ = ('info', 'compression')
+    def __init__(self, info = None, compression = None):
         agent.Request.__init__(self)
         self.info = info
+        if compression is None:
+            compression = []
+        self.compression = compression
     def getInfo(self):
         return self.info
+    def getCompression(self):
+        """List of compression codecs the connecting agent understands"""
+        return self.compression
+
+class ConnectResponse(agent.OkResponse):
+    """Accepts a ConnectRequest, naming the compression codec (if any) both
+    sides may now use"""
+    __slots__ = ('compression',)
+    def __init__(self, key = None, compression = None):
+        agent.OkResponse.__init__(self, key)
+        self.compression = compression
+    def getCompression(self):
+        return self.compression
 
 class ConnectionRequestTimeoutEvent(agent.ConnectionEvent):
     """This event is generated when a connection has not returned
     a connection request in time"""
-    pass
+    __slots__ = ()
 
 class ConnectionRequestTimer(timer.Timer):
     """Timer for connection to deliver a connection request in time"""
-    def __init__(self, source = None):
-        event = ConnectionConfTimeoutEvent(source)
-        timer.Timer.__init__(self, CONFIG_TIMEOUT, event)
+    def __init__(self, source = None, timeout = agent.CONFIG_TIMEOUT):
+        event = ConnectionRequestTimeoutEvent(source)
+        timer.Timer.__init__(self, timeout, event)
+
+class HandshakeReadyEvent(event.Event):
+    """Event to indicate waiting ConnectRequests may now be handled"""
+    __slots__ = ()
 
 class HandleConnectJob(job.Job):
     """When an agent connects to us, it will request connect and provide us
     with its info object. This allows us to know what kind of agent it is
-    and connect to its server port if it has one"""
+    and connect to its server port if it has one.
+
+    Requests are admitted at the rate given by the agent config. A burst
+    of requests beyond it waits, in order, until the rate allows it to be
+    handled, so a crowd of agents reconnecting at once is taken in
+    smoothly.
+
+    A connection we accept has the config's handshake timeout to send
+    its request, after which it is closed."""
+    def __init__(self, agnt):
+        job.Job.__init__(self, agnt)
+        rate, burst = agnt.getConfig().getHandshakeRate()
+        self.bucket = None
+        if rate is not None:
+            self.bucket = throttle.TokenBucket(rate, burst)
+        self.waiting = []
+        self.timer = None
+
+    def getWaitingCount(self):
+        """Number of ConnectRequests waiting to be handled"""
+        return len(self.waiting)
+
     def notify(self, evt):
         job.Job.notify(self, evt)
-        if isinstance(evt, agent.MessageReceivedEvent) and \
+        if isinstance(evt, agent.ConnectEvent) and \
+           isinstance(evt.getNewConnection(), agent.AgentConnection):
+            conn = evt.getNewConnection()
+            conn.setConnectTimer(ConnectionRequestTimer(conn,
+                           self.getAgent().getConfig().getHandshakeTimeout()))
+            self.getAgent().addTimer(conn.getConnectTimer())
+
+        elif isinstance(evt, ConnectionRequestTimeoutEvent):
+            conn = evt.getSource()
+            conn.setConnectTimer(None)
+            if conn.getAgentInfo() is None and conn.isConnected() and \
+               conn in self.getAgent().getConnections():
+                log.info("Closing connection which sent no ConnectRequest")
+                self.getAgent().closeConnection(conn)
+
+        elif isinstance(evt, agent.MessageReceivedEvent) and \
            isinstance(evt.getMessage(), ConnectRequest):
-            # We are only goign to accept the connection if we don't already
-            # have a connection to it.
-            info = evt.getMessage().getInfo()
-            conn = self.getAgent().getConnectionByInfo(info)
-            if conn is None:
-                evt.getSource().setAgentInfo(info)
-               
-                out_msg = agent.OkResponse(evt.getMessage().getKey())
+            conn_timer = evt.getSource().getConnectTimer()
+            if conn_timer is not None:
+                conn_timer.stop()
+                evt.getSource().setConnectTimer(None)
+            if self.bucket is None or \
+               (len(self.waiting) == 0 and self.bucket.take()):
+                self.handle(evt)
+            else:
+                self.waiting.append(evt)
+                self._wait()
+
+        elif isinstance(evt, HandshakeReadyEvent) and evt.getSource() is self:
+            self.timer = None
+            while len(self.waiting) > 0:
+                if not self.waiting[0].getSource().isConnected():
+                    # The agent gave up on us while it waited
+                    self.waiting.pop(0)
+                elif self.bucket.take():
+                    self.handle(self.waiting.pop(0))
+                else:
+                    break
+            if len(self.waiting) > 0:
+                self._wait()
+
+    def _wait(self):
+        if self.timer is None:
+            self.timer = timer.Timer(self.bucket.getWait(), 
+                                     HandshakeReadyEvent(self))
+            self.getAgent().addTimer(self.timer)
+
+    def handle(self, evt):
+        # We are only goign to accept the connection if we don't already
+        # have a connection to it.
+        info = evt.getMessage().getInfo()
+        conn = self.getAgent().getConnectionByInfo(info)
+        if conn is not None and not conn.isConnected():
+            # The agent lost its old connection and is reconnecting
+            self.getAgent().dropConnection(conn)
+            conn = None
+        if conn is None:
+            evt.getSource().setAgentInfo(info)
+
+            config = self.getAgent().getConfig()
+            codec = config.getCompression()
+            if codec in evt.getMessage().getCompression():
+                evt.getSource().setCompression(codec,
+                                        config.getCompressThreshold())
             else:
-                out_msg = agent.DeniedResponse(evt.getMessage().getKey())
+                codec = None
+            out_msg = ConnectResponse(evt.getMessage().getKey(), codec)
+            self.getAgent().addEvent(
+                            AgentJoinedEvent(self, evt.getSource()))
+        else:
+            out_msg = agent.DeniedResponse(evt.getMessage().getKey())
 
-            e = agent.MessageSendEvent(self, out_msg, evt.getSource())
-            self.getAgent().addEvent(e)
+        e = agent.MessageSendEvent(self, out_msg, evt.getSource())
+        self.getAgent().addEvent(e)
 
 class HandlePingJob(job.Job):
     """Respond to a Ping Request"""
@@ -68,7 +170,7 @@ class HandlePingJob(job.Job):
         job.Job.notify(self, evt)
         if isinstance(evt, agent.MessageReceivedEvent) and \
            isinstance(evt.getMessage(), agent.PingRequest):
-            log.debug("Replying to ping to %s" % evt.getSource().getName())
+            trc.trace("Replying to ping", conn=evt.getSource().getName())
             msg = evt.getMessage()
             key = msg.getKey()
             conn = evt.getSource()
@@ -100,20 +202,32 @@ class HandleShutdownJob(job.Job):
                                          self, out_msg, evt.getSource()))
 
 class ConnectCompleteEvent(event.Event):
+    __slots__ = ('connection',)
+    def __init__(self, source, connection):
+        event.Event.__init__(self, source)
+        self.connection = connection
+    def getConnection(self):
+        return self.connection
+
+class AgentJoinedEvent(event.Event):
+    """Event generated when a connecting agent has been accepted"""
+    __slots__ = ('connection',)
     def __init__(self, source, connection):
         event.Event.__init__(self, source)
         self.connection = connection
     def getConnection(self):
         return self.connection
 
-class ConnectFailedEvent(event.Event): pass
+class ConnectFailedEvent(event.Event):
+    __slots__ = ()
 
-class ConnectRetryEvent(event.Event): pass
+class ConnectRetryEvent(event.Event):
+    __slots__ = ()
 
 class ConnectRetryTimer(timer.Timer):
-    def __init__(self, source = None):
+    def __init__(self, source = None, interval = CONNECT_RETRY):
         evt = ConnectRetryEvent(source)
-        timer.Timer.__init__(self, CONNECT_RETRY, evt)
+        timer.Timer.__init__(self, interval, evt)
 
 class ConnectJob(job.Job):
     """The ConnectJob will attempt to open a connection to a remote agent.
@@ -121,15 +235,23 @@ class ConnectJob(job.Job):
     ConnectionRequest object. We will attempt to connect for max_retries
     number of times. Eventually, if a OkResponse is received, we will
     create a ConnectCompleteEvent to notify anyone who cares that the
-    connection was successful"""
+    connection was successful.
+
+    The wait between attempts is given by a backoff policy (by default
+    the agent config's). Each attempt also needs one of the agent's
+    connect slots, so only a limited number are in progress at once."""
     def __init__(self, agent_obj, agent_info, max_retries = -1, 
-                 send_msg = None):
+                 send_msg = None, backoff = None):
         job.Job.__init__(self, agent_obj)
         self.key = None
         self._max_retries = max_retries
         self._retries = 0
         self._connection = None
         self._send_msg = send_msg
+        self._timer = None
+        if backoff is None:
+            backoff = agent_obj.getConfig().getConnectBackoff()
+        self._backoff = backoff
 
         # The agent we are going to connect to
         self.info = agent_info
@@ -143,12 +265,28 @@ class ConnectJob(job.Job):
         if isinstance(evt, agent.MessageReceivedEvent):
             if isinstance(evt.getMessage(), agent.OkResponse) and \
                self.key == evt.getMessage().getRequestKey():
+                msg = evt.getMessage()
+                if isinstance(msg, ConnectResponse) and \
+                   msg.getCompression() is not None:
+                    config = self.getAgent().getConfig()
+                    evt.getSource().setCompression(msg.getCompression(),
+                                            config.getCompressThreshold())
                 evt = ConnectCompleteEvent(self, evt.getSource())
                 self.getAgent().addEvent(evt)
 
                 # we have successfully connect, stop retrying
                 self._timer.stop()
                 self._timer = None
+                self.getAgent().releaseConnectSlot(self)
+            elif isinstance(evt.getMessage(), agent.BusyResponse) and \
+               self.key == evt.getMessage().getRequestKey():
+                # The other side is too busy for us, back off and try again
+                log.info("Connect to %s refused, agent busy" 
+                         % self.info.getName())
+                self.key = None
+                self._abandon()
+                self._timer.stop()
+                self._set_retry_timer()
             elif isinstance(evt.getMessage(), agent.DeniedResponse) and \
                self.key == evt.getMessage().getRequestKey():
                 log.warning("Connect to %s failed, request denied" 
@@ -156,6 +294,7 @@ class ConnectJob(job.Job):
 
         elif isinstance(evt, ConnectRetryEvent) and evt.getSource() == self:
             log.info("Attempting to reconnect to remote agent")
+            self._abandon()
             self._retries += 1
             self._connect()
 
@@ -169,38 +308,68 @@ class ConnectJob(job.Job):
         return self._connection
     
     def _set_retry_timer(self):
-        self._timer = ConnectRetryTimer(self)
+        delay = self._backoff.getDelay(self._retries)
+        self._timer = ConnectRetryTimer(self, delay)
         self.getAgent().addTimer(self._timer)
 
+    def _abandon(self):
+        """Give up on the connection of the previous attempt, which has
+        not been answered in time. The retry timer is the deadline of
+        each attempt, including a connect that is still in progress."""
+        self.getAgent().releaseConnectSlot(self)
+        conn = self._connection
+        self._connection = None
+        if conn is None:
+            return
+        if conn.isConnecting():
+            log.info("Connect to %s timed out" % self.info.getName())
+        conn.disconnect()
+        if conn in self.getAgent().getConnections():
+            self.getAgent().dropConnection(conn)
+
     def _connect(self):
-        # Create connection to remote agent
+        # Create connection to remote agent. The connect completes in the
+        # background, our ConnectRequest is sent once it has.
         if self._max_retries == -1 or self._max_retries >= self._retries:
+            if not self.getAgent().acquireConnectSlot(self, 
+                                        job.RunJobEvent(self, self)):
+                log.debug("Waiting for a connect slot")
+                return
             connection = agent.AgentConnection(self.info)
             connection.connect()
             if connection.isConnected():
                 self.getAgent().addConnection(connection)
                 self._connection = connection
 
-                # Send Connect Request
-                msg = ConnectRequest(self.getAgent().getInfo())
+                # Send Connect Request, offering the compression we know
+                codecs = []
+                if self.getAgent().getConfig().getCompression() is not None:
+                    codecs.append(self.getAgent().getConfig().getCompression())
+                msg = ConnectRequest(self.getAgent().getInfo(), codecs)
                 self.key = msg.getKey()
                 evt = agent.MessageSendEvent(self, msg, connection)
                 self.getAgent().addEvent(evt)
+            else:
+                self.getAgent().releaseConnectSlot(self)
 
             self._set_retry_timer()
         else:
             # This job is complete
+            self.getAgent().releaseConnectSlot(self)
             self.getAgent().dropListener(self)
             self.getAgent().addEvent(ConnectFailedEvent(self))
 
             
-class StatusRequest(message.Request): pass
+class StatusRequest(message.Request):
+    __slots__ = ()
 
 class StatusResponse(message.Response):
+    __slots__ = ('status_details', 'state', 'stats')
     def __init__(self, key = None):
         message.Response.__init__(self, key)
         self.status_details = ""
         self.state = None
+        self.stats = None
 
     def getStatusDetails(self):
         return self.status_details
@@ -212,6 +381,39 @@ class StatusResponse(message.Response):
     def setState(self, new_state):
         self.state = new_state
 
+    def getStats(self):
+        """Return the agent's statistics snapshot (see stats.AgentStats),
+        or None if the agent is not collecting statistics"""
+        return self.stats
+    def setStats(self, stats):
+        self.stats = stats
+
+class StateNotice(message.Message):
+    """Sent by a sub-agent to its director whenever its state changes"""
+    __slots__ = ('state',)
+    def __init__(self, state = None):
+        message.Message.__init__(self)
+        self.state = state
+    def getState(self):
+        return self.state
+
+class ReportStateJob(job.Job):
+    """Tells the agent on the other end of a ConnectJob's connection about
+    every change in our state"""
+    def __init__(self, agent_obj, connect_job):
+        job.Job.__init__(self, agent_obj)
+        self.connect_job = connect_job
+
+    def notify(self, evt):
+        job.Job.notify(self, evt)
+        if isinstance(evt, agent.StateChangeEvent) and \
+           evt.getSource() is self.getAgent() and \
+           evt.getOldState() is not evt.getNewState():
+            conn = self.connect_job.getConnection()
+            if conn is not None and conn.isConnected():
+                self.getAgent().addEvent(agent.MessageSendEvent(self, 
+                                     StateNotice(evt.getNewState()), conn))
+
 class HandleStatusJob(job.Job):
     def notify(self, evt):
         job.Job.notify(self, evt)
@@ -219,11 +421,14 @@ class HandleStatusJob(job.Job):
             if isinstance(evt.getMessage(), StatusRequest):
                 key = evt.getMessage().getKey()
                 if evt.getSource().isAuthorized(evt.getMessage()):
-                    resp = self.getAgent().getStatusResponse(key)
+                    resp, encoded = \
+                          self.getAgent().getEncodedStatusResponse(key)
                 else:
-                    resp = agent.DeniedResponse(key)
+                    resp, encoded = agent.DeniedResponse(key), None
 
                 msg = agent.MessageSendEvent(self, resp, evt.getSource())
+                if encoded is not None:
+                    msg.setEncodedMessage(encoded)
                 self.getAgent().addEvent(msg)
 
 
@@ -272,7 +477,15 @@ class SimpleAgent(agent.Agent):
         by sub-classes for custom responses"""
         resp = StatusResponse(key)
         resp.setState(self.getState())
+        if self.getStats() is not None:
+            resp.setStats(self.getStats().getSnapshot(self))
         return resp
+
+    def getEncodedStatusResponse(self, key):
+        """Return a tuple of the status response and its encoded form, or
+        None if the response has not already been encoded. Sub-classes
+        whose responses are expensive to build may cache them here."""
+        return (self.getStatusResponse(key), None)
     
     def handleMessageSendEvent(self, evt):
         agent.Agent.handleMessageSendEvent(self, evt)
@@ -291,13 +504,16 @@ class SimpleAgent(agent.Agent):
                 self.addListener(jb)
                 self.addEvent(job.RunJobEvent(self, jb))
             else:
-                log.debug("Writing message %s" % (str(evt.getMessage())))
-                conn.write(str(evt.getMessage()))
+                trc.trace("Writing message", message=evt.getMessage())
+                self.writeMessage(conn, evt.getEncodedMessage())
+
+    # Our own copy of the handler table. Changing the table in Agent would
+    # change the handlers for every agent running in this process.
+    _handlers = agent.Agent._handlers.copy()
+    _handlers[agent.MessageSendEvent] = handleMessageSendEvent
 
     def getHandlers(self):
-        handlers = agent.Agent.getHandlers(self)
-        handlers[agent.MessageSendEvent] = SimpleAgent.handleMessageSendEvent
-        return handlers
+        return SimpleAgent._handlers
 
 class SubAgentConfig(agent.AgentConfig):
     """SubAgents have the special need of connecting to a director agent.
@@ -324,7 +540,9 @@ class SubAgent(SimpleAgent):
         # We need a job to connect to our director agent.
         self._dir_connect_job = ConnectJob(self, 
                                   self.getConfig().getDirectorInfo(), -1)
-        return SimpleAgent.getInitJobs(self) + [self._dir_connect_job]
+        return SimpleAgent.getInitJobs(self) + \
+               [self._dir_connect_job,
+                ReportStateJob(self, self._dir_connect_job)]
 
     def getInitEvents(self):
         # We want to connect to our director agent as soon as this agent starts
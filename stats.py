@@ -0,0 +1,229 @@
+# JoeAgent - A Multi-Agent Distributed Application Framework
+# Copyright (C) 2004 Rhett Garber
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""
+Runtime instrumentation for agents.
+
+An agent only collects statistics once Agent.enableStats() has been
+called (or the AgentConfig asks for it). Until then the agent holds no
+AgentStats object and the event loop skips all the timing calls, so
+instrumentation costs nothing when it is not wanted.
+
+The snapshot produced by AgentStats.getSnapshot() is built entirely out of
+dictionaries, lists and numbers so it can be carried in a StatusResponse.
+"""
+
+import time
+import event
+
+class Histogram:
+    """Collection of timing samples (in seconds). Samples are counted in
+    power-of-two microsecond buckets so percentiles can be estimated without
+    keeping every sample around."""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        bucket = int(value * 1000000).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def getCount(self):
+        return self.count
+    def getTotal(self):
+        return self.total
+    def getMax(self):
+        return self.max
+    def getMean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def getPercentile(self, percent):
+        """Return the upper bound (in seconds) of the bucket which holds
+        the given percentile (0 - 100) of the samples"""
+        if self.count == 0:
+            return 0.0
+        wanted = self.count * percent / 100.0
+        seen = 0
+        buckets = self.buckets.keys()
+        buckets.sort()
+        for b in buckets:
+            seen += self.buckets[b]
+            if seen >= wanted:
+                return min((1 << b) / 1000000.0, self.max)
+        return self.max
+
+    def merge(self, hist):
+        """Add the samples of another histogram to this one"""
+        self.count += hist.count
+        self.total += hist.total
+        if hist.max > self.max:
+            self.max = hist.max
+        for b, count in hist.buckets.items():
+            self.buckets[b] = self.buckets.get(b, 0) + count
+
+    def getSnapshot(self):
+        return {'count': self.count,
+                'total': self.total,
+                'mean':  self.getMean(),
+                'max':   self.max,
+                'p50':   self.getPercentile(50),
+                'p99':   self.getPercentile(99)}
+
+class AgentStats:
+    """Statistics collected by a single agent. Events and listeners are
+    grouped by class name."""
+    def __init__(self):
+        self.start_time = time.time()
+        self.events = {}
+        self.listeners = {}
+        self.queue_wait = Histogram()
+        self.queue_age = Histogram()
+        self.accept_latency = Histogram()
+        self.ticks = 0
+        self.io_ready = 0
+        self.io_handled = 0
+        self.events_handled = 0
+        self.max_backlog = 0
+        self.loops = 0
+        self.select_time = 0.0
+        self.busy_time = 0.0
+
+    def _getHistogram(self, table, obj):
+        name = obj.__class__.__name__
+        hist = table.get(name)
+        if hist is None:
+            hist = table[name] = Histogram()
+        return hist
+
+    def recordEvent(self, evt, elapsed):
+        """Record the time it took for all listeners to handle an event"""
+        self._getHistogram(self.events, evt).record(elapsed)
+
+    def recordListener(self, listener, elapsed):
+        """Record the time a single listener spent in notify()"""
+        self._getHistogram(self.listeners, listener).record(elapsed)
+
+    def recordQueueWait(self, elapsed):
+        """Record how long an event sat in the event queue"""
+        self.queue_wait.record(elapsed)
+
+    def recordQueueAge(self, age):
+        """Record the age of the oldest queued event at the start of a
+        pass through the scheduler"""
+        self.queue_age.record(age)
+
+    def recordAccept(self, latency):
+        """Record the time from accepting a connection to adding it to
+        the agent"""
+        self.accept_latency.record(latency)
+
+    def recordTick(self, ready, handled, events, backlog):
+        """Record the work done in one pass through the scheduler: the
+        number of ready connections, how many of those were handled within
+        the I/O budget, the events processed and the events left queued"""
+        self.ticks += 1
+        self.io_ready += ready
+        self.io_handled += handled
+        self.events_handled += events
+        if backlog > self.max_backlog:
+            self.max_backlog = backlog
+
+    def recordLoop(self, select_time, busy_time):
+        """Record one pass through the agent's run loop. select_time is the
+        time spent waiting in select, busy_time is everything else"""
+        self.loops += 1
+        self.select_time += select_time
+        self.busy_time += busy_time
+
+    def getEventHistogram(self, name):
+        return self.events.get(name)
+    def getListenerHistogram(self, name):
+        return self.listeners.get(name)
+    def getQueueWait(self):
+        return self.queue_wait
+    def getQueueAge(self):
+        return self.queue_age
+    def getAcceptLatency(self):
+        return self.accept_latency
+
+    def getSnapshot(self, agnt = None):
+        """Return the collected statistics as a dictionary. If an agent is
+        provided, byte counts for each of its connections are included"""
+        snap = {'uptime':      time.time() - self.start_time,
+                'loops':       self.loops,
+                'select_time': self.select_time,
+                'busy_time':   self.busy_time,
+                'queue_wait':  self.queue_wait.getSnapshot(),
+                'queue_age':   self.queue_age.getSnapshot(),
+                'scheduler':   {'ticks':       self.ticks,
+                                'io_ready':    self.io_ready,
+                                'io_handled':  self.io_handled,
+                                'io_deferred': self.io_ready - self.io_handled,
+                                'events':      self.events_handled,
+                                'max_backlog': self.max_backlog},
+                'events':      {},
+                'listeners':   {}}
+        for name, hist in self.events.items():
+            snap['events'][name] = hist.getSnapshot()
+        for name, hist in self.listeners.items():
+            snap['listeners'][name] = hist.getSnapshot()
+
+        if agnt is not None:
+            conns = []
+            for c in agnt.getConnections():
+                conns.append({'name':      c.getName(),
+                              'class':     c.__class__.__name__,
+                              'bytes_in':  c.getBytesIn(),
+                              'bytes_out': c.getBytesOut(),
+                              'pending':   c.getPendingBytes(),
+                              'refused':   c.getRefusedCount(),
+                              'compressed': c.getCompressedBytes()})
+            snap['connections'] = conns
+            snap['queue_length'] = len(agnt.event_queue)
+            snap['shed'] = agnt.getShedCount()
+            accepted, rejected = agnt.getAcceptCounts()
+            reaped, evicted = agnt.getReapCounts()
+            snap['accept'] = {'accepted': accepted,
+                              'rejected': rejected,
+                              'reaped':   reaped,
+                              'evicted':  evicted,
+                              'latency':  self.accept_latency.getSnapshot()}
+        return snap
+
+class TimedEventQueue(event.EventQueue):
+    """EventQueue which remembers when each event was pushed so the time
+    spent waiting in the queue can be recorded when it is popped"""
+    def __init__(self, stats):
+        event.EventQueue.__init__(self)
+        self.stats = stats
+    def push(self, evt):
+        self._events.append((time.time(), evt))
+    def pop(self):
+        queued, evt = self._events.pop(0)
+        self.stats.recordQueueWait(time.time() - queued)
+        return evt
+    def getOldestAge(self):
+        """Seconds the event at the head of the queue has been waiting"""
+        return time.time() - self._events[0][0]
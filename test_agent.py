@@ -17,11 +17,20 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import unittest
+import unittest, socket, threading, time
+from select import select
 from test import test_support
 from agent import *
+from event import EventListener
 import StringIO
 
+class RecordingListener(EventListener):
+    def __init__(self):
+        EventListener.__init__(self)
+        self.events = []
+    def notify(self, evt):
+        self.events.append(evt.__class__)
+
 class InstantiateTestCase(unittest.TestCase):
     # Only use setUp() and tearDown() if necessary
 
@@ -65,8 +74,720 @@ class InstantiateTestCase(unittest.TestCase):
         obj = ServerConnection()
         obj = Agent(AgentConfig())
 
+class EncodedMessageTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Test messages are only serialized once when sent"
+
+    def test_feature_one(self):
+        msg = PingRequest()
+        evt = MessageSendEvent(self, msg, None)
+        encoded = evt.getEncodedMessage()
+        assert encoded == str(msg)
+
+        # Changes after the first encode are not picked up
+        msg.key = "changed"
+        assert evt.getEncodedMessage() is encoded
+
+    def test_template(self):
+        template = MessageTemplate(ShutdownRequest())
+        # Keys are only unique while the copies are alive, just like the
+        # keys of any other Request
+        keys = {}
+        for ndx in range(0, 5):
+            msg, encoded = template.create()
+            assert not keys.has_key(msg.getKey())
+            keys[msg.getKey()] = msg
+
+            assert encoded == str(msg), "%s != %s" % (encoded, str(msg))
+            obj = xobject.load_object_from_file(StringIO.StringIO(encoded))
+            assert isinstance(obj, ShutdownRequest)
+            assert obj.getKey() == msg.getKey()
+
+        msg, encoded = MessageTemplate(OkResponse("abc")).create("1234")
+        assert msg.getRequestKey() == "1234"
+        assert encoded == str(msg)
+
+        # The key must appear just once to know which copy to patch
+        msg = EchoRequest()
+        msg.echo = PingRequest()
+        msg.key = msg.echo.getKey()
+        self.assertRaises(ValueError, MessageTemplate, msg)
+
+class EchoRequest(Request):
+    pass
+
+class StalledSocket:
+    """Socket whose peer only accepts as much data as we let it"""
+    def __init__(self):
+        self.space = 0
+    def send(self, data):
+        sent = min(len(data), self.space)
+        self.space -= sent
+        return sent
+    def close(self):
+        pass
+
+class IODispatchTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Readiness events only reach I/O listeners"
+
+    def test_feature_one(self):
+        agnt = Agent(AgentConfig())
+        listener = RecordingListener()
+        io_listener = RecordingListener()
+        agnt.addListener(listener)
+        agnt.addIOListener(io_listener)
+
+        sock, other = socket.socketpair()
+        conn = AgentConnection(None, sock)
+        agnt.addConnection(conn)
+        other.sendall(str(PingRequest()))
+
+        agnt.dispatch([conn], [], [])
+        while agnt.event_queue.hasEvents():
+            agnt.processEvent()
+
+        assert ConnectionReadEvent not in listener.events
+        assert MessageReceivedEvent in listener.events
+        assert io_listener.events == [ConnectionReadEvent]
+
+        conn.disconnect()
+        other.close()
+
+    def test_invalid(self):
+        agnt = Agent(AgentConfig())
+        for data in ['<array type="d">abc</array>',
+                     '<array type="l">AAAA</array>',
+                     '<blob>a</blob>']:
+            sock, other = socket.socketpair()
+            conn = AgentConnection(None, sock)
+            agnt.addConnection(conn)
+            other.sendall(data)
+
+            # The peer goes, the agent carries on
+            agnt.dispatch([conn], [], [])
+            assert not conn.isConnected()
+            other.close()
+
+class SchedulerTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Events and I/O share each pass within their budgets"
+
+    def test_feature_one(self):
+        config = AgentConfig()
+        config.setMaxEventsPerTick(5)
+        config.setMaxIOPerTick(1)
+        agnt = Agent(config)
+        agnt.enableStats()
+        while agnt.event_queue.hasEvents():
+            agnt.processEvent()
+
+        pairs = [socket.socketpair() for ndx in range(0, 2)]
+        conns = []
+        for sock, other in pairs:
+            conns.append(AgentConnection(None, sock))
+            agnt.addConnection(conns[-1])
+            other.sendall(str(PingRequest()))
+        for ndx in range(0, 20):
+            agnt.addEvent(StateChangeEvent(agnt, RUNNING, RUNNING))
+
+        # Busy connections do not stop queued events being processed,
+        # and only one of them is read from
+        agnt.dispatch(conns, [], [])
+        assert len(agnt.event_queue) == 16
+        snap = agnt.getStats().getSnapshot()
+        assert snap['scheduler']['io_deferred'] == 1
+        assert snap['queue_age']['count'] == 1
+
+        # The other connection gets its turn next
+        agnt.dispatch(conns, [], [])
+        assert len(agnt.event_queue) == 12
+        assert agnt.getStats().getSnapshot()['scheduler']['io_handled'] == 2
+
+        for sock, other in pairs:
+            sock.close()
+            other.close()
+
+class FlowControlTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Overloaded agents shed requests, slow peers pause requests"
+
+    def test_shed(self):
+        config = AgentConfig()
+        config.setQueueWatermarks(3, 1)
+        config.setMaxEventsPerTick(0)
+        agnt = Agent(config)
+        for ndx in range(0, 3):
+            agnt.addEvent(StateChangeEvent(agnt, RUNNING, RUNNING))
+
+        sock, other = socket.socketpair()
+        conn = AgentConnection(None, sock)
+        agnt.addConnection(conn)
+        request = PingRequest()
+        other.sendall(str(request))
+        agnt.dispatch([conn], [], [])
+
+        assert agnt.getShedCount() == 1
+        resp = xobject.load_object_from_file(
+                                StringIO.StringIO(other.recv(4096)))
+        assert isinstance(resp, BusyResponse)
+        assert resp.getRequestKey() == request.getKey()
+
+        # Accepting requests again once the queue has drained
+        while agnt.event_queue.hasEvents():
+            agnt.processEvent()
+        other.sendall(str(PingRequest()))
+        agnt.dispatch([conn], [], [])
+        assert agnt.getShedCount() == 1
+        assert len(agnt.event_queue) == 1
+
+        sock.close()
+        other.close()
+
+    def test_send_window(self):
+        sock = StalledSocket()
+        conn = AgentConnection(None, sock)
+        conn.setSendLimits(100, 50, 10)
+        conn.write("x" * 60)
+        assert conn.isPaused()
+
+        conn.write("y" * 50)
+        assert conn.getRefusedCount() == 1
+        assert conn.getPendingBytes() == 60
+
+        # Requests are taken again once the peer has taken enough of the
+        # data
+        sock.space = 40
+        conn.write()
+        assert conn.isPaused()
+        sock.space = 10
+        conn.write()
+        assert not conn.isPaused()
+
+    def test_hold_requests(self):
+        agnt = Agent(AgentConfig())
+        while agnt.event_queue.hasEvents():
+            agnt.processEvent()
+        sock, other = socket.socketpair()
+        conn = AgentConnection(None, sock)
+        agnt.addConnection(conn)
+        conn.setSendLimits(1000, 0, -1)
+        assert conn.isPaused()
+
+        listener = RecordingListener()
+        agnt.addListener(listener)
+
+        # Replies still arrive while new requests wait, so two peers
+        # waiting on each other keep reading
+        request = PingRequest()
+        other.sendall(str(request) + str(OkResponse("1")))
+        assert conn.isReadPending()
+        agnt.dispatch([conn], [], [])
+        assert listener.events.count(MessageReceivedEvent) == 1
+        assert not conn.isWritePending()
+
+        conn.setSendLimits(1000, 500, 100)
+        assert conn.isWritePending()
+        agnt.dispatch([], [conn], [])
+        assert listener.events.count(MessageReceivedEvent) == 2
+        assert not conn.isWritePending()
+
+        conn.disconnect()
+        other.close()
+
+    def test_refused_request(self):
+        agnt = Agent(AgentConfig())
+        while agnt.event_queue.hasEvents():
+            agnt.processEvent()
+        conn = AgentConnection(None, StalledSocket())
+        conn.setSendLimits(100, 50, 10)
+        conn.write("x" * 60)
+
+        # The sender hears straight away that its request did not go
+        request = PingRequest()
+        agnt.addEvent(MessageSendEvent(agnt, request, conn))
+        agnt.processEvent()
+        assert conn.getRefusedCount() == 1
+        assert conn.getPendingBytes() == 60
+        evt = agnt.event_queue.pop()
+        assert isinstance(evt, MessageReceivedEvent)
+        assert evt.getSource() is conn
+        assert isinstance(evt.getMessage(), BusyResponse)
+        assert evt.getMessage().getRequestKey() == request.getKey()
+
+    def test_send_window_batch(self):
+        sock = StalledSocket()
+        conn = AgentConnection(None, sock)
+        conn.setSendLimits(1000, 800, 10)
+        conn.write("x" * 900)
+
+        # A batch which does not fit waits for the window to open
+        first, second = str(OkResponse("1")), str(OkResponse("2"))
+        conn.addMessage(first)
+        conn.addMessage(second)
+        conn.flush()
+        assert conn.getRefusedCount() == 0
+        assert conn.getPendingBytes() == 900
+        assert conn.hasBatch() and conn.isWritePending()
+
+        sock.space = 900
+        conn.write()
+        assert conn.getPendingBytes() == 0 and conn.isWritePending()
+        conn.write()
+        assert not conn.hasBatch()
+        assert conn.getPendingBytes() == len(encode_batch([first, second]))
+
+        # Messages are refused one by one once a window's worth is held
+        for ndx in range(0, 3):
+            conn.addMessage("y" * 400)
+        conn.flush()
+        assert conn.getRefusedCount() == 3
+        assert not conn.hasBatch()
+
+class BatchTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Messages are coalesced into batches and unpacked on read"
+
+    def test_feature_one(self):
+        agnt = Agent(AgentConfig())
+        sock, other = socket.socketpair()
+        conn = AgentConnection(None, sock)
+        receiver = AgentConnection(None, other)
+
+        requests = [PingRequest() for ndx in range(0, 3)]
+        for msg in requests:
+            agnt.writeMessage(conn, str(msg))
+        assert conn.hasBatch()
+        agnt.flushConnections()
+        assert not conn.hasBatch()
+
+        events = receiver.readEvents()
+        keys = [evt.getMessage().getKey() for evt in events]
+        assert keys == [msg.getKey() for msg in requests]
+
+        sock.close()
+        other.close()
+
+    def test_stream(self):
+        sock, other = socket.socketpair()
+        receiver = AgentConnection(None, other)
+
+        # Two messages in one read, then one split over two reads
+        first = str(PingRequest())
+        second = str(OkResponse("2"))
+        third = str(DeniedResponse("3"))
+        sock.sendall(first + second + third[:20])
+        events = receiver.readEvents()
+        assert [evt.getMessage().__class__ for evt in events] == \
+               [PingRequest, OkResponse]
+        sock.sendall(third[20:])
+        events = receiver.readEvents()
+        assert len(events) == 1
+        assert events[0].getMessage().getRequestKey() == "3"
+
+        sock.close()
+        other.close()
+
+class CompressionTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Large writes are sent in compressed frames"
+
+    def test_feature_one(self):
+        sock, other = socket.socketpair()
+        sender = AgentConnection(None, sock)
+        sender.setCompression("zlib", 200)
+
+        big = PingRequest()
+        big.key = "abc" * 200
+        small = OkResponse("1")
+        sender.write(str(big))
+        sender.write(str(small))
+        sender.write(str(big))
+        raw, compressed = sender.getCompressedBytes()
+        assert raw == 2 * len(str(big))
+        assert compressed < raw / 10
+        data = other.recv(65536)
+
+        # Deliver the frames a few bytes at a time
+        sock.close()
+        sock, other = socket.socketpair()
+        receiver = AgentConnection(None, other)
+        events = []
+        for ndx in range(0, len(data), 7):
+            sock.sendall(data[ndx:ndx + 7])
+            events.extend(receiver.readEvents())
+        assert [evt.getMessage().__class__ for evt in events] == \
+               [PingRequest, OkResponse, PingRequest]
+        assert events[2].getMessage().getKey() == big.getKey()
+
+        sock.close()
+        other.close()
+
+class BlobMessage(Message):
+    __slots__ = ('data', 'parts')
+
+class BlobTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Blobs travel in frames of their own, beside the message"
+
+    def test_feature_one(self):
+        agnt = Agent(AgentConfig())
+        sock, other = socket.socketpair()
+        sender = AgentConnection(None, sock)
+        sender.setCompression("zlib", 200)
+
+        msg = BlobMessage()
+        msg.data = bytearray("\x00<blob>&" * 5000)
+        msg.parts = [memoryview("part"), "<str>"]
+        encoded = encode_message(msg)
+        assert len(encoded) < len(msg.data) + 300
+        ping = PingRequest()
+        agnt.writeMessage(sender, str(ping))
+        agnt.writeMessage(sender, encoded)
+        agnt.writeMessage(sender, str(ping))
+        agnt.flushConnections()
+        data = other.recv(len(encoded) * 2)
+
+        # Deliver the frames in pieces
+        sock.close()
+        sock, other = socket.socketpair()
+        receiver = AgentConnection(None, other)
+        events = []
+        for ndx in range(0, len(data), 1000):
+            sock.sendall(data[ndx:ndx + 1000])
+            events.extend(receiver.readEvents())
+        received = [evt.getMessage() for evt in events]
+        assert [m.__class__ for m in received] == \
+               [PingRequest, BlobMessage, PingRequest]
+        blob_msg = received[1]
+        assert isinstance(blob_msg.data, memoryview)
+        assert blob_msg.data.tobytes() == str(msg.data)
+        assert blob_msg.parts[0].tobytes() == "part"
+        assert blob_msg.parts[1] == "<str>"
+        assert receiver.blobs == []
+
+        sock.close()
+        other.close()
+
+    def test_compressed(self):
+        sock, other = socket.socketpair()
+        sender = AgentConnection(None, sock)
+        sender.setCompression("zlib", 200)
+
+        # The XML after the blob frames is compressed, the blob is not
+        msg = BlobMessage()
+        msg.data = memoryview("blob" * 100)
+        msg.parts = ["abc" * 500]
+        encoded = encode_message(msg)
+        sender.write(encoded)
+        raw, compressed = sender.getCompressedBytes()
+        xml = encoded[sender._skipFrames(encoded):]
+        assert raw == len(xml) and compressed < raw / 10
+        data = other.recv(65536)
+        assert data.find("blob" * 100) >= 0
+
+        receiver = AgentConnection(None, other)
+        sock.sendall(data)
+        events = receiver.readEvents()
+        assert len(events) == 1
+        assert events[0].getMessage().data.tobytes() == "blob" * 100
+        assert events[0].getMessage().parts == ["abc" * 500]
+
+        sock.close()
+        other.close()
+
+class ConnectTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Connects complete in the background, writes wait for them"
+
+    def make_info(self, port):
+        info = AgentInfo()
+        info.setName("Remote")
+        info.setHost("127.0.0.1")
+        info.setPort(port)
+        return info
+
+    def test_feature_one(self):
+        srv_sock = create_server_socket("127.0.0.1", 0)
+        conn = AgentConnection(self.make_info(srv_sock.getsockname()[1]))
+        conn.connect()
+        assert conn.isConnected()
+        request = PingRequest()
+        conn.write(str(request))
+        while conn.isConnecting():
+            select([], [conn], [], 1.0)
+            conn.write()
+        assert not conn.isWritePending()
+
+        new_sock, addr = srv_sock.accept()
+        resp = xobject.load_object_from_file(
+                                StringIO.StringIO(new_sock.recv(4096)))
+        assert resp.getKey() == request.getKey()
+        new_sock.close()
+        srv_sock.close()
+        conn.disconnect()
+
+    def test_write_connects(self):
+        srv_sock = create_server_socket("127.0.0.1", 0)
+        conn = AgentConnection(self.make_info(srv_sock.getsockname()[1]))
+        request = PingRequest()
+        conn.write(str(request))
+        assert conn.isConnected()
+        while conn.isWritePending():
+            select([], [conn], [], 1.0)
+            conn.write()
+
+        # The message which made us connect is not lost
+        new_sock, addr = srv_sock.accept()
+        resp = xobject.load_object_from_file(
+                                StringIO.StringIO(new_sock.recv(4096)))
+        assert resp.getKey() == request.getKey()
+        new_sock.close()
+        srv_sock.close()
+        conn.disconnect()
+
+    def test_high_fd(self):
+        import resource, time
+        if resource.getrlimit(resource.RLIMIT_NOFILE)[0] <= 1100:
+            return
+        srv_sock = create_server_socket("127.0.0.1", 0)
+        conn = AgentConnection(self.make_info(srv_sock.getsockname()[1]))
+        conn.connect()
+
+        # Move the socket above FD_SETSIZE, where select() cannot go
+        spare = [os.dup(srv_sock.fileno())]
+        while spare[-1] < 1100:
+            spare.append(os.dup(srv_sock.fileno()))
+        sock = socket.fromfd(conn.sock.fileno(), socket.AF_INET,
+                             socket.SOCK_STREAM)
+        map(os.close, spare)
+        conn.sock.close()
+        conn.sock = sock
+        assert conn.fileno() > 1100
+        conn.write(str(PingRequest()))
+        for ndx in range(0, 100):
+            if not conn.isWritePending():
+                break
+            time.sleep(0.01)
+            conn.write()
+        assert conn.isConnected() and not conn.isWritePending()
+        srv_sock.close()
+        conn.disconnect()
+
+    def test_refused(self):
+        srv_sock = create_server_socket("127.0.0.1", 0)
+        port = srv_sock.getsockname()[1]
+        srv_sock.close()
+
+        conn = AgentConnection(self.make_info(port))
+        conn.connect()
+        if conn.isConnected():
+            assert conn.isWritePending() and not conn.isReadPending()
+            select([], [conn], [], 1.0)
+            conn.write()
+        assert not conn.isConnected()
+
+    def test_no_socket(self):
+        def out_of_files(*args):
+            raise socket.error(errno.EMFILE, os.strerror(errno.EMFILE))
+        create = socket.socket
+        socket.socket = out_of_files
+        try:
+            conn = AgentConnection(self.make_info(1))
+            conn.connect()
+        finally:
+            socket.socket = create
+        assert not conn.isConnected()
+
+class ParserPoolTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Connections only hold a parser while a message arrives"
+
+    def test_feature_one(self):
+        sock, other = socket.socketpair()
+        conn = AgentConnection(None, sock)
+        assert conn.parser is None
+
+        encoded = str(PingRequest())
+        other.sendall(encoded[:20])
+        assert conn.readEvents() == []
+        assert conn.parser is not None
+        other.sendall(encoded[20:] + encoded)
+        assert len(conn.readEvents()) == 2
+        assert conn.parser is None
+
+        # The parser is reused by the next connection to need one
+        created = parsers.getCreatedCount()
+        second, third = socket.socketpair()
+        conn2 = AgentConnection(None, second)
+        third.sendall(encoded)
+        assert len(conn2.readEvents()) == 1
+        assert parsers.getCreatedCount() == created
+        for s in (sock, other, second, third):
+            s.close()
+
+class AcceptTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Waiting connections are accepted in batches, within limits"
+
+    def test_feature_one(self):
+        config = AgentConfig()
+        config.setBindAddress("127.0.0.1")
+        config.setPort(0)
+        config.setAcceptBatch(3)
+        config.setMaxConnections(5)
+        config.setEvictConnections(False)
+        config.setCollectStats(True)
+        agnt = Agent(config)
+        server = agnt.getConnections()[0]
+        port = server.getSocket().getsockname()[1]
+
+        clients = []
+        for n in range(6):
+            clients.append(socket.create_connection(("127.0.0.1", port)))
+
+        # One pass accepts a batch, the rest wait for the next
+        agnt.dispatch([server], [], [])
+        assert agnt.getAcceptCounts() == (3, 0)
+        agnt.dispatch([server], [], [])
+        # The server itself counts against the limit
+        assert agnt.getAcceptCounts() == (4, 2)
+        agnt.dispatch([server], [], [])
+        assert len(agnt.getConnections()) == 5
+
+        snap = agnt.getStats().getSnapshot(agnt)
+        assert snap['accept']['latency']['count'] == 4
+        for c in clients:
+            c.close()
+        for c in agnt.getConnections():
+            c.disconnect()
+
+    def test_evict(self):
+        config = AgentConfig()
+        config.setBindAddress("127.0.0.1")
+        config.setPort(0)
+        config.setMaxConnections(3)
+        agnt = Agent(config)
+        server = agnt.getConnections()[0]
+        port = server.getSocket().getsockname()[1]
+
+        clients = [socket.create_connection(("127.0.0.1", port))]
+        agnt.dispatch([server], [], [])
+        clients.append(socket.create_connection(("127.0.0.1", port)))
+        agnt.dispatch([server], [], [])
+        first, second = agnt.getConnections()[1:]
+        second.getAgentInfo = lambda: AgentInfo()
+        first.last_active -= 1.0
+
+        # The agent is full, a new connection replaces one which has not
+        # said who it is before the least recently used
+        clients.append(socket.create_connection(("127.0.0.1", port)))
+        agnt.dispatch([server], [], [])
+        assert agnt.getReapCounts() == (0, 1)
+        assert first not in agnt.getConnections()
+        assert second in agnt.getConnections()
+        assert len(agnt.getConnections()) == 3
+
+        # Idle connections and dead anonymous ones are reaped
+        config.setIdleTimeout("AgentConnection", 0.0)
+        agnt.reapConnections()
+        assert agnt.getConnections() == [server]
+        for c in clients:
+            c.close()
+        server.disconnect()
+
+    def test_evict_ready(self):
+        config = AgentConfig()
+        config.setBindAddress("127.0.0.1")
+        config.setPort(0)
+        config.setMaxConnections(2)
+        agnt = Agent(config)
+        server = agnt.getConnections()[0]
+        port = server.getSocket().getsockname()[1]
+
+        clients = [socket.create_connection(("127.0.0.1", port))]
+        agnt.dispatch([server], [], [])
+        victim = agnt.getConnections()[1]
+
+        # The victim is evicted by the accept in the same pass that it is
+        # ready to read in
+        clients[0].sendall(str(PingRequest()))
+        clients.append(socket.create_connection(("127.0.0.1", port)))
+        agnt.dispatch([server, victim], [], [])
+        assert agnt.getReapCounts() == (0, 1)
+        assert victim not in agnt.getConnections()
+        assert len(agnt.getConnections()) == 2
+        for c in clients:
+            c.close()
+        server.disconnect()
+
+class CleanupTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "A stopped agent sends what it holds before disconnecting"
+
+    def make_agent(self, size):
+        agnt = Agent(AgentConfig())
+        sock, other = socket.socketpair()
+        sock.setblocking(0)
+        conn = AgentConnection(None, sock)
+        agnt.addConnection(conn)
+        conn.write("x" * size)
+        assert conn.getPendingBytes() > 0
+        return agnt, conn, other
+
+    def test_feature_one(self):
+        size = 1024 * 1024
+        agnt, conn, other = self.make_agent(size)
+        received = []
+        def drain():
+            total = 0
+            while total < size:
+                data = other.recv(65536)
+                if data == "":
+                    break
+                total += len(data)
+            received.append(total)
+        reader = threading.Thread(target = drain)
+        reader.start()
+        agnt.cleanup()
+        reader.join()
+        assert received == [size]
+        assert not conn.isConnected()
+        other.close()
+
+    def test_timeout(self):
+        agnt, conn, other = self.make_agent(1024 * 1024)
+        agnt.getConfig().setCleanupTimeout(0.2)
+        start = time.time()
+        agnt.cleanup()
+        assert time.time() - start < 2.0
+        assert not conn.isConnected()
+        other.close()
+
 def test_main():
-    test_support.run_unittest(InstantiateTestCase)
+    test_support.run_unittest(InstantiateTestCase,
+                              ConnectTestCase,
+                              AcceptTestCase,
+                              ParserPoolTestCase,
+                              EncodedMessageTestCase,
+                              IODispatchTestCase,
+                              SchedulerTestCase,
+                              FlowControlTestCase,
+                              BatchTestCase,
+                              CompressionTestCase,
+                              BlobTestCase,
+                              CleanupTestCase)
 
 if __name__ == '__main__':
     test_main()
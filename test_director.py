@@ -0,0 +1,115 @@
+# JoeAgent - A Multi-Agent Distributed Application Framework
+# Copyright (C) 2004 Rhett Garber
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import unittest, socket, time
+from test import test_support
+from director import *
+from reactor import Reactor
+import agent, simple
+
+class DeafAgentConfig(simple.SubAgentConfig):
+    def getAgentClass(self):
+        return DeafAgent
+
+class DeafAgent(simple.SubAgent):
+    """Sub-agent which ignores shutdown requests"""
+    def getInitJobs(self):
+        return [j for j in simple.SubAgent.getInitJobs(self)
+                if not isinstance(j, simple.HandleShutdownJob)]
+
+class ShutdownTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Shutdown proceeds in phases and gives up on silent agents"
+
+    def run_until(self, reactor, test):
+        deadline = time.time() + 10.0
+        while not test() and time.time() < deadline:
+            reactor.runOnce(0.1)
+        assert test()
+
+    def test_feature_one(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        config = DirectorConfig()
+        config.setBindAddress("127.0.0.1")
+        config.setPort(port)
+        config.setShutdownConcurrency(1)
+        config.setShutdownTimeout(0.5)
+        config.setShutdownPhases([str(DeafAgent)])
+        dir_agent = Director(config)
+        reactor = Reactor()
+        reactor.addAgent(dir_agent)
+
+        subs = []
+        for name, config_class in [("Sub0", simple.SubAgentConfig),
+                                   ("Sub1", simple.SubAgentConfig),
+                                   ("Deaf", DeafAgentConfig)]:
+            sub_config = config_class()
+            sub_config.setName(name)
+            sub_config.setDirectorInfo(dir_agent.getInfo())
+            subs.append(sub_config.getAgentClass()(sub_config))
+            reactor.addAgent(subs[-1])
+        self.run_until(reactor, lambda: len(dir_agent.getMembership()) == 3)
+
+        dir_agent.shutdown()
+        progress = dir_agent.getShutdownProgress()
+        assert progress['total'] == 3
+        assert progress['in_flight'] == 1 and progress['queued'] == 2
+
+        # The deaf agent goes first, holding up the others until it times out
+        time.sleep(0.2)
+        reactor.runOnce(0.1)
+        assert subs[0].isRunning() and subs[1].isRunning()
+
+        self.run_until(reactor, lambda: not dir_agent.isRunning())
+        progress = dir_agent.getShutdownProgress()
+        assert progress['timeout'] == 1
+        assert progress['ok'] + progress['lost'] == 2
+        assert progress['in_flight'] == progress['queued'] == 0
+
+        subs[2].shutdown()
+        self.run_until(reactor, lambda: len(reactor.getAgents()) == 0)
+        for c in dir_agent.getConnections():
+            c.disconnect()
+
+class StatusTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Status responses do not share the membership's list"
+
+    def test_feature_one(self):
+        dir_agent = Director(DirectorConfig())
+        info = agent.AgentInfo()
+        info.setName("Sub0")
+        dir_agent.getMembership().join(info)
+
+        resp = dir_agent.getStatusResponse("1")
+        resp.addAgentInfo(agent.AgentInfo())
+        assert len(dir_agent.getMembership().getInfos()) == 1
+        resp.clearAgentInfoList()
+        assert dir_agent.getMembership().getInfos() == [info]
+
+def test_main():
+    test_support.run_unittest(ShutdownTestCase,
+                              StatusTestCase)
+
+if __name__ == '__main__':
+    test_main()
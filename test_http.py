@@ -0,0 +1,73 @@
+# JoeAgent - A Multi-Agent Distributed Application Framework
+# Copyright (C) 2004 Rhett Garber
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import unittest, socket, time
+from select import select
+from test import test_support
+from http import *
+from reactor import Reactor
+import agent, job
+
+class ReplyJob(job.Job):
+    """Answers every request with a short page"""
+    def notify(self, evt):
+        job.Job.notify(self, evt)
+        if isinstance(evt, HTTPRequestEvent):
+            resp = HTTPResponse(200, [Header('Content-type', 'text/plain')],
+                                "Hello")
+            self.getAgent().addEvent(
+                    HTTPResponseEvent(self, resp, evt.getSource()))
+
+class RoundTripTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "An HTTP request gets its reply written back"
+
+    def test_feature_one(self):
+        agnt = agent.Agent(agent.AgentConfig())
+        server = HTTPServerConnection(
+                        agent.create_server_socket("127.0.0.1", 0))
+        agnt.addConnection(server)
+        agnt.addListener(ReplyJob(agnt))
+        reactor = Reactor()
+        reactor.addAgent(agnt)
+
+        port = server.getSocket().getsockname()[1]
+        client = socket.create_connection(("127.0.0.1", port))
+        client.sendall("GET / HTTP/1.0\r\n\r\n")
+        reply = ""
+        deadline = time.time() + 10.0
+        while time.time() < deadline:
+            reactor.runOnce(0.1)
+            if select([client], [], [], 0)[0]:
+                data = client.recv(4096)
+                if data == "":
+                    break
+                reply += data
+        client.close()
+        assert reply.startswith("HTTP/"), reply
+        assert reply.find(" 200 ") > 0 and reply.endswith("Hello"), reply
+
+        agnt.shutdown()
+        for c in agnt.getConnections():
+            c.disconnect()
+
+def test_main():
+    test_support.run_unittest(RoundTripTestCase)
+
+if __name__ == '__main__':
+    test_main()
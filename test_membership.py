@@ -0,0 +1,272 @@
+# JoeAgent - A Multi-Agent Distributed Application Framework
+# Copyright (C) 2004 Rhett Garber
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import unittest, socket, time
+from test import test_support
+from membership import *
+from reactor import Reactor
+import agent, simple, director
+
+def make_info(name, host = "127.0.0.1", port = 9000):
+    info = agent.AgentInfo()
+    info.setName(name)
+    info.setHost(host)
+    info.setPort(port)
+    return info
+
+class MembershipTableTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Membership changes are versioned and replayed by views"
+
+    def test_feature_one(self):
+        table = MembershipTable()
+        view = MembershipView()
+        first = make_info("First")
+        second = make_info("Second")
+
+        assert table.join(first, agent.RUNNING).getVersion() == 1
+        view.load(table.getSnapshot("1"))
+        assert len(view.getMembers()) == 1
+
+        deltas = [table.join(second, agent.RUNNING),
+                  table.setState(first, agent.STOPPING),
+                  table.leave(second)]
+        assert table.setState(first, agent.STOPPING) is None
+        assert table.leave(second) is None
+        assert [d.getKind() for d in deltas] == [JOIN, STATE, LEAVE]
+
+        for delta in deltas:
+            assert view.apply(delta)
+        assert view.getVersion() == table.getVersion() == 4
+        assert view.getMember(second) is None
+        assert view.getMember(first).getState() is agent.STOPPING
+
+        # A missed delta means a new snapshot is needed
+        table.join(second)
+        assert not view.apply(table.leave(second))
+        assert not view.isLoaded()
+
+class QueryTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Members are found through the indexes and status is cached"
+
+    def test_feature_one(self):
+        table = MembershipTable()
+        first = make_info("Worker", "10.0.0.1")
+        second = make_info("Worker", "10.0.0.2")
+        third = make_info("Watcher", "10.0.0.1", 9001)
+        for info in (first, second, third):
+            table.join(info, agent.RUNNING)
+
+        assert len(table.query()) == 3
+        assert len(table.query(name = "Worker")) == 2
+        found = table.query(name = "Worker", host = "10.0.0.1")
+        assert [r.getInfo() for r in found] == [first]
+        assert table.query(name = "Nobody") == []
+        assert len(table.query(class_name = first.getClassName())) == 3
+
+        infos = table.getInfos()
+        assert table.getInfos() is infos
+        table.setState(first, agent.STOPPING)
+        assert table.getInfos() is infos
+        table.leave(first)
+        assert first not in table.getInfos()
+        assert table.query(host = "10.0.0.1", name = "Worker") == []
+
+    def test_status(self):
+        config = director.DirectorConfig()
+        config.setBindAddress("127.0.0.1")
+        config.setPort(0)
+        dir_agent = director.Director(config)
+        dir_agent.getMembership().join(make_info("Worker"), agent.RUNNING)
+
+        resp, encoded = dir_agent.getEncodedStatusResponse("100")
+        assert resp.getRequestKey() == "100"
+        assert len(resp.getAgentInfoList()) == 1
+        cached = dir_agent.getEncodedStatusResponse("200")[1]
+        assert cached == str(dir_agent.getStatusResponse("200"))
+
+        dir_agent.getMembership().join(make_info("Watcher"), agent.RUNNING)
+        resp, encoded = dir_agent.getEncodedStatusResponse("300")
+        assert len(resp.getAgentInfoList()) == 2
+        assert encoded.count("Watcher") == 1
+
+class SubscribeTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "A subscriber follows agents joining and leaving the director"
+
+    def run_until(self, reactor, test):
+        deadline = time.time() + 10.0
+        while not test() and time.time() < deadline:
+            reactor.runOnce(0.1)
+        assert test()
+
+    def test_feature_one(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        config = director.DirectorConfig()
+        config.setBindAddress("127.0.0.1")
+        config.setPort(port)
+        dir_agent = director.Director(config)
+        reactor = Reactor()
+        reactor.addAgent(dir_agent)
+
+        def start_sub(name):
+            sub_config = simple.SubAgentConfig()
+            sub_config.setName(name)
+            sub_config.setDirectorInfo(dir_agent.getInfo())
+            sub = simple.SubAgent(sub_config)
+            reactor.addAgent(sub)
+            return sub
+
+        watcher = start_sub("Watcher")
+        subscribe_job = SubscribeJob(watcher)
+        watcher.addListener(subscribe_job)
+        view = subscribe_job.getView()
+        self.run_until(reactor, lambda: view.isLoaded() and 
+                                        len(view.getMembers()) == 1)
+
+        worker = start_sub("Worker")
+        self.run_until(reactor, lambda: len(view.getMembers()) == 2)
+        assert isinstance(view.getMember(worker.getInfo()).getState(),
+                          agent.RunningState)
+
+        # The worker reports its state on the way out, then leaves
+        worker.shutdown()
+        self.run_until(reactor, lambda: len(view.getMembers()) == 1)
+        assert view.getVersion() == dir_agent.getMembership().getVersion()
+        assert view.getVersion() == 4
+
+        dir_agent.shutdown()
+        self.run_until(reactor, lambda: len(reactor.getAgents()) == 0)
+        for c in dir_agent.getConnections():
+            c.disconnect()
+
+    def test_resubscribe(self):
+        watcher = agent.Agent(agent.AgentConfig())
+        subscribe_job = SubscribeJob(watcher)
+        view = subscribe_job.getView()
+
+        def connect(port):
+            sock, other = socket.socketpair()
+            conn = agent.AgentConnection(make_info("Director", port = port),
+                                         sock)
+            subscribe_job.notify(simple.ConnectCompleteEvent(None, conn))
+            return conn, other
+
+        conn, other = connect(9000)
+        subscribe_job.notify(agent.MessageReceivedEvent(conn, 
+                         MembershipSnapshot(subscribe_job.key, 7, [])))
+        assert view.getVersion() == 7
+
+        # Connections to other agents leave the subscription alone
+        peer, peer_other = connect(9001)
+        assert subscribe_job.conn is conn
+
+        # The director restarts, counting versions from the start again
+        conn.disconnect()
+        subscribe_job.notify(agent.MessageReceivedEvent(peer, 
+                                                   agent.OkResponse("1")))
+        assert not view.isLoaded() and subscribe_job.conn is None
+        conn, other = connect(9000)
+        assert subscribe_job.conn is conn
+        subscribe_job.notify(agent.MessageReceivedEvent(conn, 
+                         MembershipSnapshot(subscribe_job.key, 1, [])))
+        delta = MembershipDelta(2, JOIN, make_info("Worker"), 
+                                agent.RunningState())
+        subscribe_job.notify(agent.MessageReceivedEvent(conn, delta))
+        assert view.getVersion() == 2 and len(view.getMembers()) == 1
+
+        for c in (conn, peer):
+            c.disconnect()
+        other.close()
+        peer_other.close()
+
+class RelayTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "A relay director reports its shard to the parent director"
+
+    def run_until(self, reactor, test):
+        deadline = time.time() + 10.0
+        while not test() and time.time() < deadline:
+            reactor.runOnce(0.1)
+        assert test()
+
+    def free_port(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+
+    def test_feature_one(self):
+        reactor = Reactor()
+        config = director.DirectorConfig()
+        config.setName("Root")
+        config.setBindAddress("127.0.0.1")
+        config.setPort(self.free_port())
+        root = director.Director(config)
+        reactor.addAgent(root)
+
+        relay_config = director.RelayDirectorConfig()
+        relay_config.setName("Relay")
+        relay_config.setBindAddress("127.0.0.1")
+        relay_config.setPort(self.free_port())
+        relay_config.setDirectorInfo(root.getInfo())
+        relay = director.RelayDirector(relay_config)
+        reactor.addAgent(relay)
+
+        workers = []
+        for name in ("Worker0", "Worker1"):
+            sub_config = simple.SubAgentConfig()
+            sub_config.setName(name)
+            sub_config.setDirectorInfo(relay.getInfo())
+            workers.append(simple.SubAgent(sub_config))
+            reactor.addAgent(workers[-1])
+
+        table = root.getMembership()
+        self.run_until(reactor, lambda: len(table) == 3)
+        assert len(root.findAgents(name = "Worker1")) == 1
+        assert len(relay.getMembership()) == 2
+
+        # A worker leaving the relay leaves the root as well
+        workers[0].shutdown()
+        self.run_until(reactor, lambda: len(table) == 2)
+        assert table.getMember(workers[0].getInfo()) is None
+
+        # Shutting down the root reaches the workers through the relay
+        root.shutdown()
+        self.run_until(reactor, lambda: len(reactor.getAgents()) == 0)
+        for a in (root, relay):
+            for c in a.getConnections():
+                c.disconnect()
+
+def test_main():
+    test_support.run_unittest(MembershipTableTestCase,
+                              QueryTestCase,
+                              SubscribeTestCase,
+                              RelayTestCase)
+
+if __name__ == '__main__':
+    test_main()
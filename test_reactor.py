@@ -0,0 +1,107 @@
+#!/usr/bin/python
+
+# JoeAgent - A Multi-Agent Distributed Application Framework
+# Copyright (C) 2004 Rhett Garber
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import unittest, socket, time
+from test import test_support
+from reactor import *
+import agent, simple, director
+from event import EventSource, EventListener
+
+class DropSelfListener(EventListener):
+    def __init__(self, source, log):
+        EventListener.__init__(self)
+        self.source = source
+        self.log = log
+    def notify(self, evt):
+        self.log.append(self)
+        self.source.dropListener(self)
+
+class ListenerTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Listeners dropped while notified do not hide other listeners"
+
+    def test_feature_one(self):
+        source = EventSource()
+        log = []
+        first = DropSelfListener(source, log)
+        second = DropSelfListener(source, log)
+        source.addListener(first)
+        source.addListener(second)
+        source.notifyListeners(None)
+        assert log == [first, second]
+        source.notifyListeners(None)
+        assert len(log) == 2
+
+class ReactorTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Run a director and sub-agents in one reactor"
+
+    def test_feature_one(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        config = director.DirectorConfig()
+        config.setBindAddress("127.0.0.1")
+        config.setPort(port)
+        dir_agent = director.Director(config)
+
+        reactor = Reactor()
+        reactor.addAgent(dir_agent)
+        subs = []
+        for ndx in range(0, 3):
+            sub_config = simple.SubAgentConfig()
+            sub_config.setName("Sub %d" % ndx)
+            sub_config.setDirectorInfo(dir_agent.getInfo())
+            subs.append(simple.SubAgent(sub_config))
+            reactor.addAgent(subs[-1])
+
+        # Each sub-agent stops its connect retry timer once the director
+        # accepts it
+        def registered():
+            for s in subs:
+                if [t for t in s.timers.timers if t.isRunning() and
+                    isinstance(t, simple.ConnectRetryTimer)]:
+                    return 0
+            resp = dir_agent.getStatusResponse("1")
+            return len(resp.getAgentInfoList()) == 3
+        deadline = time.time() + 10.0
+        while not registered() and time.time() < deadline:
+            reactor.runOnce(0.1)
+        resp = dir_agent.getStatusResponse("1")
+        assert len(resp.getAgentInfoList()) == 3
+
+        # Shutting down the director shuts down everyone
+        dir_agent.shutdown()
+        while len(reactor.getAgents()) > 0 and time.time() < deadline:
+            reactor.runOnce(0.1)
+        assert len(reactor.getAgents()) == 0
+
+        for c in dir_agent.getConnections():
+            c.disconnect()
+
+def test_main():
+    test_support.run_unittest(ListenerTestCase,
+                              ReactorTestCase)
+
+if __name__ == '__main__':
+    test_main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+# JoeAgent - A Multi-Agent Distributed Application Framework
+# Copyright (C) 2004 Rhett Garber
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import unittest
+from test import test_support
+from stats import *
+from agent import Agent, AgentConfig, StateChangeEvent
+from event import Event, EventListener
+from xobject import convert_value, load_objects_from_file
+import StringIO
+
+class CountingListener(EventListener):
+    def __init__(self):
+        EventListener.__init__(self)
+        self.count = 0
+    def notify(self, evt):
+        self.count += 1
+
+class HistogramTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Test histogram counting and percentiles"
+
+    def test_feature_one(self):
+        hist = Histogram()
+        assert hist.getPercentile(50) == 0.0
+        for ndx in range(0, 99):
+            hist.record(0.000001)
+        hist.record(0.5)
+
+        assert hist.getCount() == 100
+        assert hist.getMax() == 0.5
+        assert hist.getPercentile(50) <= 0.000002
+        assert hist.getPercentile(100) == 0.5
+
+class AgentStatsTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Test statistics collected by an agent"
+
+    def test_disabled(self):
+        agnt = Agent(AgentConfig())
+        assert agnt.getStats() is None
+        agnt.processEvent()
+
+    def test_feature_one(self):
+        config = AgentConfig()
+        config.setCollectStats(True)
+        agnt = Agent(config)
+        listener = CountingListener()
+        agnt.addListener(listener)
+
+        # The agent queues a StateChangeEvent for itself when created
+        agnt.addEvent(Event(self))
+        while agnt.event_queue.hasEvents():
+            agnt.processEvent()
+
+        stats = agnt.getStats()
+        assert listener.count == 2
+        assert stats.getEventHistogram('Event').getCount() == 1
+        assert stats.getEventHistogram('StateChangeEvent').getCount() == 1
+        assert stats.getListenerHistogram('CountingListener').getCount() == 2
+        assert stats.getQueueWait().getCount() == 2
+
+        # The snapshot must survive the trip through a StatusResponse
+        snap = stats.getSnapshot(agnt)
+        objs = load_objects_from_file(StringIO.StringIO(convert_value(snap)))
+        assert objs[0]['events']['Event']['count'] == 1
+
+def test_main():
+    test_support.run_unittest(HistogramTestCase,
+                              AgentStatsTestCase)
+
+if __name__ == '__main__':
+    test_main()
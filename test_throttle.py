@@ -0,0 +1,142 @@
+# JoeAgent - A Multi-Agent Distributed Application Framework
+# Copyright (C) 2004 Rhett Garber
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import unittest, time, StringIO
+from test import test_support
+from throttle import *
+import agent, simple, xobject, socket
+
+class BackoffTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Backoff delays grow to their maximum and are jittered"
+
+    def test_feature_one(self):
+        policy = ExponentialBackoff(1.0, 10.0, 2.0, 0.5)
+        for attempt, full in [(0, 1.0), (1, 2.0), (3, 8.0), (10, 10.0)]:
+            for n in range(20):
+                delay = policy.getDelay(attempt)
+                assert full * 0.5 <= delay <= full
+        assert FixedBackoff(2.0).getDelay(5) == 2.0
+
+    def test_many_attempts(self):
+        policy = ExponentialBackoff(1.0, 10.0, 2.0, 0.0)
+        assert policy.getDelay(1100) == 10.0
+        assert policy.getDelay(10 ** 9) == 10.0
+        assert ExponentialBackoff(0.0, 10.0).getDelay(1100) == 0.0
+        assert ExponentialBackoff(20.0, 10.0, 2.0, 0.0).getDelay(1100) == 10.0
+
+    def test_config(self):
+        config = agent.AgentConfig()
+        config.setConnectBackoff(ExponentialBackoff(0.5, 5.0))
+        copy = xobject.load_object_from_file(StringIO.StringIO(str(config)))
+        assert isinstance(copy.getConnectBackoff(), ExponentialBackoff)
+        assert copy.getConnectBackoff().maximum == 5.0
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "A token bucket admits a burst, then a steady rate"
+
+    def test_feature_one(self):
+        bucket = TokenBucket(100.0, 3)
+        assert bucket.take() and bucket.take() and bucket.take()
+        assert not bucket.take()
+        assert 0.0 < bucket.getWait() <= 0.01
+        time.sleep(0.02)
+        assert bucket.take()
+
+class ConnectSlotTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Connect attempts beyond the concurrency wait their turn"
+
+    def test_feature_one(self):
+        config = agent.AgentConfig()
+        config.setConnectConcurrency(2)
+        agnt = agent.Agent(config)
+        first, second, third = object(), object(), object()
+        evt = agent.StateChangeEvent(agnt, agent.RUNNING, agent.RUNNING)
+
+        assert agnt.acquireConnectSlot(first, None)
+        assert agnt.acquireConnectSlot(second, None)
+        assert not agnt.acquireConnectSlot(third, evt)
+        assert agnt.acquireConnectSlot(first, None)
+        assert agnt.getConnectCounts() == (2, 1)
+
+        agnt.releaseConnectSlot(first)
+        assert agnt.getConnectCounts() == (2, 0)
+        queued = []
+        while agnt.event_queue.hasEvents():
+            queued.append(agnt.event_queue.pop())
+        assert evt in queued
+        assert agnt.acquireConnectSlot(third, None)
+
+class HandshakeTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Connect requests beyond the handshake rate wait their turn"
+
+    def test_feature_one(self):
+        config = simple.SimpleAgentConfig()
+        config.setHandshakeRate(100.0, 1)
+        agnt = simple.SimpleAgent(config)
+        handler = simple.HandleConnectJob(agnt)
+        socks = []
+        for name in ("First", "Second", "Third"):
+            sock, other = socket.socketpair()
+            socks += [sock, other]
+            info = agent.AgentInfo()
+            info.setName(name)
+            handler.notify(agent.MessageReceivedEvent(
+                              agent.AgentConnection(None, sock),
+                              simple.ConnectRequest(info)))
+        assert handler.getWaitingCount() == 2
+
+        deadline = time.time() + 1.0
+        while handler.getWaitingCount() > 0 and time.time() < deadline:
+            time.sleep(handler.bucket.getWait())
+            handler.notify(simple.HandshakeReadyEvent(handler))
+        assert handler.getWaitingCount() == 0
+        for sock in socks:
+            sock.close()
+
+    def test_deadline(self):
+        config = simple.SimpleAgentConfig()
+        config.setHandshakeTimeout(0.0)
+        agnt = simple.SimpleAgent(config)
+        sock, other = socket.socketpair()
+        silent = agent.AgentConnection(None, sock)
+        agnt.addEvent(agent.ConnectEvent(None, silent))
+        while agnt.event_queue.hasEvents():
+            agnt.processEvent()
+        assert silent in agnt.getConnections()
+
+        time.sleep(0.01)
+        agnt.dispatch([], [], [])
+        assert not silent.isConnected()
+        assert silent not in agnt.getConnections()
+        other.close()
+
+def test_main():
+    test_support.run_unittest(BackoffTestCase,
+                              TokenBucketTestCase,
+                              ConnectSlotTestCase,
+                              HandshakeTestCase)
+
+if __name__ == '__main__':
+    test_main()
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+# JoeAgent - A Multi-Agent Distributed Application Framework
+# Copyright (C) 2004 Rhett Garber
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import unittest, logging
+from test import test_support
+from tracing import *
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+    def emit(self, record):
+        self.records.append(record)
+
+class Unprintable:
+    def __str__(self):
+        raise AssertionError("Field was formatted")
+
+class TracerTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Test guarded, sampled trace points"
+
+    def setUp(self):
+        self.handler = RecordingHandler()
+        self.log = logging.getLogger("test.tracing")
+        self.log.addHandler(self.handler)
+        self.log.propagate = 0
+        self.trc = getTracer("test.tracing")
+
+    def tearDown(self):
+        self.log.removeHandler(self.handler)
+        self.trc.setSampleRate(0)
+
+    def test_disabled(self):
+        self.log.setLevel(logging.INFO)
+        assert not self.trc.isEnabled()
+        self.trc.trace("Never formatted %s", Unprintable(), obj=Unprintable())
+        assert len(self.handler.records) == 0
+
+    def test_debug(self):
+        self.log.setLevel(logging.DEBUG)
+        self.trc.trace("Event %d", 1, queue=3, conn="abc")
+        assert len(self.handler.records) == 1
+        record = self.handler.records[0]
+        assert record.levelno == logging.DEBUG
+        assert record.getMessage() == "Event 1 conn=abc queue=3", \
+               record.getMessage()
+
+    def test_sampled(self):
+        self.log.setLevel(logging.INFO)
+        self.trc.setSampleRate(10)
+        assert self.trc.isEnabled()
+        for ndx in range(0, 100):
+            self.trc.trace("Sampled", ndx=ndx)
+        assert len(self.handler.records) == 10
+        assert self.handler.records[0].levelno == logging.INFO
+
+    def test_sampled_quiet(self):
+        self.log.setLevel(logging.WARNING)
+        self.trc.setSampleRate(1)
+        assert not self.trc.isEnabled()
+        self.trc.trace("Never formatted %s", Unprintable(), obj=Unprintable())
+        assert len(self.handler.records) == 0
+
+def test_main():
+    test_support.run_unittest(TracerTestCase)
+
+if __name__ == '__main__':
+    test_main()
@@ -20,7 +20,7 @@
 import unittest
 from test import test_support
 from xobject import *
-import StringIO
+import StringIO, array, tempfile, os, shutil, base64
 
 class XMLObjectTestClass(XMLObject):
     def __init__(self):
@@ -45,6 +45,20 @@ class XMLObjectTestClass(XMLObject):
         return True
 
 
+class SlottedTestClass(SlottedXMLObject):
+    __slots__ = ('id', 'name', 'children', '_private')
+    def __init__(self):
+        self.id = 12345
+        self.name = "Rhett<da man>"
+        self.children = []
+
+class UnslottedTestClass(SlottedTestClass):
+    pass
+
+class LazyTestClass(SlottedTestClass):
+    __slots__ = ()
+    lazy_decode = True
+
 class ConvertValuesTestCase(unittest.TestCase):
     # Only use setUp() and tearDown() if necessary
 
@@ -147,9 +161,319 @@ class ConvertObjectTestCase(unittest.TestCase):
         #print "Old: %s" % str(obj)
         #print "\nNew: %s" % str(new_obj)
 
+class ConvertSlottedObjectTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Test the convert slotted Objects to XML code"
+
+    def parse(self, txt):
+        parser = make_parser()
+        parser.setFeature(feature_namespaces, 0)
+        parser.setContentHandler(SingleXMLObjectHandler())
+        try:
+            parser.parse(StringIO.StringIO(txt))
+        except EndOfObjectException, e:
+            return e.getObject()
+
+    def test_feature_one(self):
+        obj = SlottedTestClass()
+        obj.id = 4321
+        obj._private = "not sent"
+        obj.children.append(SlottedTestClass())
+        extra = UnslottedTestClass()
+        extra.color = "blue"
+        obj.children.append(extra)
+        assert not hasattr(obj, '__dict__')
+
+        new_obj = self.parse(convert_value(obj))
+        assert new_obj.__class__ == obj.__class__
+        assert new_obj.id == obj.id
+        assert new_obj.name == obj.name
+        assert not hasattr(new_obj, '_private')
+        assert new_obj.children[0].__class__ == SlottedTestClass
+        assert new_obj.children[1].__class__ == UnslottedTestClass
+        assert new_obj.children[1].color == "blue"
+
+class DecoderTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "XMLDecoder decodes what the SAX handler decodes"
+
+    def sax_decode(self, txt):
+        parser = make_parser()
+        parser.setFeature(feature_namespaces, 0)
+        parser.setContentHandler(SingleXMLObjectHandler())
+        try:
+            parser.parse(StringIO.StringIO(txt))
+        except EndOfObjectException, e:
+            return e.getObject()
+
+    def test_feature_one(self):
+        obj = XMLObjectTestClass()
+        obj.da_map = {'what': '<no> & yes', 1234: (63, None)}
+        obj.addToList(XMLObjectTestClass())
+        slotted = SlottedTestClass()
+        slotted.children.append(UnslottedTestClass())
+        values = [123, 'My Name Is', 1.23e10, True, None, [1, '2', []],
+                  {'key': {}}, ('1', 2, {'blah': None}), obj, slotted]
+        for val in values:
+            txt = convert_value(val)
+            new_val = decode(txt)
+            assert new_val.__class__ == val.__class__
+            assert str(new_val) == str(self.sax_decode(txt)), txt
+        assert decode(convert_value(obj)) == obj
+
+    def test_pieces(self):
+        txt = convert_value(XMLObjectTestClass()).rstrip()
+        follows = convert_value(1)
+        decoder = XMLDecoder()
+        for ndx in range(0, len(txt) - 1):
+            decoder.feed(txt[ndx])
+        try:
+            decoder.feed(txt[-1] + follows)
+        except EndOfObjectException, e:
+            assert e.getObject() == XMLObjectTestClass()
+        assert decoder.getByteIndex() == len(txt)
+
+        decoder.reset()
+        try:
+            decoder.feed(follows)
+        except EndOfObjectException, e:
+            assert e.getObject() == 1
+
+        decoder.reset()
+        self.assertRaises(ValueError, decoder.feed, "<bogus/>")
+
+class LazyDecodeTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Lazy decoding leaves members encoded until they are used"
+
+    def test_feature_one(self):
+        obj = LazyTestClass()
+        obj.children.append(LazyTestClass())
+        obj.children[0].children.append(SlottedTestClass())
+        txt = convert_value([obj, obj])
+
+        new_list = decode(txt, lazy = True)
+        new_obj = new_list[0]
+        assert new_obj.id == obj.id and new_obj.name == obj.name
+        assert new_obj._encoded.keys() == ['children']
+        # Untouched members are copied out as they arrived
+        assert str(decode(str(new_obj))) == str(decode(txt)[0])
+        assert new_obj.children[0].__class__ == LazyTestClass
+        assert new_obj.children[0].children[0].id == 12345
+        assert str(decode(str(new_obj))) == str(decode(txt)[0])
+
+        # A member replaced before it was decoded
+        new_list[1].children = []
+        assert decode(str(new_list[1])).children == []
+
+        # Not lazy unless asked
+        assert decode(txt)[0].children[0].children[0].id == 12345
+
+    def test_invalid(self):
+        obj = LazyTestClass()
+        obj.children = [1]
+        txt = str(obj).replace("<int>1</int>", "<int>one</int>")
+        new_obj = decode(txt, lazy = True)
+        self.assertRaises(MemberDecodeException, getattr, new_obj, 'children')
+        self.assertRaises(ValueError, getattr, new_obj, 'children')
+        assert str(new_obj).find("<int>one</int>") >= 0
+
+        # Badly formed members are caught as they arrive
+        txt = str(obj).replace("<int>1</int>", "<int>1</str>")
+        self.assertRaises(expat.ExpatError, decode, txt, True)
+
+class ArrayTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Arrays convert to XML and back in one block"
+
+    def sax_decode(self, txt):
+        parser = make_parser()
+        parser.setFeature(feature_namespaces, 0)
+        hndlr = XMLObjectHandler()
+        parser.setContentHandler(hndlr)
+        parser.parse(StringIO.StringIO(txt))
+        return hndlr.getInstances()[0]
+
+    def test_feature_one(self):
+        values = [array.array('d', [1.5, -2.25, 1e300]),
+                  array.array('f'),
+                  array.array('i', [1, -2, 2 ** 31 - 1]),
+                  array.array('B', range(256)),
+                  array.array('c', 'chars & <tags>'),
+                  array.array('l', [-1, 2 ** 31 - 1]),
+                  array.array('L', [0, 2 ** 32 - 1]),
+                  array.array('u', u'wide \u20ac')]
+        for val in values:
+            txt = convert_value(val)
+            assert txt.count('<') == 2, txt
+            for new_val in (decode(txt), self.sax_decode(txt)):
+                assert new_val.typecode == val.typecode
+                assert new_val == val, txt
+
+        # Longs and unicode characters have the same size everywhere
+        txt = convert_value(array.array('l', [-2]))
+        assert base64.b64decode(txt[txt.index('>') + 1:txt.rindex('<')]) \
+               == '\xfe' + '\xff' * 7
+        txt = convert_value(array.array('u', u'a'))
+        assert base64.b64decode(txt[txt.index('>') + 1:txt.rindex('<')]) \
+               == 'a\x00\x00\x00'
+
+        obj = LazyTestClass()
+        obj.children = values
+        assert decode(convert_value(obj), lazy = True).children == values
+
+    def test_invalid(self):
+        for txt in ['<array type="d">abc</array>',
+                    '<array type="l">AAAA</array>',
+                    '<array type="z"></array>']:
+            self.assertRaises(ValueError, decode, txt)
+        if numpy is not None:
+            self.assertRaises(ValueError, decode,
+                              '<ndarray dtype="bad" shape="">AAAA</ndarray>')
+
+    def test_numpy(self):
+        if numpy is None:
+            return
+        values = [numpy.arange(12, dtype = '>f8').reshape(3, 4),
+                  numpy.arange(10, dtype = 'int16')[::3],
+                  numpy.array(7, dtype = 'uint8'),
+                  numpy.zeros((0, 2))]
+        for val in values:
+            txt = convert_value(val)
+            for new_val in (decode(txt), self.sax_decode(txt)):
+                assert new_val.shape == val.shape
+                assert new_val.dtype.kind == val.dtype.kind
+                assert (new_val == val).all(), txt
+        self.assertRaises(TypeError, convert_value, 
+                          numpy.array([None, 1]))
+
+class BlobTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Blobs decode to memoryviews, in band or out of band"
+
+    def test_feature_one(self):
+        obj = LazyTestClass()
+        obj.name = memoryview("\x00\xff<&>")
+        obj.children = [bytearray("second"), 1]
+
+        txt = convert_value(obj)
+        new_obj = decode(txt)
+        assert new_obj.name.tobytes() == "\x00\xff<&>"
+        assert new_obj.children[0].tobytes() == "second"
+        parser = make_parser()
+        hndlr = XMLObjectHandler()
+        parser.setContentHandler(hndlr)
+        parser.parse(StringIO.StringIO(txt))
+        assert hndlr.getInstances()[0].name.tobytes() == "\x00\xff<&>"
+
+        txt, blobs = convert_value_oob(obj)
+        assert len(blobs) == 2 and txt.find("second") < 0
+        blobs = [memoryview(str(bytearray(b))) for b in blobs]
+        for lazy in (False, True):
+            new_obj = decode(txt, lazy, blobs)
+            assert new_obj.name is blobs[0]
+            assert new_obj.children[0] is blobs[1]
+        self.assertRaises(ValueError, decode, txt)
+        self.assertRaises(ValueError, decode, "<blob>a</blob>")
+
+class ArchiveTestCase(unittest.TestCase):
+
+    def shortDescription(self):
+        return "Archives are read one object at a time, from any offset"
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "archive")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, values):
+        archive = open(self.path, "ab")
+        for val in values:
+            archive.write(convert_value(val) + "\n")
+        archive.close()
+
+    def test_feature_one(self):
+        values = []
+        for ndx in range(0, 50):
+            obj = SlottedTestClass()
+            obj.id = ndx
+            obj.children = ["x" * (ndx * 997)]
+            values.append(obj)
+        values.append([1, "two"])
+        self.write(values)
+
+        reader = open_archive(self.path)
+        offsets = []
+        for obj in reader:
+            assert str(obj) == str(values[len(offsets)])
+            offsets.append(reader.getStart())
+            if len(offsets) == 20:
+                resume = reader.getOffset()
+        assert len(offsets) == len(values)
+        reader.close()
+
+        # Carry on from where an earlier reader stopped
+        reader = ObjectReader(open(self.path, "rb"), resume)
+        assert reader.next().id == 20
+        assert reader.getStart() == offsets[20]
+        assert len(list(reader)) == len(values) - 21
+
+        assert build_index(self.path) == len(values)
+        assert load_object_at(self.path, 37).id == 37
+        assert load_object_at(self.path, -1) == [1, "two"]
+        self.assertRaises(IndexError, load_object_at, self.path, 51)
+
+        # The index catches up with a growing archive
+        self.write([None, 3])
+        assert build_index(self.path) == len(values) + 2
+        assert load_object_at(self.path, len(values) + 1) == 3
+
+        assert load_objects_from_file(self.path)[-2:] == [None, 3]
+
+    def test_small_values(self):
+        values = []
+        for ndx in range(0, 2000):
+            obj = SlottedTestClass()
+            obj.id = ndx
+            obj.children = ["c%d" % ndx]
+            values.append(obj)
+        self.write(values)
+
+        # Many values come out of each read, sharing its buffer
+        reader = ObjectReader(open(self.path, "rb"), lazy = True)
+        count = 0
+        for obj in reader:
+            assert obj.id == count and obj.children == ["c%d" % count]
+            count += 1
+            if count == 1000:
+                assert reader.pos > 0
+                assert len(reader.buffer) == READ_SIZE
+        assert count == len(values)
+        reader.close()
+
+    def test_partial(self):
+        self.write([])
+        assert list(open_archive(self.path)) == []
+        reader = ObjectReader(StringIO.StringIO("<int>1</int> <list><int>"))
+        assert reader.next() == 1
+        self.assertRaises(ValueError, reader.next)
+
 def test_main():
     test_support.run_unittest(ConvertValuesTestCase,
-                              ConvertObjectTestCase)
+                              ConvertObjectTestCase,
+                              ConvertSlottedObjectTestCase,
+                              DecoderTestCase,
+                              LazyDecodeTestCase,
+                              ArrayTestCase,
+                              BlobTestCase,
+                              ArchiveTestCase)
 
 if __name__ == '__main__':
     test_main()
@@ -0,0 +1,97 @@
+# JoeAgent - A Multi-Agent Distributed Application Framework
+# Copyright (C) 2004 Rhett Garber
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""
+Pacing of connection attempts.
+
+A backoff policy decides how long an agent waits before its next attempt
+to connect, so a crowd of agents which lost their director at the same
+moment do not all come back at the same moment. Policies are XMLObjects
+so they can be part of an agent's configuration.
+
+A TokenBucket limits the rate of some action while still allowing short
+bursts of it, which is how an agent admits the handshakes of many
+reconnecting agents.
+"""
+
+import math, random, time
+from xobject import XMLObject
+
+class FixedBackoff(XMLObject):
+    """Wait the same interval before every attempt"""
+    def __init__(self, interval = 3.0):
+        XMLObject.__init__(self)
+        self.interval = interval
+
+    def getDelay(self, attempt):
+        """Return seconds to wait after the given (0 based) attempt"""
+        return self.interval
+
+class ExponentialBackoff(XMLObject):
+    """Double (by default) the wait after every failed attempt, up to a
+    maximum. The wait is randomly shortened by up to the jitter fraction
+    so agents which started together spread out."""
+    def __init__(self, initial = 3.0, maximum = 60.0, factor = 2.0,
+                 jitter = 0.5):
+        XMLObject.__init__(self)
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+
+    def getDelay(self, attempt):
+        """Return seconds to wait after the given (0 based) attempt"""
+        if self.factor > 1.0 and attempt > 0:
+            # Stop growing once the maximum is reached, factor ** attempt
+            # overflows long before attempts run out
+            if 0 < self.initial < self.maximum:
+                attempt = min(attempt, int(math.ceil(
+                    math.log(self.maximum / self.initial, self.factor))))
+            else:
+                attempt = 0
+        delay = min(self.initial * (self.factor ** attempt), self.maximum)
+        return delay * (1.0 - self.jitter * random.random())
+
+class TokenBucket:
+    """Allows rate actions per second on average and bursts of up to
+    burst actions at once"""
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, 
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def take(self):
+        """Use up a token if one is available, returning whether it was"""
+        self._refill()
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+    def getWait(self):
+        """Seconds until the next token is available"""
+        self._refill()
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
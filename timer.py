@@ -15,8 +15,9 @@
 # License along with this library; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import logging
+import logging, tracing
 log = logging.getLogger("agent.timer")
+trc = tracing.getTracer("agent.timer")
 
 
 import time
@@ -46,8 +47,10 @@ class Timer:
            self.create_time + self.interval < time.time()
 
     def getTimeLeft(self):
-        log.debug("C: %f  I: %f   N: %f" % (self.create_time, self.interval, time.time()))
-        time_left = (self.create_time + self.interval) - time.time()
+        now = time.time()
+        trc.trace("Time left", created=self.create_time,
+                  interval=self.interval, now=now)
+        time_left = (self.create_time + self.interval) - now
         if time_left < 0:
             time_left = 0
         return time_left
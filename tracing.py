@@ -0,0 +1,110 @@
+# JoeAgent - A Multi-Agent Distributed Application Framework
+# Copyright (C) 2004 Rhett Garber
+
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""
+Cheap trace points for the hot paths of the agent runtime.
+
+Formatting log messages with '%' and str() before handing them to
+log.debug() costs the same whether or not DEBUG logging is enabled. A
+Tracer wraps a logger and only formats its message and fields once it has
+decided the trace point will actually be emitted:
+
+    trc = tracing.getTracer("agent")
+    trc.trace("Event added", queue=len(queue), event=evt)
+
+Fields are written as key=value pairs after the message, and str() is only
+called on them when the trace is emitted. Code that would have to do real
+work just to build the fields should check trc.isEnabled() first.
+
+Trace points are emitted at DEBUG level when the logger has DEBUG enabled.
+For production, a tracer can also be put in sampled mode with
+setSampleRate(), in which case one out of every N trace points is emitted
+at INFO level even though DEBUG logging is off. With INFO off as well,
+sampled trace points cost no more than disabled ones.
+"""
+
+import logging
+
+class Tracer:
+    def __init__(self, name):
+        self.log = logging.getLogger(name)
+        self.sample_rate = 0
+        self._countdown = 0
+
+    def getName(self):
+        return self.log.name
+
+    def getSampleRate(self):
+        return self.sample_rate
+    def setSampleRate(self, rate):
+        """Emit one of every rate trace points at INFO level. A rate of 0
+        turns sampling off"""
+        self.sample_rate = rate
+        self._countdown = rate
+
+    def isEnabled(self):
+        """Could a trace point be emitted right now?"""
+        if self.sample_rate > 0:
+            return self.log.isEnabledFor(logging.INFO)
+        return self.log.isEnabledFor(logging.DEBUG)
+
+    def trace(self, msg, *args, **fields):
+        """Emit a trace point. msg is formatted with args the same way a
+        logging call would, followed by the fields as key=value pairs."""
+        if self.log.isEnabledFor(logging.DEBUG):
+            level = logging.DEBUG
+        elif self.sample_rate > 0 and self.log.isEnabledFor(logging.INFO):
+            self._countdown -= 1
+            if self._countdown > 0:
+                return
+            self._countdown = self.sample_rate
+            level = logging.INFO
+        else:
+            return
+
+        if args:
+            msg = msg % args
+        if fields:
+            names = fields.keys()
+            names.sort()
+            pairs = []
+            for name in names:
+                pairs.append("%s=%s" % (name, str(fields[name])))
+            msg = "%s %s" % (msg, " ".join(pairs))
+        self.log.log(level, msg)
+
+_tracers = {}
+_default_rate = 0
+
+def getTracer(name):
+    """Return the Tracer for the named logger, creating it if needed"""
+    trc = _tracers.get(name)
+    if trc is None:
+        trc = _tracers[name] = Tracer(name)
+        trc.setSampleRate(_default_rate)
+    return trc
+
+def setSampleRate(rate, name = None):
+    """Set the sample rate on the named tracer. If no name is given the
+    rate is applied to every tracer, including ones created later"""
+    global _default_rate
+    if name is not None:
+        getTracer(name).setSampleRate(rate)
+    else:
+        _default_rate = rate
+        for trc in _tracers.values():
+            trc.setSampleRate(rate)
@@ -19,7 +19,17 @@ from xml.sax import saxutils, handler, make_parser, xmlreader
 from xml.sax.handler import feature_namespaces
 from xml.sax.expatreader import ExpatParser
 from utils import get_class
-import string, types
+from xml.parsers import expat
+import string, types, array, base64, sys, threading, os, mmap, struct, re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class MemberDecodeException(ValueError):
+    """Raised when a member a lazy decoder left encoded turns out to be
+    invalid as it is decoded"""
 
 class EndOfObjectException(Exception):
     """Exception used for interrupting a parser when a single XMLObject 
@@ -60,8 +70,13 @@ TYPE_TAG_MAP = {
     types.BooleanType: 'boolean',
     types.ListType: 'list',
     types.DictType: 'dict',
-    types.TupleType: 'tuple'
+    types.TupleType: 'tuple',
+    array.ArrayType: 'array',
+    memoryview: 'blob',
+    bytearray: 'blob'
 }
+if numpy is not None:
+    TYPE_TAG_MAP[numpy.ndarray] = 'ndarray'
 
 
 def create_xml_list(value):
@@ -82,6 +97,110 @@ def create_xml_dict(value):
                            "value", convert_value(value[k]), "value"))
     return string.join(values, '\n')
 
+# Arrays are written as a single block of base64 encoded, little-endian
+# data, along with the array's typecode (or dtype and shape for NumPy
+# arrays). They decode with one call, rather than an element per item.
+# The size of longs and unicode characters differs between platforms, so
+# 'l' and 'L' items are always written as 8 bytes and 'u' as UTF-32.
+
+_ARRAY_LONGS = {'l': 'q', 'L': 'Q'}
+
+def _b64decode(data):
+    """base64.b64decode, raising ValueError (like the rest of decoding)
+    rather than TypeError for bad data"""
+    try:
+        return base64.b64decode(data)
+    except TypeError, e:
+        raise ValueError("Invalid base64 data: %s" % e)
+
+def create_xml_array(value):
+    """Return the base64 encoded, little-endian data of an array"""
+    if value.typecode in _ARRAY_LONGS:
+        data = struct.pack("<%d%s" % (len(value),
+                                      _ARRAY_LONGS[value.typecode]),
+                           *value)
+    elif value.typecode == 'u':
+        data = value.tounicode().encode('utf-32-le')
+    else:
+        if sys.byteorder != 'little':
+            value = array.array(value.typecode, value)
+            value.byteswap()
+        data = value.tostring()
+    return base64.b64encode(data)
+
+def create_xml_ndarray(value):
+    """Return the dtype, shape and base64 encoded data of a NumPy array"""
+    if value.dtype.hasobject or value.dtype.fields is not None:
+        raise TypeError("Cannot convert NumPy arrays of %s" % value.dtype)
+    dtype = value.dtype.newbyteorder('<')
+    value = value.astype(dtype, order = 'C', copy = False)
+    return (saxutils.escape(dtype.str), 
+            string.join(map(str, value.shape), ','),
+            base64.b64encode(value.tobytes()))
+
+def decode_array(typecode, data):
+    data = _b64decode(data)
+    if typecode in _ARRAY_LONGS:
+        if len(data) % 8 != 0:
+            raise ValueError("Array data is not a whole number of items")
+        return array.array(typecode, struct.unpack(
+            "<%d%s" % (len(data) / 8, _ARRAY_LONGS[typecode]), data))
+    if typecode == 'u':
+        return array.array(typecode, data.decode('utf-32-le'))
+    value = array.array(typecode)
+    value.fromstring(data)
+    if sys.byteorder != 'little':
+        value.byteswap()
+    return value
+
+def decode_ndarray(dtype, shape, data):
+    if numpy is None:
+        raise ValueError("NumPy is needed to decode an ndarray")
+    if shape:
+        shape = map(int, shape.split(','))
+    else:
+        shape = ()
+    try:
+        dtype = numpy.dtype(dtype)
+    except TypeError, e:
+        raise ValueError("Unknown dtype %s" % dtype)
+    value = numpy.frombuffer(bytearray(_b64decode(data)), 
+                             dtype).reshape(shape)
+    if sys.byteorder != 'little':
+        value = value.astype(value.dtype.newbyteorder('='))
+    return value
+
+# Blobs (memoryview and bytearray values) are raw bytes. convert_value
+# writes them base64 encoded in place, but within convert_value_oob they
+# are only referred to by their position in the list of blobs it returns,
+# so they can be sent alongside the XML as they are. Either way they
+# decode to a memoryview.
+_oob = threading.local()
+
+def convert_value_oob(value):
+    """Convert a value like convert_value, but leave out its blobs. Returns
+    the XML and a list of the blobs it refers to"""
+    _oob.blobs = blobs = []
+    try:
+        return (convert_value(value), blobs)
+    finally:
+        _oob.blobs = None
+
+def create_xml_blob(value):
+    blobs = getattr(_oob, 'blobs', None)
+    if blobs is None:
+        return "<blob>%s</blob>" % base64.b64encode(value)
+    blobs.append(value)
+    return "<blob ref=\"%d\"/>" % (len(blobs) - 1)
+
+def decode_blob(ref, data, blobs):
+    if ref is None:
+        return memoryview(_b64decode(data))
+    try:
+        return blobs[int(ref)]
+    except (IndexError, TypeError):
+        raise ValueError("Unknown blob %s" % ref)
+
 def convert_value(value):
     """Convert a primitive python value into its XML representaion"""
 
@@ -89,7 +208,7 @@ def convert_value(value):
     # converted to a string. Some are more complicated like lists and dicts
     # and are handled in another function.
 
-    if isinstance(value, XMLObject):
+    if isinstance(value, (XMLObject, SlottedXMLObject)):
         return str(value)
 
     tag = TYPE_TAG_MAP[type(value)]
@@ -103,6 +222,14 @@ def convert_value(value):
         value = create_xml_dict(value)
     elif type(value) == types.StringType:
         value = saxutils.escape(value)
+    elif type(value) == array.ArrayType:
+        return "<%s type=\"%s\">%s</%s>" % (tag, value.typecode,
+                                          create_xml_array(value), tag)
+    elif tag == 'blob':
+        return create_xml_blob(value)
+    elif tag == 'ndarray':
+        return "<%s dtype=\"%s\" shape=\"%s\">%s</%s>" % \
+               ((tag,) + create_xml_ndarray(value) + (tag,))
     
     return "<%s>%s</%s>" % (tag, str(value), tag)
     
@@ -128,6 +255,91 @@ class XMLObject:
                                                                
         return output
 
+def get_slot_names(cls):
+    """Return the names of all the slots declared by a class and its base
+    classes. The result is cached on the class."""
+    try:
+        return cls.__dict__['_slot_names']
+    except KeyError:
+        pass
+
+    names = []
+    for klass in reversed(cls.__mro__):
+        slots = klass.__dict__.get('__slots__', ())
+        if isinstance(slots, types.StringTypes):
+            slots = (slots,)
+        for name in slots:
+            if name not in names and name != '__dict__' and \
+               name != '__weakref__':
+                names.append(name)
+    cls._slot_names = tuple(names)
+    return cls._slot_names
+
+class SlottedXMLObject(object):
+    """Compact variant of XMLObject. Members are declared in __slots__, so
+    instances have no __dict__ and the serializer walks the declared
+    members (skipping any that were never set). A subclass which does not
+    declare __slots__ gets a __dict__ back, whose members are written out
+    after the slots.
+
+    If lazy_decode is set, an XMLDecoder created with lazy = True leaves
+    every member that is not a plain value (a string, number, boolean or
+    None) encoded. Such a member is decoded the first time it is used, and
+    is copied out unchanged if the object is encoded again before then.
+    The XML of the member was checked to be well formed as it arrived, but
+    its values only when it is decoded: reading a member whose values are
+    invalid (an int which is not a number, say) raises MemberDecodeException."""
+    __slots__ = ('_encoded',)
+    lazy_decode = False
+
+    def __getattr__(self, name):
+        # Only called for members which are not set
+        try:
+            raw = object.__getattribute__(self, '_encoded')[name]
+        except (AttributeError, KeyError):
+            raise AttributeError(name)
+        try:
+            value = decode(raw)
+        except Exception, e:
+            raise MemberDecodeException("Invalid %s member of %s: %s" %
+                                    (name, self.__class__.__name__, e))
+        del self._encoded[name]
+        setattr(self, name, value)
+        return value
+
+    def __str__(self):
+        """Convert Object to XML"""
+        output = []
+        for property in get_slot_names(self.__class__):
+            if property[0] != "_":
+                try:
+                    value = object.__getattribute__(self, property)
+                except AttributeError:
+                    continue
+                output.append("  <%s>%s</%s>\n" % (property, 
+                                                 convert_value(value),
+                                                 property))
+        members = getattr(self, '__dict__', {})
+        for property in members.keys():
+            if property[0] != "_":
+                output.append("  <%s>%s</%s>\n" % (property, 
+                                         convert_value(members[property]), 
+                                                 property))
+        try:
+            encoded = object.__getattribute__(self, '_encoded')
+        except AttributeError:
+            encoded = {}
+        for property, raw in encoded.items():
+            try:
+                # Set since it was decoded, so the encoded value is stale
+                object.__getattribute__(self, property)
+            except AttributeError:
+                output.append("  <%s>%s</%s>\n" % (property, raw, property))
+
+        return "<XMLObject class=\"%s.%s\">\n%s</XMLObject>\n" % \
+               (self.__class__.__module__, self.__class__.__name__,
+                string.join(output, ''))
+
 def create_object(full_class_name = None):
     """Instantiate an object by just by a string representation of its class.
     The object must not have required arguments to the __init__ function.
@@ -226,6 +438,24 @@ class NoneElement(TypedElement):
     def getValue(self):
         return None
 
+class ArrayElement(TypedElement):
+    ELEMENT_TYPE = array.ArrayType
+    TAG = TYPE_TAG_MAP[ELEMENT_TYPE]
+    def getValue(self):
+        return decode_array(str(self._attrs['type']), self.value)
+
+class NDArrayElement(TypedElement):
+    TAG = 'ndarray'
+    def getValue(self):
+        return decode_ndarray(str(self._attrs['dtype']), 
+                              str(self._attrs['shape']), self.value)
+
+class BlobElement(TypedElement):
+    TAG = 'blob'
+    def getValue(self):
+        # Blobs sent out of band are only known to an XMLDecoder
+        return decode_blob(self._attrs.get('ref'), self.value, None)
+
 class MemberElement(StackElement):
     """MemberElements coorespond to member variables of an XMLObject.
     They are special because the tag value indicates the name of the member,
@@ -252,7 +482,11 @@ class ObjectElement(StackElement):
         self.dict[elem.getName()] = elem.getValue()
     def getValue(self):
         obj = create_object(self._attrs['class'])
-        obj.__dict__.update(self.dict)
+        if isinstance(obj, SlottedXMLObject):
+            for name, value in self.dict.items():
+                setattr(obj, name, value)
+        else:
+            obj.__dict__.update(self.dict)
         return obj
 
 class ListElement(StackElement):
@@ -329,6 +563,9 @@ for elem in [StringElement,
              IntegerElement,
              FloatElement,
              BooleanElement,
+             ArrayElement,
+             NDArrayElement,
+             BlobElement,
              ListElement,
              TupleElement,
              DictionaryElement,
@@ -423,6 +660,252 @@ class SingleXMLObjectHandler(XMLObjectHandler):
             raise EndOfObjectException(self.instances[0])
 
 
+# The XMLDecoder below does the work of the XMLObjectHandler without the
+# SAX layer or a StackElement for every element. It keeps two parallel
+# stacks: the kind of each open element, and the container its value is
+# being built in (or, for elements which only wrap a value, the name of the
+# member or the tag of the type). A completed value is handed straight to
+# the container of its parent.
+#
+# A lazy decoder does not decode the members of SlottedXMLObjects which
+# ask for lazy_decode, unless they are plain values. It only notes where
+# each one starts and ends, ignoring the elements in between, and once the
+# whole value has been decoded hands the objects their members' XML.
+
+(_SCALAR, _LIST, _TUPLE, _DICT, _PAIR, _KEY, _VALUE, _OBJECT, 
+ _MEMBER, _ARRAY, _BLOB) = range(11)
+
+_CONTAINER_KINDS = {'list': _LIST, 'tuple': _TUPLE, 'dict': _DICT, 
+                    'pair': _PAIR, 'key': _KEY, 'value': _VALUE}
+
+def _decode_str(text):
+    if '&' in text:
+        return saxutils.unescape(text)
+    return text
+
+def _decode_boolean(text):
+    text = text.strip()
+    if text == "True":
+        return True
+    elif text == "False":
+        return False
+    assert 0, "Invalid for boolean: %s" % text
+
+_SCALAR_DECODERS = {'str': _decode_str, 'int': int, 'float': float,
+                    'boolean': _decode_boolean, 'none': lambda text: None}
+
+class _Encoded(object):
+    """Position of a member left encoded by a lazy XMLDecoder"""
+    __slots__ = ('start', 'end')
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+_lazy_classes = {}
+
+def _is_lazy(class_name):
+    try:
+        return _lazy_classes[class_name]
+    except KeyError:
+        pass
+    cls = get_class(class_name)
+    lazy = isinstance(cls, type) and issubclass(cls, SlottedXMLObject) and \
+           cls.lazy_decode
+    _lazy_classes[class_name] = lazy
+    return lazy
+
+class XMLDecoder:
+    """Decodes XMLObjects and python values from XML, using pyexpat
+    directly. Data is given to feed() as it arrives. Once a whole value
+    has been decoded feed() raises an EndOfObjectException holding it,
+    and getByteIndex() tells how much of the data fed so far it used.
+    reset() readies the decoder for the next value.
+
+    A lazy decoder leaves members of classes with lazy_decode set encoded
+    (see SlottedXMLObject). Blobs sent out of band (see convert_value_oob)
+    are taken from the decoder's blobs list."""
+    def __init__(self, lazy = False):
+        self.lazy = lazy
+        self.reset()
+
+    def reset(self):
+        self.parser = expat.ParserCreate()
+        self.parser.returns_unicode = False
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self._start
+        self.parser.EndElementHandler = self._end
+        self.parser.CharacterDataHandler = self._text
+        self.kinds = []
+        self.slots = []
+        self.classes = []
+        self.content = []
+        # Data fed so far, and the members left encoded, when lazy
+        self.chunks = []
+        self.deferred = []
+        self.skip_start = None
+        self.skipped = 0
+        self.blobs = None
+
+    def feed(self, data):
+        if self.lazy:
+            self.chunks.append(data)
+        self.parser.Parse(data, 0)
+
+    def getByteIndex(self):
+        """Offset (in the data fed since the last reset) just past the end
+        of the value that was decoded"""
+        return self.parser.CurrentByteIndex
+
+    def _text(self, text):
+        self.content.append(text)
+
+    def _skipStart(self, name, attrs):
+        self.skipped += 1
+
+    def _skipEnd(self, name):
+        self.skipped -= 1
+        if self.skipped == 0:
+            self.parser.StartElementHandler = self._start
+            self.parser.EndElementHandler = self._end
+            self.parser.CharacterDataHandler = self._text
+
+    def _start(self, name, attrs):
+        kinds = self.kinds
+        if kinds and kinds[-1] == _OBJECT:
+            kinds.append(_MEMBER)
+            self.slots.append(name)
+        elif _SCALAR_DECODERS.has_key(name):
+            kinds.append(_SCALAR)
+            self.slots.append(name)
+            self.content = []
+        elif name == "blob":
+            # Decoded straight away, as it may refer to a blob which is
+            # only held until the end of the value
+            kinds.append(_BLOB)
+            self.slots.append(attrs.get('ref'))
+            self.content = []
+        elif self.lazy and kinds and kinds[-1] == _MEMBER and \
+             _is_lazy(self.classes[-1]):
+            # Skip over the member's value, up to the end of the member
+            self.skip_start = self.parser.CurrentByteIndex
+            self.skipped = 1
+            self.parser.StartElementHandler = self._skipStart
+            self.parser.EndElementHandler = self._skipEnd
+            self.parser.CharacterDataHandler = None
+        elif name == "array" or name == "ndarray":
+            kinds.append(_ARRAY)
+            self.slots.append((name, attrs))
+            self.content = []
+        elif name == "XMLObject":
+            kinds.append(_OBJECT)
+            self.slots.append({})
+            self.classes.append(attrs['class'])
+        else:
+            kind = _CONTAINER_KINDS.get(name)
+            if kind is None:
+                raise ValueError("Unknown element %s" % name)
+            kinds.append(kind)
+            if kind == _DICT:
+                self.slots.append({})
+            elif kind == _LIST or kind == _TUPLE:
+                self.slots.append([])
+            elif kind == _PAIR:
+                self.slots.append([None, None])
+            else:
+                self.slots.append(None)
+
+    def _end(self, name):
+        kind = self.kinds.pop()
+        slot = self.slots.pop()
+        if kind == _SCALAR:
+            value = _SCALAR_DECODERS[slot]("".join(self.content))
+        elif kind == _LIST or kind == _DICT:
+            value = slot
+        elif kind == _TUPLE:
+            value = tuple(slot)
+        elif kind == _BLOB:
+            value = decode_blob(slot, "".join(self.content), self.blobs)
+        elif kind == _ARRAY:
+            name, attrs = slot
+            if name == "array":
+                value = decode_array(attrs['type'], "".join(self.content))
+            else:
+                value = decode_ndarray(attrs['dtype'], attrs['shape'],
+                                       "".join(self.content))
+        elif kind == _OBJECT:
+            value = create_object(self.classes.pop())
+            if isinstance(value, SlottedXMLObject):
+                for member, member_value in slot.items():
+                    if member_value.__class__ is _Encoded:
+                        self._defer(value, member, member_value)
+                    else:
+                        setattr(value, member, member_value)
+            else:
+                value.__dict__.update(slot)
+        elif kind == _PAIR:
+            self.slots[-1][slot[0]] = slot[1]
+            return
+        elif kind == _MEMBER and self.skip_start is not None:
+            self.slots[-1][slot] = _Encoded(self.skip_start, 
+                                            self.parser.CurrentByteIndex)
+            self.skip_start = None
+            return
+        else:
+            # Members, keys and values have already passed on their value
+            return
+
+        if not self.kinds:
+            if self.deferred:
+                self._resolve()
+            raise EndOfObjectException(value)
+        parent = self.kinds[-1]
+        if parent == _LIST or parent == _TUPLE:
+            self.slots[-1].append(value)
+        elif parent == _MEMBER:
+            self.slots[-2][self.slots[-1]] = value
+        elif parent == _KEY:
+            self.slots[-2][0] = value
+        elif parent == _VALUE:
+            self.slots[-2][1] = value
+        else:
+            raise ValueError("Unexpected %s element" % name)
+
+    def _defer(self, obj, member, span):
+        # The member may have a default set by __init__
+        try:
+            delattr(obj, member)
+        except AttributeError:
+            pass
+        try:
+            object.__getattribute__(obj, '_encoded')
+        except AttributeError:
+            obj._encoded = {}
+        self.deferred.append((obj, member, span))
+
+    def _resolve(self):
+        if len(self.chunks) == 1:
+            # Possibly a buffer, which slices to strings as well
+            data = self.chunks[0]
+        else:
+            data = "".join([str(chunk) for chunk in self.chunks])
+        for obj, member, span in self.deferred:
+            raw = data[span.start:span.end].rstrip()
+            if self.blobs and raw.find("<blob ") >= 0:
+                setattr(obj, member, decode(raw, blobs = self.blobs))
+            else:
+                obj._encoded[member] = raw
+        self.deferred = []
+
+def decode(data, lazy = False, blobs = None):
+    """Decode the first value in a string of XML"""
+    decoder = XMLDecoder(lazy)
+    decoder.blobs = blobs
+    try:
+        decoder.feed(data)
+    except EndOfObjectException, e:
+        return e.getObject()
+    return None
+
 def print_instance(instance, indent = ""):
     print "%sInstance of: %s" % (indent, str(instance.__class__))
     for var in instance.__dict__.keys():
@@ -454,32 +937,175 @@ def load_object_from_socket(sock):
 
     return None
 
-def load_objects_from_file(file):
-    """Load a list of objects from a file"""
-    # Create a parser
-    parser = make_parser()
-
-    # Tell the parser we are not interested in XML namespaces
-    parser.setFeature(feature_namespaces, 0)
-
-    # Create the handler
-    obj_par = XMLObjectHandler()
-
-    # Tell the parser to use our handler
-    parser.setContentHandler(obj_par)
-
-    # Parse the input
-    parser.parse(file)
+# An archive is a file of values (usually XMLObjects) written one after
+# the other, as they would be sent over a connection. An ObjectReader
+# decodes them one at a time, holding no more than one object and one
+# read's worth of data. Its offsets let a later reader carry on where it
+# left off, or go straight to an object listed in the archive's sidecar
+# index: a file of 8 byte little-endian offsets, one per object.
+
+READ_SIZE = 64 * 1024
+_SPACE = re.compile(r"\s*")
+INDEX_SUFFIX = ".idx"
+INDEX_ENTRY = "<Q"
+INDEX_ENTRY_SIZE = struct.calcsize(INDEX_ENTRY)
+
+class ObjectReader:
+    """Iterator over the values in a file (or anything with read() and
+    seek(), such as an mmap), starting at the given byte offset. A lazy
+    reader decodes like a lazy XMLDecoder."""
+    def __init__(self, file, offset = 0, lazy = False):
+        self.file = file
+        self.decoder = XMLDecoder(lazy)
+        self.buffer = ""
+        self.pos = 0
+        self.start = None
+        self.offset = offset
+        if offset != 0:
+            file.seek(offset)
+
+    def getOffset(self):
+        """Offset just past the last value read, where a new reader can
+        carry on from"""
+        return self.offset
+    def getStart(self):
+        """Offset at which the last value read started"""
+        return self.start
+
+    def close(self):
+        self.file.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        # The rest of the last read is fed from self.pos on, so values
+        # are not copied out of it one by one
+        data = self.buffer
+        pos = self.pos
+        fed = 0
+        self.decoder.reset()
+        while True:
+            if pos >= len(data):
+                data = self.file.read(READ_SIZE)
+                pos = 0
+                if data == "":
+                    self.buffer = ""
+                    if fed == 0:
+                        raise StopIteration
+                    raise ValueError("Incomplete value at offset %d" %
+                                     self.offset)
+            if fed == 0:
+                # Skip the white space between values
+                start = pos
+                pos = _SPACE.match(data, pos).end()
+                self.offset += pos - start
+                if pos == len(data):
+                    continue
+            try:
+                if pos == 0:
+                    self.decoder.feed(data)
+                else:
+                    self.decoder.feed(buffer(data, pos))
+                fed += len(data) - pos
+                pos = len(data)
+            except EndOfObjectException, e:
+                end = self.decoder.getByteIndex()
+                self.buffer = data
+                self.pos = pos + end - fed
+                self.start = self.offset
+                self.offset += end
+                return e.getObject()
+
+def open_archive(path, offset = 0, lazy = False, use_mmap = True):
+    """Return an ObjectReader over the archive at path, memory mapped
+    unless use_mmap is False. The pages of a mapped archive count towards
+    the resident size of the process as they are read, though the system
+    can take them back at any time."""
+    file = open(path, "rb")
+    if use_mmap and os.fstat(file.fileno()).st_size > 0:
+        mapped = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        file.close()
+        file = mapped
+    return ObjectReader(file, offset, lazy)
+
+class ArchiveIndex:
+    """Sidecar index of an archive, giving the offset of each value"""
+    def __init__(self, file):
+        self.file = file
+
+    def __len__(self):
+        self.file.seek(0, 2)
+        return self.file.tell() / INDEX_ENTRY_SIZE
+
+    def getOffset(self, ndx):
+        """Offset of the ndx'th value in the archive"""
+        if ndx < 0:
+            ndx += len(self)
+        entry = ""
+        if ndx >= 0:
+            self.file.seek(ndx * INDEX_ENTRY_SIZE)
+            entry = self.file.read(INDEX_ENTRY_SIZE)
+        if len(entry) < INDEX_ENTRY_SIZE:
+            raise IndexError("Archive index out of range")
+        return struct.unpack(INDEX_ENTRY, entry)[0]
+
+    def add(self, offset):
+        self.file.seek(0, 2)
+        self.file.write(struct.pack(INDEX_ENTRY, offset))
+
+def build_index(path, index_path = None):
+    """Write the sidecar index of the archive at path, or bring it up to
+    date if the archive has grown since. Returns the number of values in
+    the archive."""
+    if index_path is None:
+        index_path = path + INDEX_SUFFIX
+    index_file = open(index_path, "ab+")
+    index = ArchiveIndex(index_file)
+    count = len(index)
+    if count > 0:
+        # Carry on after the last value indexed
+        reader = open_archive(path, index.getOffset(-1), lazy = True)
+        reader.next()
+    else:
+        reader = open_archive(path, lazy = True)
+    try:
+        for obj in reader:
+            index.add(reader.getStart())
+            count += 1
+        return count
+    finally:
+        reader.close()
+        index_file.close()
+
+def load_object_at(path, ndx, index_path = None, lazy = False):
+    """Load the ndx'th value of the archive at path, using its index"""
+    if index_path is None:
+        index_path = path + INDEX_SUFFIX
+    index_file = open(index_path, "rb")
+    try:
+        offset = ArchiveIndex(index_file).getOffset(ndx)
+    finally:
+        index_file.close()
+    reader = open_archive(path, offset, lazy, use_mmap = False)
+    try:
+        return reader.next()
+    finally:
+        reader.close()
 
-    return obj_par.getInstances()
+def load_objects_from_file(file):
+    """Load a list of all the values in a file (or file name). Large files
+    should be read with an ObjectReader instead."""
+    if isinstance(file, types.StringTypes):
+        reader = open_archive(file, use_mmap = False)
+        try:
+            return list(reader)
+        finally:
+            reader.close()
+    return list(ObjectReader(file))
 
 def load_object_from_file(file):
-    """Load a single object from a file"""
-    # Note: If there are more than one object in the file, it will try to 
-    # parse the objects. The file must come to an end at some point, not
-    # for use with just keeping an open stream like the from_socket sister
-    # function.
-
+    """Load a single object from a file (or file name)"""
     objs = load_objects_from_file(file)
     assert len(objs) == 1, "More than one object in file"
     return objs[0]